@@ -1,49 +1,225 @@
 import os
 import pandas as pd
+import numpy as np
 import math
 import uuid
 import time
 from datetime import datetime
-from flask import Flask, request, jsonify, send_file, send_from_directory
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
+from job_store import create_job_store
+from pdf_cache import PDFCache
+from upload_store import UploadStore
+from live_trips import LiveTripStore
+from fleet_store import FILTER_COLUMNS, RANGE_COLUMNS, FleetStore, speed_histograms
+from geofences import GeofenceIndex
+from report_template import ReportTemplate
+from pdf_merge import PDFMerger
+from trip_export import EXPORT_FORMATS, gzip_chunks, iter_export
+from metrics import Registry, SQLiteMetricStore
 from reportlab.lib.pagesizes import letter
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Flowable
+from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
+from reportlab import rl_config
 import io
+import copy
+import json
+import hashlib
+import shutil
+import zipfile
+import heapq
+import cProfile
+import itertools
+import functools
+import openpyxl
+from xml.etree import ElementTree
+import socket
+import sys
 import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 
 app = Flask(__name__)
 CORS(app)
 
-# Create directories if they don't exist
+# Request bodies larger than this are refused with 413 before they are read
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', 512 * 1024 * 1024))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Set by gunicorn.conf.py: the server runs the startup tasks once in its
+# master process and starts each worker's batch thread after forking
+SERVER_MANAGED = os.environ.get('TRIP_ANALYTICS_SERVER') == 'gunicorn'
+
+# Set in the render pool's processes and their fork server (see
+# create_render_pool), which import this module to render trips and leave the
+# startup tasks and batch thread to the process that started them.
+# multiprocessing marks a process as _inheriting while it imports the modules
+# a new child needs.
+RENDER_PROCESS = (getattr(multiprocessing.current_process(), '_inheriting', False)
+                  or multiprocessing.parent_process() is not None)
+
 UPLOAD_FOLDER = 'uploads'
+BATCH_FOLDER = os.path.join(UPLOAD_FOLDER, 'batches')
 PDF_FOLDER = '/tmp/generated_pdfs'  # Use temp directory for Render free tier
-for folder in [UPLOAD_FOLDER, PDF_FOLDER]:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
 
-# Clean up any existing files in temp directory on startup
+# Store batch processing status (shared by every process and kept across restarts)
+job_store = create_job_store(os.environ.get(
+    'JOB_STORE_URL', f"sqlite:///{os.path.join(UPLOAD_FOLDER, 'batch_jobs.db')}"
+))
+
+# Rendered PDFs are cached by content, so re-uploads of the same trip are served
+# without rendering again. Unused files are evicted by age and total size,
+# except those of batches that have not expired yet.
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+PDF_CACHE_MAX_AGE_SECONDS = int(os.environ.get('PDF_CACHE_MAX_AGE_SECONDS', 24 * 3600))
+pdf_cache = PDFCache(PDF_FOLDER, PDF_CACHE_MAX_BYTES, PDF_CACHE_MAX_AGE_SECONDS,
+                     pinned=job_store.batch_pdfs)
+
+# Processed uploads, kept so later requests can refer to them by upload_id
+# instead of sending and parsing the file again
+UPLOAD_STORE_FOLDER = os.path.join(UPLOAD_FOLDER, 'normalized')
+UPLOAD_RETENTION_SECONDS = int(os.environ.get('UPLOAD_RETENTION_SECONDS', 24 * 3600))
+upload_store = UploadStore(UPLOAD_STORE_FOLDER)
+
+# Exports of stored uploads are written this many rows (of whole trips) at a
+# time; gzip level 1 compresses about four times faster than the default 6
+# for output about 10% larger
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 100000))
+EXPORT_GZIP_LEVEL = int(os.environ.get('EXPORT_GZIP_LEVEL', 1))
+
+# Running totals of trips that are still receiving pings (created below, once
+# compute_ping_metrics is defined). Trips idle for LIVE_TRIP_RETENTION_SECONDS
+# are purged by the batch worker.
+LIVE_TRIP_DB = os.environ.get('LIVE_TRIP_DB', os.path.join(UPLOAD_FOLDER, 'live_trips.db'))
+LIVE_TRIP_RETENTION_SECONDS = int(os.environ.get('LIVE_TRIP_RETENTION_SECONDS', 7 * 24 * 3600))
+
+# Per-trip, per-day aggregates of every processed upload and batch, queried
+# by /fleet-analytics (FLEET_ANALYTICS=0 stops recording them)
+FLEET_DB = os.environ.get('FLEET_DB', os.path.join(UPLOAD_FOLDER, 'fleet_analytics.db'))
+FLEET_ANALYTICS = os.environ.get('FLEET_ANALYTICS', '1') != '0'
+fleet_store = FleetStore(FLEET_DB)
+
+# Metrics served by /metrics in the Prometheus text format. Every process
+# (web workers, batch workers and their render pools) adds its counters and
+# histograms to METRICS_DB, so a scrape sees the totals over all of them.
+# Stages: read (loading an upload), parse (timestamps), process (filtering,
+# metrics and summaries), render (PDF layout) and write (storing uploads,
+# payloads and PDFs). Renders in pool workers are timed there and recorded
+# by the batch worker when the trip settles.
+METRICS_DB = os.environ.get('METRICS_DB', os.path.join(UPLOAD_FOLDER, 'metrics.db'))
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 1))
+metrics = Registry(SQLiteMetricStore(METRICS_DB), METRICS_FLUSH_SECONDS)
+STAGE_SECONDS = metrics.histogram(
+    'trip_analytics_stage_seconds', 'Time spent in each processing stage', ['stage'])
+TRIP_SECONDS = metrics.histogram(
+    'trip_analytics_trip_seconds', 'Time to render and store one trip report', ['source'])
+REQUEST_SECONDS = metrics.histogram(
+    'trip_analytics_request_seconds', 'Time to handle a request, until its response is returned', ['endpoint'])
+ROWS_REJECTED = metrics.counter(
+    'trip_analytics_rows_rejected_total', 'Upload rows left out of the analysis', ['reason'])
+PDFS_GENERATED = metrics.counter(
+    'trip_analytics_pdfs_generated_total', 'Trip PDFs rendered (cache hits excluded)', ['source'])
+UPLOADS_REJECTED = metrics.counter(
+    'trip_analytics_uploads_rejected_total', 'Uploads turned away by validation before being read in full', ['reason'])
+REQUESTS_THROTTLED = metrics.counter(
+    'trip_analytics_requests_throttled_total', 'CPU-heavy requests turned away with 429', ['endpoint'])
+metrics.gauge(
+    'trip_analytics_batch_trips', 'Batch trips waiting to be rendered (queued) or rendering (running)', ['state'],
+    callback=lambda: {(state,): job_store.queue_stats()[f'{state}_trips'] for state in ('queued', 'running')})
+metrics.gauge(
+    'trip_analytics_active_batches', 'Batches still being ingested or rendered',
+    callback=lambda: {(): job_store.queue_stats()['active_batches']})
+
+# Per-request cProfile dumps, for requests sent with ?profile=1 or an
+# X-Profile header while PROFILE_REQUESTS=1
+PROFILE_REQUESTS = os.environ.get('PROFILE_REQUESTS', '0') == '1'
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', '/tmp/trip_analytics_profiles')
+
+# Evict stale cache files
 def cleanup_temp_directory():
     """Clean up temp directory on startup"""
     try:
-        if os.path.exists(PDF_FOLDER):
-            for filename in os.listdir(PDF_FOLDER):
-                filepath = os.path.join(PDF_FOLDER, filename)
-                if os.path.isfile(filepath):
-                    os.remove(filepath)
-            print("Cleaned up temporary files on startup")
+        removed = pdf_cache.evict()
+        print(f"Cleaned up temporary files on startup ({removed} removed)")
     except Exception as e:
         print(f"Error cleaning up temp directory: {str(e)}")
 
-# Clean up on startup
-cleanup_temp_directory()
+def run_startup_tasks():
+    """Create the data directories and clean up the PDF cache (once per deployment)"""
+    for folder in [UPLOAD_FOLDER, BATCH_FOLDER, PDF_FOLDER]:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    cleanup_temp_directory()
+
+# Clean up on startup, unless the server already did
+if not SERVER_MANAGED and not RENDER_PROCESS:
+    run_startup_tasks()
+
+# CPU-heavy requests (parsing uploads, rendering PDFs) allowed to run at once
+# in each process. Others wait up to HEAVY_REQUEST_WAIT_SECONDS for a slot and
+# are then turned away with 429.
+HEAVY_REQUEST_SLOTS = max(1, int(os.environ.get('HEAVY_REQUEST_SLOTS', 2)))
+HEAVY_REQUEST_WAIT_SECONDS = float(os.environ.get('HEAVY_REQUEST_WAIT_SECONDS', 10))
+heavy_request_slots = threading.BoundedSemaphore(HEAVY_REQUEST_SLOTS)
+
+# Worker processes used to render batch PDFs (1 renders on the batch worker thread).
+# They are started from a fork server or spawned, never forked from the
+# multi-threaded web or worker process, since a lock held by another thread at
+# fork time could deadlock a forked child.
+BATCH_WORKERS = max(1, int(os.environ.get('BATCH_WORKERS', 1)))
+
+# Batch worker queue settings
+MAX_TRIP_ATTEMPTS = int(os.environ.get('MAX_TRIP_ATTEMPTS', 3))
+TRIP_LEASE_SECONDS = int(os.environ.get('TRIP_LEASE_SECONDS', 600))
+BATCH_RETENTION_SECONDS = int(os.environ.get('BATCH_RETENTION_SECONDS', 3600))
+WORKER_POLL_SECONDS = 1.0
+WORKER_PURGE_SECONDS = 60
+
+# Run a batch worker thread inside each web process (set to 0 when running
+# dedicated `python app.py worker` processes instead)
+BATCH_WORKER_THREAD = os.environ.get('BATCH_WORKER_THREAD', '1') != '0'
+batch_worker_thread = None
+
+# CSV uploads at least this large are read in chunks instead of all at once
+STREAMING_MIN_BYTES = int(os.environ.get('STREAMING_MIN_BYTES', 20 * 1024 * 1024))
+CSV_CHUNK_ROWS = int(os.environ.get('CSV_CHUNK_ROWS', 200000))
 
-# Store batch processing status
-batch_jobs = {}
+# Columns (and their narrow dtypes) kept when streaming a CSV upload
+STREAM_DTYPES = {
+    'latitude': 'float32',
+    'longitude': 'float32',
+    'device_timestamp': 'str',
+    'trip_id': 'Int64'
+}
+
+# Optional per-trip columns kept alongside them (as text) for fleet analytics,
+# mapped to their fleet store names
+TRIP_METADATA_COLUMNS = {
+    'trip_created_at': 'trip_created_at',
+    'trip_closed_at': 'trip_closed_at',
+    'Invoice Number': 'invoice_number',
+    'vehicle_number': 'vehicle'
+}
+KEPT_DTYPES = {**STREAM_DTYPES, **{col: 'str' for col in TRIP_METADATA_COLUMNS}}
+
+# Columns every upload needs, and the largest absolute value of each coordinate
+REQUIRED_COLUMNS = ['latitude', 'longitude', 'device_timestamp']
+COORDINATE_LIMITS = {'latitude': 90, 'longitude': 180}
+
+# Uploads are checked on their header and first rows before being read in full.
+# A sampled column fails when more than UPLOAD_MAX_INVALID_SHARE of its rows are empty or invalid.
+UPLOAD_SAMPLE_ROWS = int(os.environ.get('UPLOAD_SAMPLE_ROWS', 1000))
+UPLOAD_MAX_INVALID_SHARE = float(os.environ.get('UPLOAD_MAX_INVALID_SHARE', 0.5))
+UPLOAD_ERROR_EXAMPLES = 5
+
+# Counts of a processed upload's row report (see row_report)
+ROW_REPORT_KEYS = ['rows', 'analysed', 'missing_trip_id', 'unparseable_timestamp', 'missing_timestamp',
+                   'short_trip', 'ping_filter', 'invalid_coordinates']
 
 def haversine_distance(lat1, lon1, lat2, lon2):
     """Calculate the great circle distance between two points on Earth in KM"""
@@ -59,6 +235,181 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     
     return R * c
 
+def haversine_distance_np(lat1, lon1, lat2, lon2):
+    """Vectorized haversine distance in KM between arrays of points"""
+    R = 6371  # Earth's radius in kilometers
+    
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    
+    return R * c
+
+def equirectangular_distance_np(lat1, lon1, lat2, lon2):
+    """Vectorized equirectangular distance in KM between arrays of points
+    
+    Treats the sphere as flat around each pair's mean latitude. For
+    consecutive pings up to ~10 KM apart it stays within a centimetre of
+    haversine, with one cosine per pair instead of four trig calls.
+    """
+    R = 6371  # Earth's radius in kilometers
+    
+    # Differences are taken in degrees and converted once, at the end
+    lat1, lon1, lat2, lon2 = (np.asarray(value, dtype=float) for value in [lat1, lon1, lat2, lon2])
+    
+    dlat = lat2 - lat1
+    dlon = (lon2 - lon1 + 180) % 360 - 180
+    x = dlon * np.cos(np.radians((lat1 + lat2) / 2))
+    
+    return (R * np.pi / 180) * np.hypot(x, dlat)
+
+# WGS-84 ellipsoid, for the Vincenty distance
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+VINCENTY_MAX_ITERATIONS = 200
+VINCENTY_TOLERANCE = 1e-12
+
+def vincenty_distance_np(lat1, lon1, lat2, lon2):
+    """Vectorized Vincenty (inverse) distance in KM on the WGS-84 ellipsoid
+    
+    Accurate to a fraction of a millimetre. Every pair is iterated together
+    until all have converged; the rare nearly antipodal pairs where Vincenty
+    does not converge fall back to haversine.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*map(np.radians, [lat1, lon1, lat2, lon2]))
+    
+    U1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    U2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+    L = lon2 - lon1
+    lam = L
+    
+    for _ in range(VINCENTY_MAX_ITERATIONS):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_U2 * sin_lam, cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam)
+        cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        sin_alpha = np.divide(cos_U1 * cos_U2 * sin_lam, sin_sigma,
+                              out=np.zeros_like(sin_sigma), where=sin_sigma != 0)
+        cos2_alpha = 1 - sin_alpha ** 2
+        # Pairs on the equator have cos2_alpha = 0 and cos_2sigma_m = 0
+        cos_2sigma_m = cos_sigma - np.divide(2 * sin_U1 * sin_U2, cos2_alpha,
+                                             out=cos_sigma.copy(), where=cos2_alpha != 0)
+        C = WGS84_F / 16 * cos2_alpha * (4 + WGS84_F * (4 - 3 * cos2_alpha))
+        lam_previous = lam
+        lam = L + (1 - C) * WGS84_F * sin_alpha * (
+            sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+        )
+        change = np.abs(lam - lam_previous)
+        converged = (change < VINCENTY_TOLERANCE) | np.isnan(change)
+        if converged.all():
+            break
+    
+    u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (
+        cos_sigma * (-1 + 2 * cos_2sigma_m ** 2) -
+        B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+    ))
+    distances = WGS84_B * A * (sigma - delta_sigma) / 1000
+    
+    if not converged.all():
+        distances = np.where(converged, distances, haversine_distance_np(
+            np.degrees(lat1), np.degrees(lon1), np.degrees(lat2), np.degrees(lon2)))
+    return distances
+
+# Distance models for the gaps between pings, selected per request with a
+# distance_model form field (DISTANCE_MODEL by default): haversine on a sphere,
+# the cheaper equirectangular approximation, or ellipsoidal Vincenty for
+# billing-grade totals. See benchmarks/bench_distance_models.py.
+DISTANCE_MODELS = {
+    'haversine': haversine_distance_np,
+    'equirectangular': equirectangular_distance_np,
+    'vincenty': vincenty_distance_np
+}
+DISTANCE_MODEL = os.environ.get('DISTANCE_MODEL', 'haversine')
+if DISTANCE_MODEL not in DISTANCE_MODELS:
+    raise ValueError(f"DISTANCE_MODEL must be one of {sorted(DISTANCE_MODELS)}")
+
+def distance_model_option(form):
+    """The distance model named in request form fields, or None when not given"""
+    distance_model = form.get('distance_model') or None
+    if distance_model is not None and distance_model not in DISTANCE_MODELS:
+        raise ValueError(f"distance_model must be one of {sorted(DISTANCE_MODELS)}")
+    return distance_model
+
+def compute_ping_metrics(latitudes, longitudes, timestamps, distance_model=DISTANCE_MODEL):
+    """Calculate per-ping distance (KM), duration (hours) and speed (KM/Hr)
+    
+    Takes equal-length arrays sorted by timestamp. Each ping is measured from
+    the one before it (with the distance_model named in DISTANCE_MODELS), so
+    the first ping gets 0 for all three metrics and a ping with a
+    zero-duration gap gets a speed of 0.
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+    
+    count = len(latitudes)
+    distances = np.zeros(count)
+    durations = np.zeros(count)
+    speeds = np.zeros(count)
+    if count < 2:
+        return distances, durations, speeds
+    
+    distances[1:] = DISTANCE_MODELS[distance_model](
+        latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]
+    )
+    durations[1:] = np.diff(timestamps).astype(np.int64) / 1e9 / 3600
+    np.divide(distances, durations, out=speeds, where=durations > 0)
+    
+    return distances, durations, speeds
+
+live_trip_store = LiveTripStore(LIVE_TRIP_DB, compute_ping_metrics)
+
+# Depots, plants and customer sites (CSV or GeoJSON) that trips are tagged
+# with; sites without a radius_m get GEOFENCE_DEFAULT_RADIUS_M
+GEOFENCE_FILE = os.environ.get('GEOFENCE_FILE')
+GEOFENCE_DEFAULT_RADIUS_M = float(os.environ.get('GEOFENCE_DEFAULT_RADIUS_M', 500))
+
+def load_geofence_index():
+    """The geofence index for GEOFENCE_FILE, or None when none is configured"""
+    if not GEOFENCE_FILE:
+        return None
+    try:
+        index = GeofenceIndex.load(GEOFENCE_FILE, haversine_distance_np, GEOFENCE_DEFAULT_RADIUS_M)
+        print(f"Loaded {len(index)} geofences from {GEOFENCE_FILE}")
+        return index
+    except Exception as e:
+        print(f"Error loading geofences from {GEOFENCE_FILE}: {str(e)}")
+        return None
+
+geofence_index = load_geofence_index()
+
+# Timestamp formats accepted in uploads, in order of preference
+TIMESTAMP_FORMATS = [
+    '%d/%m/%y %H:%M',      # 04/02/25 16:19
+    '%m/%d/%y %H:%M',      # 02/04/25 16:19
+    '%d/%m/%Y %H:%M',      # 04/02/2025 16:19
+    '%m/%d/%Y %H:%M',      # 02/04/2025 16:19
+    '%Y-%m-%d %H:%M:%S',   # 2025-02-04 16:19:00
+    '%Y-%m-%d %H:%M',      # 2025-02-04 16:19
+    '%d-%m-%Y %H:%M',      # 04-02-2025 16:19
+    '%m-%d-%Y %H:%M',      # 02-04-2025 16:19
+    '%d/%m/%y %H:%M:%S',   # 04/02/25 16:19:30
+    '%m/%d/%y %H:%M:%S',   # 02/04/25 16:19:30
+]
+
+# Number of non-empty cells used to pick the format for a column
+TIMESTAMP_SAMPLE_SIZE = 1000
+
 def parse_timestamp(timestamp_str):
     """Parse timestamp from various formats"""
     try:
@@ -73,36 +424,122 @@ def parse_timestamp(timestamp_str):
         if not timestamp_str or timestamp_str.lower() in ['', 'nan', 'none', 'null']:
             return None
         
-        # List of formats to try
-        formats = [
-            '%d/%m/%y %H:%M',      # 04/02/25 16:19
-            '%m/%d/%y %H:%M',      # 02/04/25 16:19
-            '%d/%m/%Y %H:%M',      # 04/02/2025 16:19
-            '%m/%d/%Y %H:%M',      # 02/04/2025 16:19
-            '%Y-%m-%d %H:%M:%S',   # 2025-02-04 16:19:00
-            '%Y-%m-%d %H:%M',      # 2025-02-04 16:19
-            '%d-%m-%Y %H:%M',      # 04-02-2025 16:19
-            '%m-%d-%Y %H:%M',      # 02-04-2025 16:19
-            '%d/%m/%y %H:%M:%S',   # 04/02/25 16:19:30
-            '%m/%d/%y %H:%M:%S',   # 02/04/25 16:19:30
-        ]
-        
-        for fmt in formats:
+        for fmt in TIMESTAMP_FORMATS:
             try:
                 return datetime.strptime(timestamp_str, fmt)
             except ValueError:
                 continue
         
-        # If all formats fail, print debug info for first few failures
-        print(f"Failed to parse timestamp: '{timestamp_str}' (type: {type(timestamp_str)})")
+        # Unparseable values are counted by parse_timestamp_column
         return None
         
-    except Exception as e:
-        print(f"Error parsing timestamp '{timestamp_str}': {str(e)}")
+    except Exception:
         return None
 
-def process_trip_data(df):
-    """Process trip data to calculate distances, durations, and speeds"""
+def infer_timestamp_formats(text, formats=TIMESTAMP_FORMATS, sample_size=TIMESTAMP_SAMPLE_SIZE):
+    """Rank candidate formats by how many sampled cells they parse
+    
+    Returns the formats that parse at least one sampled cell, best first. Ties
+    keep the order of `formats`, so an all-ambiguous dd/mm vs mm/dd file is read
+    day-first for the whole file, as parse_timestamp would.
+    """
+    if len(text) == 0:
+        return []
+    
+    # Spread the sample over the whole column
+    step = max(1, len(text) // sample_size)
+    sample = text.iloc[::step].iloc[:sample_size]
+    
+    scores = []
+    for fmt in formats:
+        hits = int(pd.to_datetime(sample, format=fmt, errors='coerce').notna().sum())
+        if hits:
+            scores.append((hits, fmt))
+    
+    scores.sort(key=lambda score: -score[0])
+    return [fmt for _, fmt in scores]
+
+def blank_values(values):
+    """Mask of the cells of a column that count as empty (missing, blank or a null placeholder)"""
+    text = values.astype(str).str.strip().str.lower()
+    return (values.isna() | text.isin(['', 'nan', 'nat', 'none', 'null'])).to_numpy()
+
+def parse_timestamp_values(values, formats=TIMESTAMP_FORMATS):
+    """Parse a whole column of timestamps with a format inferred once per column
+    
+    Distinct values are parsed once each (pings from a fleet share most of
+    their minute-resolution timestamps) using vectorized pd.to_datetime with
+    the inferred format, then the other matching candidates. Only values that
+    still fail fall back to the per-cell parse_timestamp. A single entry in
+    formats fixes the format: it is used without sampling, and only the values
+    it can't read go to parse_timestamp. Returns the parsed datetime Series
+    and a report of the inferred format and parsed/rejected/empty row counts.
+    """
+    values = pd.Series(values)
+    
+    # Excel columns that were already converted to datetimes
+    if pd.api.types.is_datetime64_any_dtype(values):
+        parsed = pd.to_datetime(values)
+        report = {
+            'format': 'datetime',
+            'parsed': int(parsed.notna().sum()),
+            'rejected': 0,
+            'empty': int(parsed.isna().sum())
+        }
+        return parsed, report
+    
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    blank = blank_values(uniques)
+    text = uniques.astype(str).str.strip()[~blank]
+    
+    candidates = list(formats) if len(formats) == 1 else infer_timestamp_formats(text, formats)
+    unique_parsed = pd.Series(pd.NaT, index=uniques.index, dtype='datetime64[ns]')
+    for fmt in candidates:
+        remaining = unique_parsed[text.index].isna()
+        if not remaining.any():
+            break
+        pending = text[remaining.to_numpy()]
+        unique_parsed[pending.index] = pd.to_datetime(pending, format=fmt, errors='coerce')
+    
+    # Per-cell fallback for the values none of the inferred formats could read
+    remaining = text.index[unique_parsed[text.index].isna().to_numpy()]
+    if len(remaining):
+        unique_parsed[remaining] = pd.to_datetime(uniques[remaining].apply(parse_timestamp), errors='coerce')
+    
+    # Missing values have code -1, which picks the trailing NaT
+    lookup = np.append(unique_parsed.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT'))
+    parsed = pd.Series(lookup[codes], index=values.index)
+    
+    value_counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    empty = int((codes < 0).sum() + value_counts[blank].sum())
+    parsed_count = int(parsed.notna().sum())
+    report = {
+        'format': candidates[0] if candidates else None,
+        'parsed': parsed_count,
+        'rejected': int(len(values) - parsed_count - empty),
+        'empty': empty
+    }
+    return parsed, report
+
+@STAGE_SECONDS.timed(stage='parse')
+def parse_timestamp_column(values, formats=TIMESTAMP_FORMATS):
+    """parse_timestamp_values, counting the rows it rejects in ROWS_REJECTED"""
+    parsed, report = parse_timestamp_values(values, formats)
+    if report['rejected']:
+        print(f"Rejected {report['rejected']} unparseable timestamps (inferred format: {report['format']})")
+        ROWS_REJECTED.inc(report['rejected'], reason='timestamp')
+    if report['empty']:
+        ROWS_REJECTED.inc(report['empty'], reason='missing_timestamp')
+    return parsed, report
+
+def process_trip_data(df, ping_filter=None, distance_model=None):
+    """Process trip data to calculate distances, durations, and speeds
+    
+    ping_filter, if given, holds filter_pings settings; noisy pings are then
+    dropped after sorting and before the metrics are computed. distance_model
+    names one of DISTANCE_MODELS (DISTANCE_MODEL when None).
+    """
     # Input validation
     if df is None or len(df) == 0:
         raise ValueError("DataFrame is empty")
@@ -117,11 +554,12 @@ def process_trip_data(df):
         raise ValueError(f"Missing required columns: {missing_columns}")
     
     # Sort by timestamp
+    rows = len(df)
     df = df.copy()
-    df['parsed_timestamp'] = df['device_timestamp'].apply(parse_timestamp)
+    df['parsed_timestamp'], timestamp_report = parse_timestamp_column(df['device_timestamp'])
     
     # Remove rows with invalid timestamps
-    df = df.dropna(subset=['parsed_timestamp']).sort_values('parsed_timestamp')
+    df = df.dropna(subset=['parsed_timestamp']).sort_values('parsed_timestamp', kind='stable')
     
     # Check again after filtering
     if len(df) < 2:
@@ -130,47 +568,1265 @@ def process_trip_data(df):
     # Reset index to avoid indexing issues
     df = df.reset_index(drop=True)
     
-    # Calculate distances and durations
-    distances = []
-    durations = []
-    speeds = []
+    filter_report = None
+    if ping_filter:
+        df, filter_report = filter_pings(df, **ping_filter)
+        if len(df) < 2:
+            raise ValueError("Trip has insufficient valid data after filtering")
     
-    for i in range(len(df)):
-        if i == 0:
-            distances.append(0)
-            durations.append(0)
-            speeds.append(0)
-        else:
-            try:
-                # Calculate distance
-                prev_row = df.iloc[i-1]
-                curr_row = df.iloc[i]
-                
-                distance = haversine_distance(
-                    prev_row['latitude'], prev_row['longitude'],
-                    curr_row['latitude'], curr_row['longitude']
-                )
-                distances.append(distance)
-                
-                # Calculate duration in hours
-                time_diff = (curr_row['parsed_timestamp'] - prev_row['parsed_timestamp']).total_seconds() / 3600
-                durations.append(time_diff)
-                
-                # Calculate speed (km/h)
-                speed = distance / time_diff if time_diff > 0 else 0
-                speeds.append(speed)
-                
-            except Exception as e:
-                print(f"Error calculating metrics for row {i}: {str(e)}")
-                distances.append(0)
-                durations.append(0)
-                speeds.append(0)
+    df = add_ping_metrics(df, distance_model=distance_model)
+    df.attrs['timestamp_parsing'] = timestamp_report
+    if filter_report:
+        df.attrs['ping_filter'] = filter_report
+    df.attrs['row_report'] = row_report(df, rows, timestamp_report, filter_report)
+    return df
+
+@STAGE_SECONDS.timed(stage='process')
+def add_ping_metrics(df, trip_starts=None, distance_model=None):
+    """Add distance_km, duration_hours and speed_kmh columns to a sorted frame
+    
+    trip_starts holds the row positions where a new trip begins when the frame
+    contains several trips laid out one after another; those pings get zero
+    metrics just like the first ping of a single trip, as do pings with
+    non-numeric or out of range coordinates (counted in
+    df.attrs['invalid_coordinates']), including rows of a stored upload
+    flagged in its invalid_coordinate column (see stored_coordinates). The
+    model used (DISTANCE_MODEL unless distance_model is given) is recorded
+    in df.attrs['distance_model'].
+    """
+    distance_model = distance_model or DISTANCE_MODEL
+    latitudes = pd.to_numeric(df['latitude'], errors='coerce')
+    longitudes = pd.to_numeric(df['longitude'], errors='coerce')
+    distances, durations, speeds = compute_ping_metrics(
+        latitudes.to_numpy(dtype=float),
+        longitudes.to_numpy(dtype=float),
+        pd.to_datetime(df['parsed_timestamp']).to_numpy(dtype='datetime64[ns]'),
+        distance_model
+    )
+    
+    # Pings with non-numeric or out of range coordinates get zero metrics, as do the pings after them
+    invalid = ((latitudes.isna() & df['latitude'].notna()) | (latitudes.abs() > COORDINATE_LIMITS['latitude']) |
+               (longitudes.isna() & df['longitude'].notna()) | (longitudes.abs() > COORDINATE_LIMITS['longitude'])
+               ).to_numpy(copy=True)
+    if 'invalid_coordinate' in df.columns:
+        invalid |= df['invalid_coordinate'].to_numpy(dtype=bool)
+    invalid_count = int(invalid.sum())
+    if invalid_count:
+        print(f"Invalid coordinates in {invalid_count} rows, metrics set to 0")
+        ROWS_REJECTED.inc(invalid_count, reason='coordinates')
+        invalid = invalid | np.concatenate(([False], invalid[:-1]))
+    if trip_starts is not None:
+        invalid[trip_starts] = True
+    distances[invalid] = 0
+    durations[invalid] = 0
+    speeds[invalid] = 0
     
     df['distance_km'] = distances
     df['duration_hours'] = durations
     df['speed_kmh'] = speeds
+    df.attrs['distance_model'] = distance_model
+    df.attrs['invalid_coordinates'] = invalid_count
+    
+    return df
+
+def find_trip_starts(trip_ids):
+    """Row positions where each contiguous run of trip_id values begins"""
+    trip_ids = np.asarray(trip_ids)
+    if len(trip_ids) == 0:
+        return np.array([], dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], trip_ids[1:] != trip_ids[:-1])))
+
+# Ping noise filtering (off unless a request asks for it)
+PING_FILTER_MAX_SPEED_KMH = float(os.environ.get('PING_FILTER_MAX_SPEED_KMH', 150))
+PING_FILTER_STATIONARY_RADIUS_M = float(os.environ.get('PING_FILTER_STATIONARY_RADIUS_M', 0))
+DOWNSAMPLE_METHODS = ('douglas-peucker', 'time')
+
+# Gaps shorter than this are treated as this long when checking for jumps, so
+# pings logged within the same minute don't look infinitely fast
+JUMP_MIN_INTERVAL_SECONDS = 60
+
+# Rounds of spike removal; each round removes isolated spikes left by the last
+JUMP_FILTER_PASSES = 3
+
+def jump_speeds(latitudes, longitudes, timestamps, first, second):
+    """Speed (KM/Hr) from ping first[i] to ping second[i], for the jump filter"""
+    distances = haversine_distance_np(latitudes[first], longitudes[first], latitudes[second], longitudes[second])
+    seconds = np.maximum((timestamps[second] - timestamps[first]) / 1e9, JUMP_MIN_INTERVAL_SECONDS)
+    return distances / (seconds / 3600)
+
+def douglas_peucker_keep(latitudes, longitudes, target_rows):
+    """Mask of the target_rows most significant pings of a track
+    
+    Greedy Douglas-Peucker: starting from the two end pings, the ping that
+    lies furthest from the kept segment around it is added until target_rows
+    pings are kept. Distances are measured in a local equirectangular
+    projection.
+    """
+    count = len(latitudes)
+    keep = np.zeros(count, dtype=bool)
+    keep[[0, -1]] = True
+    scale = math.cos(math.radians(float(np.nanmean(latitudes))))
+    x = np.radians(longitudes) * scale
+    y = np.radians(latitudes)
+    
+    heap = []
+    def push(start, stop):
+        if stop - start < 2:
+            return
+        # Distance of the pings between start and stop from the segment joining them
+        dx, dy = x[stop] - x[start], y[stop] - y[start]
+        px, py = x[start + 1:stop] - x[start], y[start + 1:stop] - y[start]
+        length = dx * dx + dy * dy
+        t = np.clip((px * dx + py * dy) / length, 0, 1) if length > 0 else 0
+        deviation = np.hypot(px - t * dx, py - t * dy)
+        farthest = int(np.argmax(deviation))
+        heapq.heappush(heap, (-deviation[farthest], start + 1 + farthest, start, stop))
+    
+    push(0, count - 1)
+    kept = 2
+    while heap and kept < target_rows:
+        _, index, start, stop = heapq.heappop(heap)
+        keep[index] = True
+        kept += 1
+        push(start, index)
+        push(index, stop)
+    return keep
+
+def time_bucket_keep(timestamps, trip_first, trip_last, target_rows):
+    """Mask keeping the first ping in each of target_rows - 1 equal time buckets of every trip, plus its last ping
+    
+    trip_first and trip_last are the positions of each trip's first and last ping.
+    """
+    trip_codes = np.repeat(np.arange(len(trip_first)), trip_last - trip_first + 1)
+    start = timestamps[trip_first][trip_codes]
+    span = (timestamps[trip_last] - timestamps[trip_first])[trip_codes].astype(float)
+    buckets = np.zeros(len(timestamps))
+    np.divide((timestamps - start) * (target_rows - 1.0), span, out=buckets, where=span > 0)
+    buckets = np.floor(buckets)
+    keep = np.ones(len(timestamps), dtype=bool)
+    keep[1:] = (buckets[1:] != buckets[:-1]) | (trip_codes[1:] != trip_codes[:-1])
+    keep[trip_last] = True
+    return keep
+
+def check_downsample(downsample, target_rows):
+    """Raise ValueError for an unknown downsample method or a missing target_rows"""
+    if downsample is None:
+        return
+    if downsample not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"Unknown downsample method: {downsample} (use one of {list(DOWNSAMPLE_METHODS)})")
+    if not target_rows or target_rows < 2:
+        raise ValueError("target_rows of at least 2 is required for downsampling")
+
+@STAGE_SECONDS.timed(stage='process')
+def filter_pings(df, trip_starts=None, max_speed_kmh=PING_FILTER_MAX_SPEED_KMH,
+                 stationary_radius_m=PING_FILTER_STATIONARY_RADIUS_M, downsample=None, target_rows=None):
+    """Drop noisy pings from a frame sorted by trip and time, before its metrics are computed
+    
+    Three steps, each run on every trip of the frame at once:
+    
+    - stationary duplicates: in a run of consecutive pings within
+      stationary_radius_m of the one before (0 means identical coordinates),
+      only the first and last ping are kept, so the trip's timing is unchanged;
+    - jumps: a ping that is reached and left faster than max_speed_kmh while
+      its neighbours are within that speed of each other is a spike and is
+      dropped, as is a first or last ping that is too far from the rest;
+    - downsample ('douglas-peucker' or 'time'), optional: trips with more
+      than target_rows pings are cut down to target_rows, keeping the pings
+      that best preserve the route or one ping per equal time bucket.
+    
+    trip_starts is as for add_ping_metrics. Neither of the first two steps
+    drops a trip's first or last ping, but the jump step can (when it jumps
+    away), so a 3-ping trip may be left with a single ping: callers drop
+    such trips again afterwards (see drop_short_trips). Returns the filtered
+    frame and a report of how many pings each step removed.
+    """
+    check_downsample(downsample, target_rows)
+    
+    count = len(df)
+    latitudes = pd.to_numeric(df['latitude'], errors='coerce').to_numpy(dtype=float)
+    longitudes = pd.to_numeric(df['longitude'], errors='coerce').to_numpy(dtype=float)
+    timestamps = pd.to_datetime(df['parsed_timestamp']).to_numpy(dtype='datetime64[ns]').view('int64')
+    is_start = np.zeros(count, dtype=bool)
+    is_start[0 if trip_starts is None else trip_starts] = True
+    trip_codes = np.cumsum(is_start) - 1
+    
+    # Stationary duplicates: ping i is still if it is at the place of ping i - 1
+    steps = np.full(count, np.inf)
+    steps[1:] = haversine_distance_np(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]) * 1000
+    still = ~is_start & (steps <= stationary_radius_m)
+    duplicates = still & np.append(still[1:], False)
+    keep = ~duplicates
+    
+    # Jumps, judged on the pings that are left
+    jumps = 0
+    for _ in range(JUMP_FILTER_PASSES):
+        kept = np.flatnonzero(keep)
+        codes = trip_codes[kept]
+        inner = np.flatnonzero((codes[1:-1] == codes[:-2]) & (codes[1:-1] == codes[2:])) + 1
+        speed_in = jump_speeds(latitudes, longitudes, timestamps, kept[inner - 1], kept[inner])
+        speed_out = jump_speeds(latitudes, longitudes, timestamps, kept[inner], kept[inner + 1])
+        speed_skip = jump_speeds(latitudes, longitudes, timestamps, kept[inner - 1], kept[inner + 1])
+        spikes = (speed_in > max_speed_kmh) & (speed_out > max_speed_kmh) & (speed_skip <= max_speed_kmh)
+        # Of two neighbouring spikes only the first is dropped; the next pass judges the other again
+        spikes[1:] &= ~(spikes[:-1] & (inner[1:] == inner[:-1] + 1))
+        if not spikes.any():
+            break
+        keep[kept[inner[spikes]]] = False
+        jumps += int(spikes.sum())
+    
+    # A trip's first or last ping that jumps away from the rest (trips with 3+ pings left)
+    kept = np.flatnonzero(keep)
+    codes = trip_codes[kept]
+    first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    last = np.r_[first[1:], len(kept)] - 1
+    long_trips = last - first >= 2
+    first, last = first[long_trips], last[long_trips]
+    bad_first = jump_speeds(latitudes, longitudes, timestamps, kept[first], kept[first + 1]) > max_speed_kmh
+    bad_last = jump_speeds(latitudes, longitudes, timestamps, kept[last - 1], kept[last]) > max_speed_kmh
+    keep[kept[first[bad_first]]] = False
+    keep[kept[last[bad_last]]] = False
+    jumps += int(bad_first.sum() + bad_last.sum())
+    
+    # Downsampling, per trip
+    downsampled = 0
+    if downsample is not None:
+        kept = np.flatnonzero(keep)
+        codes = trip_codes[kept]
+        first = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        last = np.r_[first[1:], len(kept)] - 1
+        if downsample == 'time':
+            sampled = time_bucket_keep(timestamps[kept], first, last, target_rows)
+        else:
+            sampled = np.ones(len(kept), dtype=bool)
+            for start, stop in zip(first.tolist(), (last + 1).tolist()):
+                if stop - start > target_rows:
+                    rows = kept[start:stop]
+                    sampled[start:stop] = douglas_peucker_keep(latitudes[rows], longitudes[rows], target_rows)
+        keep[kept[~sampled]] = False
+        downsampled = int((~sampled).sum())
+    
+    report = {
+        'input_pings': count,
+        'stationary_duplicates': int(duplicates.sum()),
+        'jumps': jumps,
+        'downsampled': downsampled,
+        'removed': int(count - keep.sum()),
+        'output_pings': int(keep.sum())
+    }
+    if report['removed']:
+        ROWS_REJECTED.inc(report['removed'], reason='ping_filter')
+    return df[keep].reset_index(drop=True), report
+
+def merge_filter_reports(reports):
+    """Combine the ping_filter reports of several processed frames"""
+    reports = [report for report in reports if report]
+    if not reports:
+        return None
+    return {key: sum(report[key] for report in reports) for key in reports[0]}
+
+def row_report(processed, rows, timestamp_report, filter_report=None, missing_trip_id=0, short_trip=0):
+    """Where the input rows of a processed frame went, by ROW_REPORT_KEYS
+    
+    rows counts the rows read and analysed those left in processed. The
+    others count rows dropped for each reason, except invalid_coordinates:
+    those rows are kept with zero metrics.
+    """
+    return {
+        'rows': int(rows),
+        'analysed': int(len(processed)),
+        'missing_trip_id': int(missing_trip_id),
+        'unparseable_timestamp': timestamp_report['rejected'],
+        'missing_timestamp': timestamp_report['empty'],
+        'short_trip': int(short_trip),
+        'ping_filter': filter_report['removed'] if filter_report else 0,
+        'invalid_coordinates': processed.attrs.get('invalid_coordinates', 0)
+    }
+
+def merge_row_reports(reports):
+    """Add up the row reports of a file's frames (and of the rows its reader dropped)"""
+    reports = [report for report in reports if report]
+    if not reports:
+        return None
+    return {key: sum(report.get(key, 0) for report in reports) for key in ROW_REPORT_KEYS}
+
+def ping_filter_options(form):
+    """Ping filter settings from request form fields, or None when filtering is off
+    
+    filter_pings=1 turns the filter on; max_speed_kmh, stationary_radius_m,
+    downsample and target_rows override its defaults.
+    """
+    if form.get('filter_pings', '').lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    try:
+        options = {
+            'max_speed_kmh': float(form.get('max_speed_kmh') or PING_FILTER_MAX_SPEED_KMH),
+            'stationary_radius_m': float(form.get('stationary_radius_m') or PING_FILTER_STATIONARY_RADIUS_M),
+            'downsample': form.get('downsample') or None,
+            'target_rows': int(form['target_rows']) if form.get('target_rows') else None
+        }
+    except ValueError:
+        raise ValueError("max_speed_kmh, stationary_radius_m and target_rows must be numbers")
+    check_downsample(options['downsample'], options['target_rows'])
+    return options
+
+def refilter_processed(processed, ping_filter, distance_model=None):
+    """Apply the ping filter and/or another distance model to already processed rows
+    
+    The rows are measured again when either changes them; otherwise they are
+    returned as they are.
+    """
+    stored_model = processed.attrs.get('distance_model') or 'haversine'
+    if not ping_filter and distance_model in (None, stored_model):
+        return processed
+    starts = find_trip_starts(processed['trip_id'].to_numpy()) if 'trip_id' in processed.columns else None
+    attrs = dict(processed.attrs)
+    if ping_filter:
+        processed, attrs['ping_filter'] = filter_pings(processed, starts, **ping_filter)
+        if starts is not None:
+            processed, starts, _ = drop_short_trips(processed, find_trip_starts(processed['trip_id'].to_numpy()))
+        elif len(processed) < 2:
+            raise ValueError("Trip has insufficient valid data after filtering")
+    processed = add_ping_metrics(processed, trip_starts=starts, distance_model=distance_model or stored_model)
+    processed.attrs.update(attrs, distance_model=processed.attrs['distance_model'])
+    return processed
+
+def drop_short_trips(df, starts):
+    """Drop the trips with fewer than 2 pings from a frame sorted by trip
+    
+    Returns the frame, its new trip starts and the number of rows dropped.
+    """
+    counts = np.diff(np.append(starts, len(df)))
+    short = counts < 2
+    if not short.any():
+        return df, starts, 0
+    print(f"Skipping {int(short.sum())} trips with fewer than 2 valid pings")
+    df = df[np.repeat(~short, counts)].reset_index(drop=True)
+    return df, find_trip_starts(df['trip_id'].to_numpy()), int(counts[short].sum())
+
+def process_trips(df, timestamp_formats=TIMESTAMP_FORMATS, ping_filter=None, distance_model=None):
+    """Process every trip in a multi-trip frame in a single pass
+    
+    Timestamps are parsed once for the whole frame, which is then sorted by
+    trip (in order of first appearance) and time so that each trip is one
+    contiguous block. Trips with fewer than 2 valid pings are dropped. With
+    ping_filter (filter_pings settings) noisy pings are dropped before the
+    metrics are computed with distance_model (as for process_trip_data), and
+    trips the filter leaves with a single ping are dropped too.
+    """
+    required_columns = ['latitude', 'longitude', 'device_timestamp', 'trip_id']
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    if missing_columns:
+        raise ValueError(f"Missing required columns: {missing_columns}")
+    
+    rows = len(df)
+    df = df.dropna(subset=['trip_id']).copy()
+    missing_trip_id = rows - len(df)
+    if missing_trip_id:
+        ROWS_REJECTED.inc(missing_trip_id, reason='missing_trip_id')
+    df['parsed_timestamp'], timestamp_report = parse_timestamp_column(df['device_timestamp'], timestamp_formats)
+    df = df.dropna(subset=['parsed_timestamp'])
+    
+    # Sort once by trip (first appearance order) and then by time
+    trip_codes = pd.factorize(df['trip_id'])[0]
+    order = np.lexsort((df['parsed_timestamp'].to_numpy(), trip_codes))
+    df = df.iloc[order].reset_index(drop=True)
+    
+    # Drop trips that can't produce a distance
+    df, starts, short_trip = drop_short_trips(df, find_trip_starts(df['trip_id'].to_numpy()))
+    
+    filter_report = None
+    if ping_filter and len(df):
+        df, filter_report = filter_pings(df, starts, **ping_filter)
+        df, starts, filtered_short = drop_short_trips(df, find_trip_starts(df['trip_id'].to_numpy()))
+        short_trip += filtered_short
+    if short_trip:
+        ROWS_REJECTED.inc(short_trip, reason='short_trip')
+    
+    df = add_ping_metrics(df, trip_starts=starts, distance_model=distance_model)
+    df.attrs['timestamp_parsing'] = timestamp_report
+    if filter_report:
+        df.attrs['ping_filter'] = filter_report
+    df.attrs['row_report'] = row_report(df, rows, timestamp_report, filter_report, missing_trip_id, short_trip)
+    return df
+
+def iter_trips(processed):
+    """Yield (trip_id, trip_data) for each contiguous trip in a processed frame"""
+    starts = find_trip_starts(processed['trip_id'].to_numpy())
+    ends = np.append(starts[1:], len(processed))
+    for start, end in zip(starts, ends):
+        yield processed['trip_id'].iat[start], processed.iloc[start:end].reset_index(drop=True)
+
+# Stoppage detection: an interval between two pings is stopped when its speed
+# is at most STOP_SPEED_KMH; stopped runs separated by less than
+# STOP_MERGE_GAP_SECONDS of movement are merged, and merged stops shorter
+# than STOP_MIN_DWELL_SECONDS count as moving
+STOP_SPEED_KMH = float(os.environ.get('STOP_SPEED_KMH', 5))
+STOP_MIN_DWELL_SECONDS = int(os.environ.get('STOP_MIN_DWELL_SECONDS', 10 * 60))
+STOP_MERGE_GAP_SECONDS = int(os.environ.get('STOP_MERGE_GAP_SECONDS', 5 * 60))
+
+STOP_COLUMNS = ['trip_id', 'start_time', 'end_time', 'duration_hours', 'latitude', 'longitude', 'ping_count']
+
+def detect_stops(processed, trip_starts=None, speed_kmh=STOP_SPEED_KMH,
+                 min_dwell_seconds=STOP_MIN_DWELL_SECONDS, merge_gap_seconds=STOP_MERGE_GAP_SECONDS):
+    """Split a processed frame's ping intervals into moving and stopped
+    
+    Interval i runs from ping i - 1 to ping i (its metrics are those of ping
+    i). Works on every trip of the frame in one linear pass; trip_starts is
+    as for add_ping_metrics and defaults to the trip_id runs, or one trip.
+    Returns (stopped, stops): a boolean mask over the pings' intervals and a
+    frame of stop events with their start and end time, duration, mean
+    location and ping count.
+    """
+    count = len(processed)
+    if trip_starts is None:
+        trip_starts = find_trip_starts(processed['trip_id'].to_numpy()) if 'trip_id' in processed.columns else [0]
+    is_start = np.zeros(count, dtype=bool)
+    is_start[trip_starts] = True
+    
+    distances = processed['distance_km'].to_numpy(dtype=float)
+    durations = processed['duration_hours'].to_numpy(dtype=float)
+    timestamps = pd.to_datetime(processed['parsed_timestamp']).to_numpy(dtype='datetime64[ns]').view('int64')
+    
+    # Stopped intervals (a zero-length interval that covers no distance is stopped too)
+    slow = ~is_start & (distances <= speed_kmh * durations)
+    
+    # Runs of stopped intervals: run k covers intervals first[k]..last[k]
+    edges = np.diff(np.concatenate(([False], slow, [False])).astype(np.int8))
+    first = np.flatnonzero(edges == 1)
+    last = np.flatnonzero(edges == -1) - 1
+    
+    # Merge runs of the same trip separated by a short moving gap
+    if len(first) > 1:
+        trip_codes = np.cumsum(is_start) - 1
+        gap_seconds = (timestamps[first[1:] - 1] - timestamps[last[:-1]]) / 1e9
+        merge = (trip_codes[first[1:]] == trip_codes[last[:-1]]) & (gap_seconds <= merge_gap_seconds)
+        groups = np.flatnonzero(np.r_[True, ~merge])
+        first = first[groups]
+        last = np.r_[last[groups[1:] - 1], last[-1]]
+    
+    # A stop spans the ping it was reached at (first - 1) through the one it was left at (last)
+    dwell_seconds = (timestamps[last] - timestamps[first - 1]) / 1e9
+    long_enough = dwell_seconds >= min_dwell_seconds
+    first, last = first[long_enough], last[long_enough]
+    
+    marks = np.zeros(count + 1, dtype=np.int64)
+    np.add.at(marks, first, 1)
+    np.add.at(marks, last + 1, -1)
+    stopped = np.cumsum(marks[:-1]) > 0
+    
+    # Mean location of the pings in each stop, from running sums
+    ping_counts = last - first + 2
+    latitudes = pd.to_numeric(processed['latitude'], errors='coerce').to_numpy(dtype=float)
+    longitudes = pd.to_numeric(processed['longitude'], errors='coerce').to_numpy(dtype=float)
+    lat_sums = np.r_[0, np.nancumsum(latitudes)]
+    lon_sums = np.r_[0, np.nancumsum(longitudes)]
+    trip_ids = processed['trip_id'].to_numpy()[first] if 'trip_id' in processed.columns else np.full(len(first), None)
+    stops = pd.DataFrame({
+        'trip_id': trip_ids,
+        'start_time': processed['parsed_timestamp'].to_numpy()[first - 1],
+        'end_time': processed['parsed_timestamp'].to_numpy()[last],
+        'duration_hours': (timestamps[last] - timestamps[first - 1]) / 1e9 / 3600,
+        'latitude': (lat_sums[last + 1] - lat_sums[first - 1]) / ping_counts,
+        'longitude': (lon_sums[last + 1] - lon_sums[first - 1]) / ping_counts,
+        'ping_count': ping_counts
+    }, columns=STOP_COLUMNS)
+    return stopped, stops
+
+def stop_events(stops):
+    """Stop events as JSON-ready dicts (with the matched site, once geofences are matched)"""
+    events = []
+    for stop in stops.itertuples(index=False):
+        event = {
+            'start_time': pd.Timestamp(stop.start_time).isoformat(),
+            'end_time': pd.Timestamp(stop.end_time).isoformat(),
+            'duration_hours': float(stop.duration_hours),
+            'latitude': float(stop.latitude),
+            'longitude': float(stop.longitude),
+            'ping_count': int(stop.ping_count)
+        }
+        if 'site_index' in stops.columns:
+            event['site'] = geofence_index.site(stop.site_index)
+        events.append(event)
+    return events
+
+def match_trip_sites(processed, stops, trip_starts):
+    """Geofences at each trip's first and last ping and at each of its stops
+    
+    All points are matched in one bulk query. Returns site index arrays
+    (origins, destinations, stop sites; -1 where no site matches), or None
+    when no geofences are configured.
+    """
+    if geofence_index is None:
+        return None
+    trip_starts = np.asarray(trip_starts)
+    trip_ends = np.append(trip_starts[1:], len(processed)) - 1
+    latitudes = pd.to_numeric(processed['latitude'], errors='coerce').to_numpy(dtype=float)
+    longitudes = pd.to_numeric(processed['longitude'], errors='coerce').to_numpy(dtype=float)
+    site_index, _ = geofence_index.nearest(
+        np.concatenate([latitudes[trip_starts], latitudes[trip_ends], stops['latitude'].to_numpy(dtype=float)]),
+        np.concatenate([longitudes[trip_starts], longitudes[trip_ends], stops['longitude'].to_numpy(dtype=float)])
+    )
+    trip_count = len(trip_starts)
+    return site_index[:trip_count], site_index[trip_count:2 * trip_count], site_index[2 * trip_count:]
+
+def site_names(site_indices):
+    """Distinct names of matched sites, in order of first match"""
+    names = [geofence_index.site(index)['name'] for index in site_indices if index >= 0]
+    return list(dict.fromkeys(names))
+
+def movement_totals(trip_data, stopped):
+    """Running time, stoppage time and moving average speed of one trip
+    
+    The moving average speed is the distance covered while moving over the
+    running time.
+    """
+    durations = trip_data['duration_hours'].to_numpy(dtype=float)
+    distances = trip_data['distance_km'].to_numpy(dtype=float)
+    running_time = float(durations[~stopped].sum())
+    return {
+        'running_time': running_time,
+        'stoppage_time': float(durations[stopped].sum()),
+        'moving_avg_speed': float(distances[~stopped].sum() / running_time) if running_time > 0 else 0.0
+    }
+
+@STAGE_SECONDS.timed(stage='process')
+def summarize_trips(processed, include_stops=False):
+    """Per-trip summary dicts for a processed frame, from one grouped aggregate
+    
+    running_time, stoppage_time and moving_avg_speed split the trip at the
+    stops found by detect_stops; with include_stops each summary also lists
+    its stop events. With geofences configured, the sites at the trip's
+    origin, destination and stops are added.
+    """
+    starts = find_trip_starts(processed['trip_id'].to_numpy())
+    stopped, stops = detect_stops(processed, starts)
+    sites = match_trip_sites(processed, stops, starts)
+    if sites is not None:
+        stops = stops.assign(site_index=sites[2])
+    moving = ~stopped
+    summary = processed.assign(
+        running_time=processed['duration_hours'] * moving,
+        moving_distance=processed['distance_km'] * moving
+    ).groupby('trip_id', sort=False).agg(
+        ping_count=('distance_km', 'size'),
+        total_distance=('distance_km', 'sum'),
+        total_duration=('duration_hours', 'sum'),
+        avg_speed=('speed_kmh', 'mean'),
+        running_time=('running_time', 'sum'),
+        moving_distance=('moving_distance', 'sum')
+    )
+    stops_by_trip = {trip_id: trip_stops for trip_id, trip_stops in stops.groupby('trip_id', sort=False)}
+    
+    reports = []
+    for position, (trip_id, row) in enumerate(zip(summary.index, summary.itertuples(index=False))):
+        trip_stops = stops_by_trip.get(trip_id, stops.iloc[:0])
+        report = {
+            'trip_id': int(trip_id),
+            'ping_count': int(row.ping_count),
+            'total_distance': float(row.total_distance),
+            'total_duration': float(row.total_duration),
+            'avg_speed': float(row.avg_speed),
+            'running_time': float(row.running_time),
+            'stoppage_time': float(row.total_duration - row.running_time),
+            'moving_avg_speed': float(row.moving_distance / row.running_time) if row.running_time > 0 else 0.0,
+            'stop_count': int(len(trip_stops))
+        }
+        if sites is not None:
+            report['origin_site'] = geofence_index.site(sites[0][position])
+            report['destination_site'] = geofence_index.site(sites[1][position])
+            report['stop_sites'] = site_names(trip_stops['site_index'])
+        if include_stops:
+            report['stops'] = stop_events(trip_stops)
+        reports.append(report)
+    return reports
+
+def fleet_trip_days(processed, reports, upload_id=None):
+    """Per-trip, per-day aggregates of a processed frame, for the fleet store
+    
+    Each interval between pings counts towards the day of the ping that ends
+    it; stopped intervals (see detect_stops) are idle hours and the rest are
+    moving hours. Moving speeds are binned into a histogram for percentiles.
+    Trip metadata columns (from each trip's first row) and the geofenced
+    route from the summary reports are attached to every row, with the trip's
+    creation and closing times converted to ISO 8601 (None where they don't
+    parse).
+    """
+    trip_ids = processed['trip_id'].to_numpy()
+    starts = find_trip_starts(trip_ids)
+    stopped, _ = detect_stops(processed, starts)
+    moving = ~stopped
+    distances = processed['distance_km'].to_numpy(dtype=float)
+    durations = processed['duration_hours'].to_numpy(dtype=float)
+    speeds = processed['speed_kmh'].to_numpy(dtype=float)
+    days = pd.to_datetime(processed['parsed_timestamp']).to_numpy(dtype='datetime64[ns]').astype('datetime64[D]')
+    
+    # Rows are sorted by trip and time, so every trip-day is one contiguous run
+    firsts = np.flatnonzero(np.concatenate(([True], (trip_ids[1:] != trip_ids[:-1]) | (days[1:] != days[:-1]))))
+    counts = np.diff(np.append(firsts, len(processed)))
+    trip_days = pd.DataFrame({
+        'trip_id': trip_ids[firsts],
+        'day': np.datetime_as_string(days[firsts], unit='D'),
+        'ping_count': counts,
+        'distance_km': np.add.reduceat(distances, firsts),
+        'moving_distance_km': np.add.reduceat(distances * moving, firsts),
+        'moving_hours': np.add.reduceat(durations * moving, firsts),
+        'idle_hours': np.add.reduceat(durations * stopped, firsts),
+        'max_speed_kmh': np.maximum.reduceat(speeds, firsts)
+    })
+    moving_intervals = moving & (durations > 0)
+    codes = np.repeat(np.arange(len(firsts)), counts)
+    trip_days['speed_histogram'] = list(speed_histograms(codes[moving_intervals], speeds[moving_intervals],
+                                                         len(firsts)))
+    
+    trip_rows = np.repeat(starts, np.diff(np.append(np.searchsorted(firsts, starts), len(firsts))))
+    for col, name in TRIP_METADATA_COLUMNS.items():
+        trip_days[name] = processed[col].iloc[trip_rows].to_numpy() if col in processed.columns else None
+    # Trip times are stored as ISO 8601 text, which the fleet store filters and buckets by date
+    for name in ['trip_created_at', 'trip_closed_at']:
+        if trip_days[name].notna().any():
+            parsed, _ = parse_timestamp_values(trip_days[name])
+            trip_days[name] = parsed.dt.strftime('%Y-%m-%dT%H:%M:%S').to_numpy(dtype=object)
+    routes = {
+        report['trip_id']: f"{report['origin_site']['name']} -> {report['destination_site']['name']}"
+        for report in reports if report.get('origin_site') and report.get('destination_site')
+    }
+    trip_days['route'] = trip_days['trip_id'].map(routes)
+    trip_days['upload_id'] = upload_id
+    return trip_days
+
+def record_fleet_days(processed, reports, upload_id=None):
+    """Add a processed multi-trip frame to the fleet store (when FLEET_ANALYTICS is on)"""
+    if not FLEET_ANALYTICS or 'trip_id' not in processed.columns or len(processed) == 0:
+        return
+    with STAGE_SECONDS.time(stage='write'):
+        fleet_store.record(fleet_trip_days(processed, reports, upload_id))
+
+def process_trip_frames(frames, ping_filter=None, distance_model=None):
+    """Process frames of complete trips, reusing the first frame's timestamp format
+    
+    The format inferred from the first frame is fixed for every later frame
+    (values it can't read fall back to the per-cell parser), so a file's
+    dd/mm vs mm/dd ambiguity is settled once per file.
+    """
+    formats = TIMESTAMP_FORMATS
+    for frame in frames:
+        processed = process_trips(frame, formats, ping_filter, distance_model)
+        inferred = processed.attrs['timestamp_parsing']['format']
+        if formats is TIMESTAMP_FORMATS and inferred in TIMESTAMP_FORMATS:
+            formats = [inferred]
+        yield processed
+
+def merge_timestamp_reports(reports):
+    """Combine the timestamp_parsing reports of several processed frames"""
+    formats = [report['format'] for report in reports if report['format']]
+    return {
+        'format': formats[0] if formats else None,
+        'parsed': sum(report['parsed'] for report in reports),
+        'rejected': sum(report['rejected'] for report in reports),
+        'empty': sum(report['empty'] for report in reports)
+    }
+
+def rewind(source):
+    """Seek a file object back to the start (paths need no rewinding)"""
+    if hasattr(source, 'seek'):
+        source.seek(0)
+
+def count_missing_trip_ids(count, row_counts=None):
+    """Count rows a reader dropped for lacking a trip_id, adding them to row_counts when given
+    
+    row_counts is a partial row report (see row_report) merged with those of
+    the processed frames.
+    """
+    if count:
+        ROWS_REJECTED.inc(count, reason='missing_trip_id')
+        if row_counts is not None:
+            for key in ['rows', 'missing_trip_id']:
+                row_counts[key] = row_counts.get(key, 0) + count
+
+def read_csv_chunks(source, chunk_rows=CSV_CHUNK_ROWS, row_counts=None):
+    """Read the streaming columns of a CSV in chunks with narrow dtypes
+    
+    Trip metadata columns are kept too when the file has them. Rows without
+    a trip_id are dropped (and counted in row_counts) and trip_id is cast to
+    int64. If a chunk has non-numeric coordinates, the rest of the file is
+    read with coordinates as text, which add_ping_metrics treats as invalid.
+    """
+    header = csv_upload_columns(source)
+    missing_columns = [col for col in STREAM_DTYPES if col not in header]
+    if missing_columns:
+        raise ValueError(f"Missing required columns: {missing_columns}")
+    
+    dtypes = KEPT_DTYPES
+    rows_read = 0
+    while True:
+        reader = pd.read_csv(source, usecols=lambda col: col in KEPT_DTYPES, dtype=dtypes, chunksize=chunk_rows,
+                             skiprows=range(1, rows_read + 1) if rows_read else None)
+        while True:
+            try:
+                chunk = next(reader)
+            except StopIteration:
+                return
+            except ValueError:
+                if dtypes is not KEPT_DTYPES:
+                    raise
+                # Start again from the failed chunk's first row
+                dtypes = {**KEPT_DTYPES, **{col: 'str' for col in COORDINATE_LIMITS}}
+                rewind(source)
+                break
+            rows = len(chunk)
+            rows_read += rows
+            chunk = chunk.dropna(subset=['trip_id'])
+            count_missing_trip_ids(rows - len(chunk), row_counts)
+            chunk['trip_id'] = chunk['trip_id'].astype('int64')
+            yield chunk
+
+def scan_csv_trips(source, chunk_rows=CSV_CHUNK_ROWS):
+    """Count the trips in a CSV and check each trip's rows are contiguous
+    
+    Only the trip_id column is read. Returns (trip_count, contiguous).
+    """
+    seen = set()
+    contiguous = True
+    last_trip_id = None
+    for chunk in pd.read_csv(source, usecols=['trip_id'], dtype={'trip_id': 'Int64'}, chunksize=chunk_rows):
+        trip_ids = chunk['trip_id'].dropna().astype('int64').to_numpy()
+        if len(trip_ids) == 0:
+            continue
+        run_ids = trip_ids[find_trip_starts(trip_ids)]
+        if run_ids[0] == last_trip_id:
+            run_ids = run_ids[1:]
+        for trip_id in run_ids.tolist():
+            if trip_id in seen:
+                contiguous = False
+            seen.add(trip_id)
+        last_trip_id = trip_ids[-1]
+    rewind(source)
+    return len(seen), contiguous
+
+def iter_csv_trip_frames(source, chunk_rows=CSV_CHUNK_ROWS, contiguous=None, row_counts=None):
+    """Yield frames of complete trips from a CSV with a trip_id column
+    
+    When every trip's rows are contiguous in the file, it is read in chunks and
+    the trip still open at the end of a chunk is carried into the next one, so
+    each trip is yielded once its last row has been read and peak memory
+    depends on the chunk size and the largest trip rather than the file size.
+    Otherwise the narrow columns of the whole file are yielded as one frame.
+    Rows without a trip_id are counted in row_counts (see read_csv_chunks).
+    """
+    if contiguous is None:
+        _, contiguous = scan_csv_trips(source, chunk_rows)
+    
+    if not contiguous:
+        print("Trip rows are not contiguous, reading the whole file at once")
+        yield pd.concat(read_csv_chunks(source, chunk_rows, row_counts), ignore_index=True)
+        return
+    
+    carry = None
+    for chunk in read_csv_chunks(source, chunk_rows, row_counts):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+        
+        # The last trip in the chunk may continue in the next one
+        trip_ids = chunk['trip_id'].to_numpy()
+        tail_start = find_trip_starts(trip_ids)[-1]
+        carry = chunk.iloc[tail_start:]
+        if tail_start > 0:
+            yield chunk.iloc[:tail_start]
+    
+    if carry is not None and len(carry):
+        yield carry
+
+def read_csv_trip(source, trip_id, chunk_rows=CSV_CHUNK_ROWS):
+    """Read a single trip's rows from a CSV in chunks"""
+    rows = [chunk[chunk['trip_id'] == trip_id] for chunk in read_csv_chunks(source, chunk_rows)]
+    return pd.concat(rows, ignore_index=True)
+
+def csv_upload_columns(source):
+    """Column names from the header row of a CSV file object or path"""
+    columns = list(pd.read_csv(source, nrows=0).columns)
+    rewind(source)
+    return columns
+
+def use_streaming(file):
+    """Whether an upload should be read in chunks instead of all at once
+    
+    file is an uploaded FileStorage or the path of a saved upload. Applies to
+    CSV uploads of at least STREAMING_MIN_BYTES that have every column the
+    chunked reader needs, including trip_id.
+    """
+    if isinstance(file, str):
+        filename, source = file, file
+        size = os.path.getsize(file)
+    else:
+        filename, source = file.filename, file.stream
+        source.seek(0, os.SEEK_END)
+        size = source.tell()
+        rewind(source)
+    
+    if not filename.endswith('.csv') or size < STREAMING_MIN_BYTES:
+        return False
+    
+    columns = csv_upload_columns(source)
+    return all(col in columns for col in STREAM_DTYPES)
+
+# Relationship type of the workbook part in an .xlsx package
+OFFICE_DOCUMENT_REL = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument'
+
+def excel_sheet_names(source):
+    """Worksheet names of an .xlsx file, read from the workbook part alone
+    
+    Only the package's relationships and xl/workbook.xml are parsed; no
+    worksheet or shared string is loaded.
+    """
+    with zipfile.ZipFile(source) as package:
+        workbook_path = 'xl/workbook.xml'
+        rels = ElementTree.fromstring(package.read('_rels/.rels'))
+        for rel in rels.iterfind('{*}Relationship'):
+            if rel.get('Type') == OFFICE_DOCUMENT_REL:
+                workbook_path = rel.get('Target').lstrip('/')
+        workbook = ElementTree.fromstring(package.read(workbook_path))
+        names = [sheet.get('name') for sheet in workbook.iterfind('{*}sheets/{*}sheet')]
+    rewind(source)
+    return names
+
+def open_excel_sheet(source, sheet_name=None):
+    """Open a worksheet in read-only mode; returns (workbook, sheet, header)
+    
+    The caller closes the workbook.
+    """
+    workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+        first_row = next(sheet.iter_rows(max_row=1, values_only=True), ())
+    except Exception:
+        workbook.close()
+        raise
+    # Blank header cells are named the way pd.read_excel names them
+    header = [f'Unnamed: {i}' if value is None else str(value) for i, value in enumerate(first_row)]
+    return workbook, sheet, header
+
+def excel_column(values, dtype):
+    """A streamed Excel column as a Series, narrowed like the CSV stream
+    
+    Coordinates become float32 unless a cell isn't numeric, in which case the
+    raw values are kept so add_ping_metrics can flag those rows. Blank cells
+    stay missing in text columns rather than becoming 'None' or 'nan'.
+    """
+    column = pd.Series(values)
+    if dtype == 'float32':
+        numeric = pd.to_numeric(column, errors='coerce')
+        if not (numeric.isna() & column.notna()).any():
+            column = numeric.astype('float32')
+    elif dtype == 'Int64':
+        column = pd.to_numeric(column).astype('Int64')
+    elif dtype == 'str':
+        column = column.where(column.isna(), column.astype(str))
+    return column
+
+def read_excel_columns(source, sheet_name=None, chunk_rows=CSV_CHUNK_ROWS, row_counts=None):
+    """Stream a worksheet in read-only mode, keeping only the STREAM_DTYPES columns
+    
+    Returns (header, frame) where header lists every column of the sheet and
+    frame holds the kept columns (and trip metadata columns) that are
+    present, with the narrow dtypes of read_csv_chunks (rows without a
+    trip_id are dropped when the sheet has one, and counted in row_counts).
+    Timestamp cells that Excel stored as dates stay datetimes. Rows are
+    converted chunk_rows at a time, so the whole sheet is never held as cells.
+    """
+    workbook, sheet, header = open_excel_sheet(source, sheet_name)
+    try:
+        positions = {col: header.index(col) for col in KEPT_DTYPES if col in header}
+        # Cells right of the last kept column are skipped without being built
+        rows = sheet.iter_rows(min_row=2, max_col=max(positions.values(), default=0) + 1, values_only=True)
+        chunks = []
+        while True:
+            batch = list(itertools.islice(rows, chunk_rows))
+            if not batch:
+                break
+            chunk = pd.DataFrame({
+                col: excel_column([row[i] if i < len(row) else None for row in batch], KEPT_DTYPES[col])
+                for col, i in positions.items()
+            })
+            # Read-only sheets can end in rows that are empty in every kept column
+            chunks.append(chunk.dropna(how='all'))
+    finally:
+        workbook.close()
+        rewind(source)
+    
+    if chunks:
+        frame = pd.concat(chunks, ignore_index=True)
+    else:
+        frame = pd.DataFrame({col: pd.Series(dtype='object') for col in positions})
+    if 'trip_id' in frame.columns:
+        rows = len(frame)
+        frame = frame.dropna(subset=['trip_id']).reset_index(drop=True)
+        count_missing_trip_ids(rows - len(frame), row_counts)
+        frame['trip_id'] = frame['trip_id'].astype('int64')
+    return header, frame
+
+def read_upload_sample(source, filename, sheet_name=None, sample_rows=UPLOAD_SAMPLE_ROWS):
+    """Header and first sample_rows data rows of a CSV or .xlsx upload
+    
+    Returns (columns, sample) where sample holds the STREAM_DTYPES columns
+    the file has, as raw text (CSV) or cell values (Excel), indexed by their
+    row number in the file with the header as row 1.
+    """
+    try:
+        if filename.endswith('.xlsx'):
+            workbook, sheet, columns = open_excel_sheet(source, sheet_name)
+            try:
+                positions = {col: columns.index(col) for col in STREAM_DTYPES if col in columns}
+                rows = list(sheet.iter_rows(min_row=2, max_row=sample_rows + 1,
+                                            max_col=max(positions.values(), default=0) + 1, values_only=True))
+            finally:
+                workbook.close()
+            sample = pd.DataFrame({
+                col: pd.Series([row[i] if i < len(row) else None for row in rows], dtype=object)
+                for col, i in positions.items()
+            }, index=pd.RangeIndex(2, len(rows) + 2))
+            # Read-only sheets can end in rows that are empty in every column
+            sample = sample.dropna(how='all')
+        else:
+            sample = pd.read_csv(source, nrows=sample_rows, dtype=str)
+            columns = list(sample.columns)
+            sample = sample[[col for col in STREAM_DTYPES if col in columns]]
+            sample.index = sample.index + 2
+    finally:
+        rewind(source)
+    return columns, sample
+
+def check_sample_column(name, values):
+    """Validation report of one sampled column
+    
+    Counts the sampled rows whose value is valid, empty or invalid (with a
+    few examples of the invalid ones): coordinates must be numbers within
+    COORDINATE_LIMITS, timestamps must parse and trip IDs must be integers.
+    The status is 'error' when more than UPLOAD_MAX_INVALID_SHARE of the
+    rows are empty or invalid, 'warning' when some are and 'ok' otherwise.
+    """
+    empty = blank_values(values)
+    details = {}
+    if name == 'device_timestamp':
+        parsed, timestamp_report = parse_timestamp_values(values)
+        invalid = parsed.isna().to_numpy() & ~empty
+        details['format'] = timestamp_report['format']
+    else:
+        numbers = pd.to_numeric(values.where(~empty), errors='coerce')
+        if name in COORDINATE_LIMITS:
+            out_of_range = (numbers.abs() > COORDINATE_LIMITS[name]).to_numpy()
+            invalid = (numbers.isna().to_numpy() & ~empty) | out_of_range
+            details['out_of_range'] = int(out_of_range.sum())
+        else:
+            invalid = (numbers.isna() | (numbers % 1 != 0)).to_numpy() & ~empty
+    
+    sampled = len(values)
+    bad = int(empty.sum() + invalid.sum())
+    report = {
+        'status': 'ok',
+        'sampled': sampled,
+        'valid': sampled - bad,
+        'empty': int(empty.sum()),
+        'invalid': int(invalid.sum()),
+        **details,
+        'examples': [{'row': int(row), 'value': str(value)}
+                     for row, value in values[invalid].head(UPLOAD_ERROR_EXAMPLES).items()]
+    }
+    if sampled and bad > UPLOAD_MAX_INVALID_SHARE * sampled:
+        report['status'] = 'error'
+        report['message'] = (f"{bad} of the first {sampled} rows are empty or invalid "
+                             f"({report['empty']} empty, {report['invalid']} invalid)")
+    elif bad:
+        report['status'] = 'warning'
+    return report
+
+@STAGE_SECONDS.timed(stage='validate')
+def validate_upload(source, filename, sheet_name=None):
+    """Check an upload's header and first rows before it is read in full
+    
+    Reads only the header row (or the sheet's first row) and the next
+    UPLOAD_SAMPLE_ROWS rows, so a file with the wrong columns or unusable
+    values is turned away in milliseconds whatever its size. Returns a
+    report with 'valid', the 'errors' that make it invalid, the required and
+    found columns, the number of sampled rows and a check_sample_column
+    report for each of latitude, longitude, device_timestamp and trip_id
+    (status 'missing' when a required column is absent). A trip_id column is
+    optional, but when present it is checked like the others.
+    """
+    report = {
+        'valid': False,
+        'errors': [],
+        'required_columns': REQUIRED_COLUMNS,
+        'found_columns': [],
+        'sampled_rows': 0,
+        'columns': {}
+    }
+    try:
+        columns, sample = read_upload_sample(source, filename, sheet_name)
+    except Exception as e:
+        report['errors'].append(f"Unreadable file: {str(e)}")
+        UPLOADS_REJECTED.inc(reason='unreadable')
+        return report
+    
+    report['found_columns'] = columns
+    report['sampled_rows'] = int(len(sample))
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in columns]
+    if missing_columns:
+        report['errors'].append(f"Missing required columns: {missing_columns}")
+    elif len(sample) == 0:
+        report['errors'].append("No data rows")
+    
+    for name in STREAM_DTYPES:
+        if name in sample.columns and len(sample):
+            column = check_sample_column(name, sample[name])
+            if column['status'] == 'error':
+                report['errors'].append(f"{name}: {column['message']}")
+            report['columns'][name] = column
+        elif name in missing_columns:
+            report['columns'][name] = {'status': 'missing'}
+    
+    report['valid'] = not report['errors']
+    if not report['valid']:
+        reason = 'missing_columns' if missing_columns else 'no_rows' if len(sample) == 0 else 'invalid_values'
+        UPLOADS_REJECTED.inc(reason=reason)
+    return report
+
+def validation_error(validation):
+    """400 response for an upload that failed validate_upload"""
+    return jsonify({
+        'error': '; '.join(validation['errors']),
+        'required_columns': validation['required_columns'],
+        'found_columns': validation['found_columns'],
+        'validation': validation
+    }), 400
+
+# Part of every cached PDF's key; bump it whenever the report layout changes
+REPORT_TEMPLATE_VERSION = 4
+
+def trip_pdf_filename(trip_id, trip_data):
+    """Cache filename for a trip's report: its ID plus a hash of its pings
+    
+    Only the columns the report is built from are hashed, in fixed dtypes, so
+    the same trip uploaded again (with extra columns, from Excel instead of
+    CSV or with another timestamp format) maps to the same file. Distances
+    are hashed too, as they depend on the distance model. The geofence file
+    is part of the key, since the report names matched sites.
+    """
+    geofences = geofence_index.digest if geofence_index is not None else ''
+    digest = hashlib.sha256(f"{REPORT_TEMPLATE_VERSION}:{geofences}:{trip_id}".encode())
+    digest.update(trip_data['parsed_timestamp'].to_numpy(dtype='datetime64[ns]').view('int64').tobytes())
+    for column in ['latitude', 'longitude', 'distance_km']:
+        values = pd.to_numeric(trip_data[column], errors='coerce')
+        digest.update(values.to_numpy(dtype='float64').tobytes())
+        # Non-numeric values are printed as uploaded, so their text is part of the key
+        invalid = values.isna() & trip_data[column].notna()
+        if invalid.any():
+            digest.update('\0'.join(trip_data[column][invalid].astype(str)).encode())
+    return f"trip_report_{trip_id}_{digest.hexdigest()[:32]}.pdf"
+
+# Report layout shared by every PDF (built once per process)
+LOGO_PATH = 'Freight Tiger Logo.webp'
+
+# Write PDF streams as plain binary instead of ASCII85 text. Without
+# ReportLab's C accelerator, ASCII85 runs in pure Python and encoding the
+# logo this way took most of a short report's render time
+rl_config.useA85 = 0
+
+HEADER_TABLE_COL_WIDTHS = [2.5*inch, 3*inch]
+
+PING_TABLE_HEADER = ["Updated At", "Latitude", "Longitude", "Distance (Km)", "Duration (Minutes)", "Avg Speed (Km/hr)"]
+PING_TABLE_COL_WIDTHS = [1.4*inch, 1.1*inch, 1.1*inch, 1.2*inch, 1.2*inch, 1*inch]
+PING_TABLE_STYLE = TableStyle([
+    # Header row styling - no background color
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 9),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('TOPPADDING', (0, 0), (-1, 0), 8),
+    
+    # Data rows styling - no background color
+    ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 1), (-1, -1), 8),
+    ('TOPPADDING', (0, 1), (-1, -1), 6),
+    ('BOTTOMPADDING', (0, 1), (-1, -1), 6),
+    
+    # Grid lines
+    ('GRID', (0, 0), (-1, -1), 1, colors.black)
+])
+
+# Stop sites named in the report header before the rest are summarized
+GEOFENCE_HEADER_MAX_SITES = 4
+
+# Table of trips at the front of a batch's merged PDF
+SUMMARY_TABLE_HEADER = ["Trip ID", "Pings", "Distance (Km)", "Running Time (Hrs)", "Avg Speed (Km/hr)", "Page"]
+SUMMARY_TABLE_COL_WIDTHS = [1.3*inch, 0.8*inch, 1.2*inch, 1.4*inch, 1.4*inch, 0.9*inch]
+
+# Trips with at least this many pings get the canvas-drawn ping table (all of them by default)
+FAST_TABLE_MIN_PINGS = int(os.environ.get('FAST_TABLE_MIN_PINGS', 0))
+
+report_template_instance = None
+
+def report_template():
+    """The report's static layers (logo, column layout), built once per process"""
+    global report_template_instance
+    if report_template_instance is None:
+        report_template_instance = ReportTemplate(LOGO_PATH, 2*inch, 0.8*inch, HEADER_TABLE_COL_WIDTHS,
+                                                  PING_TABLE_COL_WIDTHS, SUMMARY_TABLE_COL_WIDTHS)
+    return report_template_instance
+
+def report_logo():
+    """A copy of the report logo flowable, or None without a logo; the image is decoded once per process"""
+    logo = report_template().logo
+    return copy.copy(logo) if logo is not None else None
+
+def format_coordinates(values):
+    """Coordinates to 5 decimals, with non-numeric ones shown as uploaded"""
+    numeric = pd.to_numeric(values, errors='coerce')
+    text = np.char.mod('%.5f', numeric.to_numpy(dtype='float64'))
+    invalid = (numeric.isna() & values.notna()).to_numpy()
+    if invalid.any():
+        text = text.astype(object)
+        text[invalid] = values[invalid].astype(str).to_numpy()
+        text = text.astype(str)
+    return text
+
+def format_ping_rows(trip_data):
+    """Cell text of the ping table, as one string array per column"""
+    timestamps = trip_data['parsed_timestamp'].to_numpy(dtype='datetime64[s]')
+    durations = trip_data['duration_hours'].to_numpy(dtype='float64') * 60  # Convert hours to minutes
+    return [
+        np.char.replace(np.datetime_as_string(timestamps, unit='s'), 'T', ' '),
+        format_coordinates(trip_data['latitude']),
+        format_coordinates(trip_data['longitude']),
+        np.char.mod('%.2f', trip_data['distance_km'].to_numpy()),
+        durations.astype(np.int64).astype(str),
+        np.char.mod('%.0f', trip_data['speed_kmh'].to_numpy())  # No decimal places for speed
+    ]
+
+class HeaderBlock(Flowable):
+    """The report header's label and value rows drawn straight onto the canvas
+    
+    Labels (10pt Helvetica-Bold) and values (10pt Helvetica) are placed
+    where a left-aligned, top-aligned platypus Table with
+    HEADER_TABLE_COL_WIDTHS columns and default padding would put them, so
+    only the trip's values are laid out per report.
+    """
+    ROW_HEIGHT = 18  # 12pt leading + 3pt top and bottom padding
+    PADDING = 6      # Left cell padding
+    BASELINE = 5     # Row height - top padding - font size
+    
+    def __init__(self, rows):
+        Flowable.__init__(self)
+        self.rows = rows
+        self.hAlign = 'CENTER'
+        self.template = report_template()
+    
+    def wrap(self, availWidth, availHeight):
+        self.width = self.template.header_table_width
+        self.height = len(self.rows) * self.ROW_HEIGHT
+        return self.width, self.height
+    
+    def draw(self):
+        canv = self.canv
+        canv.saveState()
+        for column, font in enumerate(['Helvetica-Bold', 'Helvetica']):
+            canv.setFont(font, 10, 12)
+            x = self.template.header_col_positions[column] + self.PADDING
+            for i, row in enumerate(self.rows, start=1):
+                if row[column]:
+                    canv.drawString(x, self.height - i * self.ROW_HEIGHT + self.BASELINE, row[column])
+        canv.restoreState()
+
+class PingTable(Flowable):
+    """The ping table drawn straight onto the canvas
+    
+    Draws the same cells and grid as a platypus Table styled with
+    PING_TABLE_STYLE, but splits across pages by slicing the preformatted
+    column arrays, so long trips render in time linear in their ping count.
+    """
+    HEADER_HEIGHT = 32  # 12pt leading + 8pt top and 12pt bottom padding
+    ROW_HEIGHT = 24     # 12pt leading + 6pt top and bottom padding
+    
+    LABELS = PING_TABLE_HEADER
+    
+    def __init__(self, columns, start=0, stop=None, header=True):
+        Flowable.__init__(self)
+        self.columns = columns
+        self.start = start
+        self.stop = len(columns[0]) if stop is None else stop
+        self.header = header
+        self.hAlign = 'CENTER'
+        self.template = report_template()
+    
+    def _header_height(self):
+        return self.HEADER_HEIGHT if self.header else 0
+    
+    def layout(self):
+        """Column edges, column centres and width, from the report template"""
+        return self.template.ping_col_positions, self.template.ping_col_centers, self.template.ping_table_width
+    
+    def wrap(self, availWidth, availHeight):
+        self.width = self.layout()[2]
+        self.height = self._header_height() + (self.stop - self.start) * self.ROW_HEIGHT
+        return self.width, self.height
+    
+    def split(self, availWidth, availHeight):
+        rows = int((availHeight - self._header_height()) // self.ROW_HEIGHT)
+        if rows <= 0:
+            return []
+        if rows >= self.stop - self.start:
+            return [self]
+        middle = self.start + rows
+        return [
+            type(self)(self.columns, self.start, middle, self.header),
+            type(self)(self.columns, middle, self.stop, header=False)
+        ]
     
-    return df
+    def draw(self):
+        canv = self.canv
+        canv.saveState()
+        
+        col_positions, centers, _ = self.layout()
+        
+        # Row boundaries from the top of the table down
+        top = self.height
+        row_positions = [top]
+        if self.header:
+            row_positions.append(top - self.HEADER_HEIGHT)
+            canv.setFont('Helvetica-Bold', 9, 12)
+            baseline = row_positions[-1] + 15  # bottom padding + leading - font size
+            for x, text in zip(centers, self.LABELS):
+                canv.drawCentredString(x, baseline, text)
+        
+        canv.setFont('Helvetica', 8, 12)
+        body_top = row_positions[-1]
+        rows = zip(*(column[self.start:self.stop].tolist() for column in self.columns))
+        for i, row in enumerate(rows, start=1):
+            baseline = body_top - i * self.ROW_HEIGHT + 10
+            for x, text in zip(centers, row):
+                canv.drawCentredString(x, baseline, text)
+        row_positions.extend(body_top - i * self.ROW_HEIGHT for i in range(1, self.stop - self.start + 1))
+        
+        # Grid lines, as drawn for ('GRID', ..., 1, colors.black)
+        canv.setStrokeColor(colors.black)
+        canv.setLineWidth(1)
+        canv.setLineCap(1)
+        canv.setLineJoin(1)
+        bottom = row_positions[-1]
+        lines = [(0, y, self.width, y) for y in row_positions]
+        lines.extend((x, bottom, x, top) for x in col_positions)
+        canv.lines(lines)
+        
+        canv.restoreState()
+
+class SummaryTable(PingTable):
+    """The trip table at the front of a batch's merged PDF, drawn like the ping table"""
+    LABELS = SUMMARY_TABLE_HEADER
+    
+    def layout(self):
+        return (self.template.summary_col_positions, self.template.summary_col_centers,
+                self.template.summary_table_width)
 
 def generate_pdf_report(trip_data, trip_id):
     """Generate PDF report for a trip"""
@@ -194,17 +1850,11 @@ def generate_pdf_report(trip_data, trip_id):
     )
     story = []
     
-    styles = getSampleStyleSheet()
-    
     # Header section with logo on top left (no text)
-    if os.path.exists('Freight Tiger Logo.webp'):
-        try:
-            logo = Image('Freight Tiger Logo.webp', width=2*inch, height=0.8*inch)
-            logo.hAlign = 'LEFT'
-            story.append(logo)
-            story.append(Spacer(1, 20))
-        except:
-            pass
+    logo = report_logo()
+    if logo is not None:
+        story.append(logo)
+        story.append(Spacer(1, 20))
     
     # Trip information header
     try:
@@ -213,18 +1863,23 @@ def generate_pdf_report(trip_data, trip_id):
     except IndexError:
         raise ValueError("Cannot access trip data rows")
     
-    # Header info - removed stoppage time, origin, destination
     report_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
-    # Safe calculations with error handling
+    # Safe calculations with error handling; speed and running time leave out stops
+    sites = None
     try:
-        avg_speed = float(trip_data['speed_kmh'].mean())
+        stopped, stops = detect_stops(trip_data, trip_starts=[0])
+        sites = match_trip_sites(trip_data, stops, [0])
+        totals = movement_totals(trip_data, stopped)
+        avg_speed = totals['moving_avg_speed']
         total_distance = float(trip_data['distance_km'].sum())
-        total_duration = float(trip_data['duration_hours'].sum())
+        running_time = totals['running_time']
+        stoppage_time = totals['stoppage_time']
     except (KeyError, ValueError, TypeError):
         avg_speed = 0.0
         total_distance = 0.0
-        total_duration = 0.0
+        running_time = 0.0
+        stoppage_time = 0.0
     
     header_data = [
         ["Report Generation Timestamp", report_time],
@@ -235,58 +1890,37 @@ def generate_pdf_report(trip_data, trip_id):
         ["", ""],
         ["Average Speed:", f"{avg_speed:.2f} KM/Hr"],
         ["Distance Covered:", f"{total_distance:.2f} KM"],
-        ["Running Time:", f"{total_duration:.2f} Hrs"]
+        ["Running Time:", f"{running_time:.2f} Hrs"],
+        ["Stoppage Time:", f"{stoppage_time:.2f} Hrs"]
     ]
     
-    header_table = Table(header_data, colWidths=[2.5*inch, 3*inch])
-    header_table.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),  # Bold the first column (headings)
-        ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),       # Regular font for values
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-    ]))
+    # Origin, destination and stop sites, when geofences are configured
+    if sites is not None:
+        origin = geofence_index.site(sites[0][0])
+        destination = geofence_index.site(sites[1][0])
+        stop_sites = site_names(sites[2])
+        if len(stop_sites) > GEOFENCE_HEADER_MAX_SITES:
+            stop_sites = stop_sites[:GEOFENCE_HEADER_MAX_SITES] + [f"and {len(stop_sites) - GEOFENCE_HEADER_MAX_SITES} more"]
+        header_data += [
+            ["", ""],
+            ["Origin:", origin['name'] if origin else "-"],
+            ["Destination:", destination['name'] if destination else "-"],
+            ["Stopped At:", ", ".join(stop_sites) or "-"]
+        ]
     
-    story.append(header_table)
+    story.append(HeaderBlock(header_data))
     story.append(Spacer(1, 20))
     
     # Trip details table - removed device label and address columns
-    table_data = [
-        ["Updated At", "Latitude", "Longitude", "Distance (Km)", "Duration (Minutes)", "Avg Speed (Km/hr)"]
-    ]
-    
-    for i, row in trip_data.iterrows():
-        duration_minutes = int(row['duration_hours'] * 60)  # Convert hours to minutes
-        table_data.append([
-            row['parsed_timestamp'].strftime("%Y-%m-%d %H:%M:%S"),
-            f"{row['latitude']:.5f}",
-            f"{row['longitude']:.5f}",
-            f"{row['distance_km']:.2f}",
-            str(duration_minutes),
-            f"{row['speed_kmh']:.0f}"  # No decimal places for speed
-        ])
-    
-    # Create table with increased column widths for Distance and Duration
-    table = Table(table_data, colWidths=[1.4*inch, 1.1*inch, 1.1*inch, 1.2*inch, 1.2*inch, 1*inch])
-    table.setStyle(TableStyle([
-        # Header row styling - no background color
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 9),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('TOPPADDING', (0, 0), (-1, 0), 8),
-        
-        # Data rows styling - no background color
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -1), 8),
-        ('TOPPADDING', (0, 1), (-1, -1), 6),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 6),
-        
-        # Grid lines
-        ('GRID', (0, 0), (-1, -1), 1, colors.black)
-    ]))
-    
-    story.append(table)
+    columns = format_ping_rows(trip_data)
+    if len(trip_data) >= FAST_TABLE_MIN_PINGS:
+        # Long trips: draw the rows page by page instead of laying out one huge Table
+        story.append(PingTable(columns))
+    else:
+        table_data = [PING_TABLE_HEADER] + [list(row) for row in zip(*(column.tolist() for column in columns))]
+        table = Table(table_data, colWidths=PING_TABLE_COL_WIDTHS)
+        table.setStyle(PING_TABLE_STYLE)
+        story.append(table)
     
     # Build PDF
     doc.build(story)
@@ -294,104 +1928,585 @@ def generate_pdf_report(trip_data, trip_id):
     
     return buffer.getvalue()
 
-def generate_batch_pdfs(batch_id, df):
-    """Generate PDFs for multiple trips in background"""
+def generate_batch_summary_pdf(batch_id, trips, first_page):
+    """Render the summary that opens a batch's merged PDF
+    
+    trips are the batch's trips in section order: completed ones as listed
+    under pdfs in the batch status, plus page (the section's first page
+    counted from 0 after the summary, None when it has no section) and
+    status (the page cell's text for trips without a section). first_page
+    is the page number of the first section, i.e. the summary's page count
+    plus one. Returns the PDF and its page count.
+    """
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=letter,
+        rightMargin=30,
+        leftMargin=30,
+        topMargin=30,
+        bottomMargin=30
+    )
+    story = []
+    
+    logo = report_logo()
+    if logo is not None:
+        story.append(logo)
+        story.append(Spacer(1, 20))
+    
+    included = [trip for trip in trips if trip['page'] is not None]
+    story.append(HeaderBlock([
+        ["Report Generation Timestamp", datetime.now().strftime("%Y-%m-%d %H:%M:%S")],
+        ["", ""],
+        ["Batch ID:", str(batch_id)],
+        ["Trips:", str(len(trips))],
+        ["Reports Included:", str(len(included))],
+        ["", ""],
+        ["Distance Covered:", f"{sum(trip['total_distance'] for trip in included):.2f} KM"]
+    ]))
+    story.append(Spacer(1, 20))
+    
+    # Speeds leave out stops, as in each trip's report (entries stored before
+    # running times were listed fall back to the per-ping average)
+    rows = [
+        [str(trip['trip_id']), str(trip['ping_count']), f"{trip['total_distance']:.2f}",
+         f"{trip['running_time']:.2f}" if trip.get('running_time') is not None else "-",
+         f"{trip['moving_avg_speed'] if trip.get('moving_avg_speed') is not None else trip['avg_speed']:.2f}",
+         str(first_page + trip['page'])]
+        if trip['page'] is not None else [str(trip['trip_id']), "-", "-", "-", "-", trip['status']]
+        for trip in trips
+    ]
+    story.append(SummaryTable([np.array(column, dtype=str) for column in zip(*rows)] if rows
+                              else [np.array([], dtype=str)] * len(SUMMARY_TABLE_HEADER)))
+    
+    doc.build(story)
+    return buffer.getvalue(), doc.page
+
+def render_trip_pdf(trip_id, trip_data, filename):
+    """Render one processed trip into the PDF cache
+    
+    Returns the seconds spent in the render and write stages, for the caller
+    to record (a pool worker's own metrics never reach /metrics).
+    """
+    start = time.perf_counter()
+    pdf = generate_pdf_report(trip_data, trip_id)
+    rendered = time.perf_counter()
+    pdf_cache.put(filename, pdf)
+    return {'render': rendered - start, 'write': time.perf_counter() - rendered}
+
+def render_trip_task(trip_id, payload_path, filename):
+    """Render a queued trip from the processed data saved at ingestion"""
+    start = time.perf_counter()
+    trip_data = pd.read_pickle(payload_path)
+    return {'read': time.perf_counter() - start, **render_trip_pdf(trip_id, trip_data, filename)}
+
+def record_render(timings, source):
+    """Record the stage timings of one rendered trip PDF"""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    TRIP_SECONDS.observe(sum(timings.values()), source=source)
+    PDFS_GENERATED.inc(source=source)
+
+def create_render_pool(workers):
+    """Process pool for rendering batch PDFs
+    
+    Workers are started by a fork server where the platform has one (spawned
+    otherwise) rather than forked from this process, whose request and batch
+    threads may hold locks at fork time. Each worker imports app.py once,
+    skipping the startup tasks and batch thread (see RENDER_PROCESS), and
+    builds the report template before taking its first trip.
+    """
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method),
+                               initializer=report_template)
+
+def batch_folder(batch_id):
+    """Directory holding a batch's saved upload and per-trip payloads"""
+    return os.path.join(BATCH_FOLDER, batch_id)
+
+def save_batch_options(batch_id, options):
+    """Save a batch's processing options next to its upload for the ingesting worker"""
+    with open(os.path.join(batch_folder(batch_id), 'options.json'), 'w') as f:
+        json.dump(options, f)
+
+def load_batch_options(batch_id):
+    """Processing options saved with a batch (empty for batches queued without any)"""
     try:
-        # Initialize batch job status
-        batch_jobs[batch_id] = {
-            'status': 'processing',
-            'total_trips': 0,
-            'completed_trips': 0,
-            'pdfs': [],
-            'error': None
-        }
+        with open(os.path.join(batch_folder(batch_id), 'options.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_batch_row_report(batch_id, report):
+    """Save the row report of a batch's ingested upload, for batch-status"""
+    with open(os.path.join(batch_folder(batch_id), 'row_report.json'), 'w') as f:
+        json.dump(report, f)
+
+def load_batch_row_report(batch_id):
+    """Row report of a batch's upload (None until it is ingested, and for stored uploads)"""
+    try:
+        with open(os.path.join(batch_folder(batch_id), 'row_report.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def load_batch_frames(source_path, worksheet_name=None, ping_filter=None, distance_model=None, row_counts=None):
+    """Return (trip_count, processed frames) for a saved batch upload
+    
+    Stored uploads are already processed and are read in chunks of complete
+    trips, as are large CSV uploads; anything else is read whole and
+    processed in one pass. ping_filter and distance_model are applied to
+    every frame. Rows the reader drops for lacking a trip_id are counted in
+    row_counts.
+    """
+    if source_path.endswith(UploadStore.DATA_FILE):
+        upload_id = os.path.basename(os.path.dirname(source_path))
+        index = upload_store.index(upload_id)
+        if index is None:
+            raise ValueError('Upload not found (it may have expired)')
+        frames = STAGE_SECONDS.time_iter(upload_store.iter_frames(upload_id, CSV_CHUNK_ROWS), stage='read')
+        return len(index['trips']), (refilter_processed(frame, ping_filter, distance_model) for frame in frames)
+    
+    if use_streaming(source_path):
+        with STAGE_SECONDS.time(stage='read'):
+            trip_count, contiguous = scan_csv_trips(source_path)
+        frames = STAGE_SECONDS.time_iter(
+            iter_csv_trip_frames(source_path, contiguous=contiguous, row_counts=row_counts), stage='read')
+        return trip_count, process_trip_frames(frames, ping_filter, distance_model)
+    
+    with STAGE_SECONDS.time(stage='read'):
+        if source_path.endswith('.xlsx'):
+            _, df = read_excel_columns(source_path, worksheet_name, row_counts=row_counts)
+        else:
+            df = pd.read_csv(source_path)
+    
+    if 'trip_id' not in df.columns:
+        return 0, []
+    processed = process_trips(df, ping_filter=ping_filter, distance_model=distance_model)
+    return int(df['trip_id'].nunique()), [processed]  # Convert to native Python int
+
+def ingest_batch(batch):
+    """Split a claimed batch upload into queued per-trip render tasks
+    
+    Each trip's processed data is pickled next to the upload so that any
+    worker process can render it, including after a restart.
+    """
+    batch_id = batch['batch_id']
+    options = load_batch_options(batch_id)
+    reader_counts = {}
+    trip_count, frames = load_batch_frames(batch['source_path'], batch['worksheet_name'],
+                                           options.get('ping_filter'), options.get('distance_model'),
+                                           row_counts=reader_counts)
+    job_store.set_total_trips(batch_id, trip_count)
+    
+    row_reports = []
+    for processed in frames:
+        # Stop early if the batch was cancelled while its upload was being read
+        if job_store.batch_status(batch_id) != 'processing':
+            print(f"Batch {batch_id} stopped during ingestion")
+            return
         
-        # Group by trip_id
-        if 'trip_id' in df.columns:
-            trip_ids = df['trip_id'].unique()
-            batch_jobs[batch_id]['total_trips'] = int(len(trip_ids))  # Convert to native Python int
+        reports = summarize_trips(processed)
+        row_reports.append(processed.attrs.get('row_report'))
+        # Stored uploads were added to the fleet store (and counted) when they were uploaded
+        if not batch['source_path'].endswith(UploadStore.DATA_FILE):
+            record_fleet_days(processed, reports, f"batch:{batch_id}")
+        summaries = {report['trip_id']: report for report in reports}
+        trips = []
+        for trip_id, trip_data in iter_trips(processed):
+            payload_path = os.path.join(batch_folder(batch_id), f"{trip_id}.pkl")
+            with STAGE_SECONDS.time(stage='write'):
+                trip_data.to_pickle(payload_path)
+            trips.append({
+                'trip_id': int(trip_id),
+                'filename': trip_pdf_filename(trip_id, trip_data),
+                'payload_path': payload_path,
+                'summary': summaries[int(trip_id)]
+            })
+        job_store.add_trips(batch_id, trips, TRIP_LEASE_SECONDS)
+    
+    row_report = merge_row_reports(row_reports + [reader_counts])
+    if row_report:
+        save_batch_row_report(batch_id, row_report)
+    job_store.finish_ingestion(batch_id, trip_count)
+    
+    # The batch's copy of the upload is no longer needed once every trip has
+    # its own payload (stored uploads are left for other requests)
+    if os.path.dirname(batch['source_path']) == batch_folder(batch_id) and os.path.exists(batch['source_path']):
+        os.remove(batch['source_path'])
+    print(f"Batch {batch_id} queued: {trip_count} trips")
+
+def settle_trip(task, error=None, cached=False, timings=None):
+    """Record the outcome of a rendered trip task in the job store
+    
+    timings are the stage timings render_trip_task returned for the trip.
+    """
+    if timings:
+        record_render(timings, 'batch')
+    if error is None:
+        job_store.complete_trip(task['id'])
+        status = 'completed'
+        source = 'Served cached' if cached else 'Generated'
+        print(f"{source} PDF for trip {task['trip_id']} (batch {task['batch_id']})")
+    else:
+        status = job_store.fail_trip(task['id'], str(error), MAX_TRIP_ATTEMPTS)
+        print(f"Error processing trip {task['trip_id']} (attempt {task['attempts']}): {str(error)}")
+    
+    # Keep the payload while the trip may still be retried
+    if status in ('completed', 'failed') and os.path.exists(task['payload_path']):
+        os.remove(task['payload_path'])
+
+def run_batch_worker(workers=None, stop_event=None, until_idle=False):
+    """Claim queued batch work from the job store and process it
+    
+    Ingestion runs on the calling thread. Trips are rendered on it too with a
+    single worker, or in a bounded process pool with up to two trips per
+    worker in flight. Leases of in-flight trips are renewed while they render;
+    trips lost to a crashed worker process are requeued by the store's retry
+    logic. With until_idle the loop returns once there is nothing to claim.
+    """
+    workers = workers or BATCH_WORKERS
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+    pool = create_render_pool(workers) if workers > 1 else None
+    pool_broken = False
+    pending = {}
+    isolated = None
+    last_purge = 0
+    
+    try:
+        while not (stop_event and stop_event.is_set()):
+            if time.time() - last_purge > WORKER_PURGE_SECONDS:
+                purge_expired_batches()
+                upload_store.purge(UPLOAD_RETENTION_SECONDS)
+                live_trip_store.purge(LIVE_TRIP_RETENTION_SECONDS)
+                pdf_cache.maybe_evict()
+                last_purge = time.time()
             
-            for i, trip_id in enumerate(trip_ids):
+            batch = job_store.claim_ingestion(worker_id, TRIP_LEASE_SECONDS, MAX_TRIP_ATTEMPTS)
+            if batch is not None:
                 try:
-                    trip_data = df[df['trip_id'] == trip_id]
-                    
-                    # Enhanced validation before processing
-                    if len(trip_data) < 2:
-                        print(f"Skipping trip {trip_id}: insufficient data (only {len(trip_data)} pings)")
+                    ingest_batch(batch)
+                except Exception as e:
+                    print(f"Batch processing error: {str(e)}")
+                    job_store.fail_batch(batch['batch_id'], str(e))
+                continue
+            
+            if pool_broken:
+                # A crashed worker takes the whole pool and its in-flight trips down with it
+                for task in pending.values():
+                    settle_trip(task, BrokenProcessPool('Render worker stopped unexpectedly'))
+                pending.clear()
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = create_render_pool(workers)
+                pool_broken = False
+            
+            # Keep the pool fed without claiming more than it can start soon.
+            # Retried trips run on their own so a trip that keeps crashing its
+            # worker doesn't take other trips' attempts down with it.
+            task = None
+            while len(pending) < max(1, workers * 2):
+                if isolated is not None:
+                    if pending:
+                        break
+                    task, isolated = isolated, None
+                else:
+                    task = job_store.claim_trip(worker_id, TRIP_LEASE_SECONDS, MAX_TRIP_ATTEMPTS)
+                    if task is None:
+                        break
+                    if pdf_cache.get(task['filename']):
+                        settle_trip(task, cached=True)
                         continue
-                    
-                    # Check for required columns
-                    required_columns = ['latitude', 'longitude', 'device_timestamp']
-                    missing_columns = [col for col in required_columns if col not in trip_data.columns]
-                    if missing_columns:
-                        print(f"Skipping trip {trip_id}: missing columns {missing_columns}")
+                    if pool is not None and task['attempts'] > 1:
+                        isolated = task
                         continue
-                    
-                    # Process the trip data
-                    processed_data = process_trip_data(trip_data)
-                    
-                    # Generate PDF
-                    pdf_content = generate_pdf_report(processed_data, trip_id)
-                    filename = f"trip_report_{trip_id}_{batch_id}.pdf"
-                    
-                    # Save PDF to the correct directory
-                    pdf_path = os.path.join(PDF_FOLDER, filename)
-                    with open(pdf_path, 'wb') as f:
-                        f.write(pdf_content)
-                    
-                    # Update batch status
-                    batch_jobs[batch_id]['completed_trips'] += 1
-                    batch_jobs[batch_id]['pdfs'].append({
-                        'filename': filename,
-                        'trip_id': int(trip_id),
-                        'ping_count': int(len(processed_data)),
-                        'total_distance': float(processed_data['distance_km'].sum()),
-                        'avg_speed': float(processed_data['speed_kmh'].mean())
-                    })
-                    
-                    print(f"Generated PDF for trip {trip_id} ({i+1}/{len(trip_ids)})")
-                    
-                except Exception as e:
-                    print(f"Error processing trip {trip_id}: {str(e)}")
+                if pool is None:
+                    try:
+                        timings = render_trip_task(task['trip_id'], task['payload_path'], task['filename'])
+                        settle_trip(task, timings=timings)
+                    except Exception as e:
+                        settle_trip(task, e)
                     continue
-        
-        # Mark batch as completed
-        batch_jobs[batch_id]['status'] = 'completed'
-        print(f"Batch {batch_id} completed: {batch_jobs[batch_id]['completed_trips']} PDFs generated")
-        
-        # Schedule cleanup after 1 hour (files in /tmp are temporary)
-        cleanup_thread = threading.Timer(3600, cleanup_old_files, args=[batch_id])
-        cleanup_thread.daemon = True
-        cleanup_thread.start()
-        
-    except Exception as e:
-        print(f"Batch processing error: {str(e)}")
-        batch_jobs[batch_id]['status'] = 'error'
-        batch_jobs[batch_id]['error'] = str(e)
+                try:
+                    future = pool.submit(render_trip_task, task['trip_id'], task['payload_path'], task['filename'])
+                except BrokenProcessPool as e:
+                    settle_trip(task, e)
+                    pool_broken = True
+                    break
+                pending[future] = task
+                if task['attempts'] > 1:
+                    break
+            
+            if not pending:
+                if until_idle and task is None and not pool_broken:
+                    break
+                if stop_event:
+                    stop_event.wait(WORKER_POLL_SECONDS)
+                elif not pool_broken:
+                    time.sleep(WORKER_POLL_SECONDS)
+                continue
+            
+            done, _ = wait(pending, timeout=WORKER_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                pool_broken = pool_broken or isinstance(error, BrokenProcessPool)
+                settle_trip(pending.pop(future), error, timings=None if error else future.result())
+            held = list(pending.values()) + ([isolated] if isolated else [])
+            job_store.renew_leases([task['id'] for task in held], TRIP_LEASE_SECONDS)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+def start_batch_worker():
+    """Start this process's background batch worker thread (once)"""
+    global batch_worker_thread
+    if not BATCH_WORKER_THREAD:
+        return
+    if batch_worker_thread is None or not batch_worker_thread.is_alive():
+        batch_worker_thread = threading.Thread(target=run_batch_worker, daemon=True)
+        batch_worker_thread.start()
 
 def cleanup_old_files(batch_id):
-    """Clean up old PDF files and batch job data"""
+    """Clean up batch job data
+    
+    The batch's PDFs stay in the cache (other batches may share them), but
+    are no longer pinned, so they can be evicted.
+    """
     try:
-        # Clean up batch job data
-        if batch_id in batch_jobs:
-            batch_data = batch_jobs[batch_id]
-            
-            # Remove PDF files from temp directory
-            if 'pdfs' in batch_data:
-                for pdf_info in batch_data['pdfs']:
-                    filename = pdf_info['filename']
-                    filepath = os.path.join(PDF_FOLDER, filename)
-                    if os.path.exists(filepath):
-                        os.remove(filepath)
-                        print(f"Cleaned up file: {filename}")
-            
-            # Remove batch job data
-            del batch_jobs[batch_id]
-            print(f"Cleaned up batch job: {batch_id}")
+        job_store.delete_batch(batch_id)
+        
+        # Remove the saved upload and any payloads left behind
+        shutil.rmtree(batch_folder(batch_id), ignore_errors=True)
+        print(f"Cleaned up batch job: {batch_id}")
             
     except Exception as e:
         print(f"Error during cleanup: {str(e)}")
 
+def purge_expired_batches():
+    """Clean up batches that finished more than BATCH_RETENTION_SECONDS ago"""
+    for batch_id in job_store.expired_batches(time.time() - BATCH_RETENTION_SECONDS):
+        cleanup_old_files(batch_id)
+
+# Bytes read from a PDF between flushes of the batch ZIP stream
+ZIP_CHUNK_BYTES = 64 * 1024
+
+class StreamBuffer:
+    """Write-only file object that holds ZIP or PDF output until it is drained
+    
+    It has no tell() or seek(), so zipfile writes entries in streaming mode
+    (sizes and CRCs follow each entry's data).
+    """
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_batch_zip(batch_id):
+    """Yield a ZIP of a batch's PDFs, following the batch until it finishes
+    
+    PDFs are added as they complete, so a download started while the batch is
+    still rendering ends once the last trip is settled. Each poll only reads
+    the trips completed since the last one. Only one chunk of one PDF is held
+    in memory at a time. Trips whose PDF is no longer in the cache are listed
+    in a MISSING.txt entry at the end.
+    """
+    buffer = StreamBuffer()
+    offset = 0
+    missing = []
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        while True:
+            job = job_store.get_batch(batch_id, offset=offset)
+            if job is None:
+                break
+            finished = job['status'] != 'processing'
+            offset += len(job['pdfs'])
+            
+            for pdf in job['pdfs']:
+                pdf_path = pdf_cache.path(pdf['filename'])
+                if not pdf_cache.touch(pdf['filename']):
+                    print(f"Skipping evicted PDF {pdf['filename']} in batch {batch_id} download")
+                    missing.append(pdf)
+                    continue
+                
+                entry = zipfile.ZipInfo(f"trip_report_{pdf['trip_id']}.pdf", time.localtime()[:6])
+                size = os.path.getsize(pdf_path)
+                with open(pdf_path, 'rb') as src, archive.open(entry, 'w', force_zip64=size >= zipfile.ZIP64_LIMIT) as dest:
+                    for chunk in iter(lambda: src.read(ZIP_CHUNK_BYTES), b''):
+                        dest.write(chunk)
+                        yield buffer.drain()
+                yield buffer.drain()
+            
+            if finished:
+                break
+            time.sleep(WORKER_POLL_SECONDS)
+        
+        if missing:
+            lines = ['These trips were completed but their PDFs are no longer available.',
+                     'Generate them again to download them.', '']
+            lines += [f"trip_report_{pdf['trip_id']}.pdf ({pdf['filename']})" for pdf in missing]
+            archive.writestr('MISSING.txt', '\n'.join(lines) + '\n')
+    
+    # Central directory
+    yield buffer.drain()
+
+def stream_batch_pdf(batch_id):
+    """Yield one merged PDF of a batch's reports, following the batch until it finishes
+    
+    Each completed trip's cached PDF becomes a section with its own outline
+    entry, appended in completion order and written out as soon as it is
+    available, so only one trip's PDF is held in memory at a time. Once the
+    batch is settled, a summary of every trip with the page its section
+    starts on is rendered and placed in front of the sections.
+    """
+    buffer = StreamBuffer()
+    merger = PDFMerger(buffer, title=f"Trip reports for batch {batch_id}")
+    trips = []
+    failed_trips = []
+    offset = 0
+    while True:
+        job = job_store.get_batch(batch_id, offset=offset)
+        if job is None:
+            break
+        finished = job['status'] != 'processing'
+        offset += len(job['pdfs'])
+        failed_trips = job['failed_trips']
+        
+        for pdf in job['pdfs']:
+            trip = {**pdf, 'page': None, 'status': 'Unavailable'}
+            trips.append(trip)
+            first_page = merger.page_count
+            try:
+                pdf_cache.touch(pdf['filename'])
+                merger.add_file(pdf_cache.path(pdf['filename']), f"Trip {pdf['trip_id']}")
+            except FileNotFoundError:
+                print(f"Skipping evicted PDF {pdf['filename']} in batch {batch_id} merged PDF")
+                continue
+            trip['page'] = first_page
+            yield buffer.drain()
+        
+        if finished:
+            break
+        time.sleep(WORKER_POLL_SECONDS)
+    
+    trips.extend({'trip_id': trip['trip_id'], 'page': None, 'status': 'Failed'} for trip in failed_trips)
+    
+    # Page numbers in the summary depend on its own length, which only changes
+    # if the first guess was wrong
+    summary_pages = 1
+    while True:
+        summary, pages = generate_batch_summary_pdf(batch_id, trips, summary_pages + 1)
+        if pages == summary_pages:
+            break
+        summary_pages = pages
+    merger.add(summary, 'Summary', front=True)
+    merger.close()
+    yield buffer.drain()
+
+# How often an SSE stream checks for new batch events, and how long it may
+# stay quiet before sending a keep-alive comment
+EVENT_POLL_SECONDS = 0.5
+EVENT_KEEPALIVE_SECONDS = 15
+
+def format_sse(event):
+    """One batch event in text/event-stream framing"""
+    return f"id: {event['id']}\nevent: {event['type']}\ndata: {json.dumps(event['data'])}\n\n"
+
+def stream_batch_events(batch_id, last_event_id=0):
+    """Yield a batch's events after last_event_id until the batch is done"""
+    yield f"retry: {int(WORKER_POLL_SECONDS * 1000)}\n\n"
+    last_sent = time.time()
+    while True:
+        events = job_store.batch_events(batch_id, last_event_id)
+        for event in events:
+            yield format_sse(event)
+            last_event_id = event['id']
+            if event['type'] == 'batch_done':
+                return
+        if events:
+            last_sent = time.time()
+            continue
+        
+        # A batch purged while being watched has no batch_done left to send
+        if job_store.batch_status(batch_id) is None:
+            return
+        if time.time() - last_sent >= EVENT_KEEPALIVE_SECONDS:
+            yield ": keep-alive\n\n"
+            last_sent = time.time()
+        time.sleep(EVENT_POLL_SECONDS)
+
+@app.before_request
+def start_request_timing():
+    """Start timing the request, and profiling it when asked to"""
+    g.request_start = time.perf_counter()
+    g.profiler = None
+    if PROFILE_REQUESTS and (request.args.get('profile') == '1' or request.headers.get('X-Profile')):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+def stop_request_profiler():
+    """Stop the request's profiler, if it has one, and return where its profile was saved"""
+    profiler, g.profiler = g.get('profiler'), None
+    if profiler is None:
+        return None
+    profiler.disable()
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    profile_path = os.path.join(PROFILE_FOLDER, f"{request.endpoint or 'unknown'}-{uuid.uuid4().hex[:8]}.prof")
+    profiler.dump_stats(profile_path)
+    return profile_path
+
+@app.after_request
+def finish_request_timing(response):
+    """Record the request's latency and save its profile (named in X-Profile-File)"""
+    profile_path = stop_request_profiler()
+    if profile_path is not None:
+        response.headers['X-Profile-File'] = profile_path
+    if 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=request.endpoint or 'unknown')
+    return response
+
+@app.teardown_request
+def stop_failed_request_profiler(error=None):
+    """Stop the profiler of a request whose view raised (after_request doesn't run for it)"""
+    stop_request_profiler()
+
+def admission_controlled(view):
+    """Run a CPU-heavy view in one of this process's HEAVY_REQUEST_SLOTS
+    
+    A request that finds every slot taken waits up to HEAVY_REQUEST_WAIT_SECONDS
+    and is then answered with 429 and a Retry-After header, so a burst of
+    uploads queues briefly instead of slowing every request down.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not heavy_request_slots.acquire(timeout=HEAVY_REQUEST_WAIT_SECONDS):
+            REQUESTS_THROTTLED.inc(endpoint=request.endpoint or 'unknown')
+            response = jsonify({'error': 'Server is busy, please retry shortly'})
+            response.headers['Retry-After'] = str(max(1, int(HEAVY_REQUEST_WAIT_SECONDS)))
+            return response, 429
+        try:
+            return view(*args, **kwargs)
+        finally:
+            heavy_request_slots.release()
+    return wrapper
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f'File is too large (limit {MAX_UPLOAD_BYTES // (1024 * 1024)} MB)'}), 413
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Stage timings, rejected rows, PDFs generated and queue depth, summed over all processes"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/', methods=['GET'])
 def index():
     # Serve React frontend if available
@@ -414,7 +2529,41 @@ def serve_react_app(path):
         return send_from_directory('frontend/build', 'index.html')
     return jsonify({'error': 'Frontend not found'}), 404
 
+def stored_coordinates(processed):
+    """A processed frame with the numeric coordinates the upload store keeps
+    
+    Frames of one upload share the schema of the first one stored, so text
+    coordinates (from files with some non-numeric values) are stored as
+    NaN instead, with the invalid_coordinate column marking those rows so
+    add_ping_metrics still treats them as invalid when they are measured
+    again.
+    """
+    frame = processed.copy()
+    invalid = np.zeros(len(frame), dtype=bool)
+    for col in COORDINATE_LIMITS:
+        if not pd.api.types.is_numeric_dtype(frame[col]):
+            values = pd.to_numeric(frame[col], errors='coerce')
+            invalid |= (values.isna() & frame[col].notna()).to_numpy()
+            frame[col] = values
+    if 'invalid_coordinate' in frame.columns:
+        invalid |= frame['invalid_coordinate'].to_numpy(dtype=bool)
+    frame['invalid_coordinate'] = invalid
+    return frame
+
+def store_upload(processed, filename):
+    """Save a processed upload for later requests and return its upload_id"""
+    with upload_store.create({
+        'filename': filename,
+        'timestamp_parsing': processed.attrs.get('timestamp_parsing'),
+        'ping_filter': processed.attrs.get('ping_filter'),
+        'distance_model': processed.attrs.get('distance_model'),
+        'row_report': processed.attrs.get('row_report')
+    }) as upload, STAGE_SECONDS.time(stage='write'):
+        upload.write(stored_coordinates(processed))
+    return upload.upload_id
+
 @app.route('/upload', methods=['POST'])
+@admission_controlled
 def upload_file():
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
@@ -427,86 +2576,197 @@ def upload_file():
         return jsonify({'error': 'Only CSV and Excel (.xlsx) files are allowed'}), 400
     
     try:
-        # Read file based on type
-        if file.filename.endswith('.xlsx'):
-            # For Excel files, read the first sheet by default
-            df = pd.read_excel(file, sheet_name=0)
-        else:
-            # For CSV files
-            df = pd.read_csv(file)
-        
-        # Check required columns
-        required_columns = ['latitude', 'longitude', 'device_timestamp']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        
-        if missing_columns:
+        ping_filter = ping_filter_options(request.form)
+        distance_model = distance_model_option(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Turn away wrong headers and unusable values before reading the whole file
+    validation = validate_upload(file.stream, file.filename, request.form.get('worksheet_name'))
+    if not validation['valid']:
+        return validation_error(validation)
+    
+    try:
+        # Large CSV exports are summarized (and stored) chunk by chunk
+        if use_streaming(file):
+            reports = []
+            timestamp_reports = []
+            filter_reports = []
+            row_reports = []
+            reader_counts = {}
+            with upload_store.create({'filename': file.filename}) as upload:
+                frames = STAGE_SECONDS.time_iter(iter_csv_trip_frames(file.stream, CSV_CHUNK_ROWS, row_counts=reader_counts),
+                                                 stage='read')
+                for processed in process_trip_frames(frames, ping_filter, distance_model):
+                    frame_reports = summarize_trips(processed, include_stops=True)
+                    record_fleet_days(processed, frame_reports, upload.upload_id)
+                    reports.extend(frame_reports)
+                    timestamp_reports.append(processed.attrs['timestamp_parsing'])
+                    filter_reports.append(processed.attrs.get('ping_filter'))
+                    row_reports.append(processed.attrs['row_report'])
+                    with STAGE_SECONDS.time(stage='write'):
+                        upload.write(stored_coordinates(processed))
+                upload.metadata['timestamp_parsing'] = merge_timestamp_reports(timestamp_reports)
+                upload.metadata['ping_filter'] = merge_filter_reports(filter_reports)
+                upload.metadata['distance_model'] = distance_model or DISTANCE_MODEL
+                upload.metadata['row_report'] = merge_row_reports(row_reports + [reader_counts])
+            
             return jsonify({
-                'error': f'Missing required columns: {missing_columns}',
-                'required_columns': required_columns,
-                'found_columns': list(df.columns)
-            }), 400
+                'message': 'File processed successfully',
+                'upload_id': upload.upload_id,
+                'trip_count': int(len(reports)),
+                'reports': reports,
+                'timestamp_parsing': upload.metadata['timestamp_parsing'],
+                'ping_filter': upload.metadata['ping_filter'],
+                'distance_model': upload.metadata['distance_model'],
+                'validation': validation,
+                'row_report': upload.metadata['row_report']
+            })
+        
+        # Read file based on type
+        reader_counts = {}
+        with STAGE_SECONDS.time(stage='read'):
+            if file.filename.endswith('.xlsx'):
+                # For Excel files, stream the selected sheet (the first by default)
+                _, df = read_excel_columns(file.stream, request.form.get('worksheet_name'), row_counts=reader_counts)
+            else:
+                # For CSV files
+                df = pd.read_csv(file)
         
         # Group by trip_id if available, otherwise treat as single trip
         if 'trip_id' in df.columns:
-            trip_ids = df['trip_id'].unique()
-            reports = []
-            
-            for trip_id in trip_ids:
-                trip_data = df[df['trip_id'] == trip_id]
-                if len(trip_data) > 1:  # Only process trips with multiple pings
-                    processed_data = process_trip_data(trip_data)
-                    reports.append({
-                        'trip_id': int(trip_id),
-                        'ping_count': int(len(processed_data)),
-                        'total_distance': float(processed_data['distance_km'].sum()),
-                        'total_duration': float(processed_data['duration_hours'].sum()),
-                        'avg_speed': float(processed_data['speed_kmh'].mean())
-                    })
+            # One sort and one grouped aggregate for all trips
+            processed = process_trips(df, ping_filter=ping_filter, distance_model=distance_model)
+            processed.attrs['row_report'] = merge_row_reports([processed.attrs['row_report'], reader_counts])
+            reports = summarize_trips(processed, include_stops=True)
+            upload_id = store_upload(processed, file.filename)
+            record_fleet_days(processed, reports, upload_id)
             
             return jsonify({
                 'message': 'File processed successfully',
+                'upload_id': upload_id,
                 'trip_count': int(len(reports)),
-                'reports': reports
+                'reports': reports,
+                'timestamp_parsing': processed.attrs.get('timestamp_parsing'),
+                'ping_filter': processed.attrs.get('ping_filter'),
+                'distance_model': processed.attrs.get('distance_model'),
+                'validation': validation,
+                'row_report': processed.attrs['row_report']
             })
         
         else:
             # Single trip
-            processed_data = process_trip_data(df)
+            processed_data = process_trip_data(df, ping_filter, distance_model)
+            upload_id = store_upload(processed_data, file.filename)
+            stopped, stops = detect_stops(processed_data, trip_starts=[0])
+            sites = match_trip_sites(processed_data, stops, [0])
+            report = {
+                'trip_id': 'single_trip',
+                'ping_count': int(len(processed_data)),
+                'total_distance': float(processed_data['distance_km'].sum()),
+                'total_duration': float(processed_data['duration_hours'].sum()),
+                'avg_speed': float(processed_data['speed_kmh'].mean()),
+                **movement_totals(processed_data, stopped),
+                'stop_count': int(len(stops))
+            }
+            if sites is not None:
+                stops = stops.assign(site_index=sites[2])
+                report['origin_site'] = geofence_index.site(sites[0][0])
+                report['destination_site'] = geofence_index.site(sites[1][0])
+                report['stop_sites'] = site_names(sites[2])
+            report['stops'] = stop_events(stops)
             return jsonify({
                 'message': 'File processed successfully',
+                'upload_id': upload_id,
                 'trip_count': 1,
-                'reports': [{
-                    'trip_id': 'single_trip',
-                    'ping_count': int(len(processed_data)),
-                    'total_distance': float(processed_data['distance_km'].sum()),
-                    'total_duration': float(processed_data['duration_hours'].sum()),
-                    'avg_speed': float(processed_data['speed_kmh'].mean())
-                }]
+                'reports': [report],
+                'timestamp_parsing': processed_data.attrs.get('timestamp_parsing'),
+                'ping_filter': processed_data.attrs.get('ping_filter'),
+                'distance_model': processed_data.attrs.get('distance_model'),
+                'validation': validation,
+                'row_report': processed_data.attrs['row_report']
             })
     
     except Exception as e:
         return jsonify({'error': f'Error processing file: {str(e)}'}), 500
 
+def load_upload_trip(upload_id, trip_id):
+    """Processed rows of one trip of a stored upload, or an error response"""
+    index = upload_store.index(upload_id)
+    if index is None:
+        return jsonify({'error': 'Upload not found (it may have expired)'}), 404
+    
+    if trip_id == 'single_trip':
+        if len(index['trips']) > 1:
+            return jsonify({'error': 'trip_id is required for uploads with multiple trips'}), 400
+        with STAGE_SECONDS.time(stage='read'):
+            processed_data = upload_store.read(upload_id)
+    else:
+        try:
+            with STAGE_SECONDS.time(stage='read'):
+                processed_data = upload_store.read(upload_id, int(trip_id))
+        except KeyError:
+            return jsonify({'error': 'Not enough data points for trip analysis'}), 400
+    
+    if len(processed_data) < 2:
+        return jsonify({'error': 'Not enough data points for trip analysis'}), 400
+    return processed_data
+
+def send_trip_report(processed_data, trip_id):
+    """Send a trip's PDF, served from the cache when an identical trip was rendered before"""
+    filename = trip_pdf_filename(trip_id, processed_data)
+    pdf_path = pdf_cache.get(filename)
+    if pdf_path is None:
+        record_render(render_trip_pdf(trip_id, processed_data, filename), 'request')
+        pdf_path = pdf_cache.path(filename)
+        pdf_cache.maybe_evict()
+    
+    # Return PDF file
+    return send_file(
+        pdf_path,
+        mimetype='application/pdf',
+        as_attachment=True,
+        download_name=f'trip_report_{trip_id}.pdf'
+    )
+
 @app.route('/generate-report', methods=['POST'])
+@admission_controlled
 def generate_report():
-    if 'file' not in request.files:
+    upload_id = request.form.get('upload_id')
+    if 'file' not in request.files and not upload_id:
         return jsonify({'error': 'No file provided'}), 400
     
-    file = request.files['file']
     trip_id = request.form.get('trip_id', 'single_trip')
     worksheet_name = request.form.get('worksheet_name', None)
+    try:
+        ping_filter = ping_filter_options(request.form)
+        distance_model = distance_model_option(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     
     try:
+        if upload_id:
+            processed_data = load_upload_trip(upload_id, trip_id)
+            if isinstance(processed_data, tuple):
+                return processed_data  # Error response
+            return send_trip_report(refilter_processed(processed_data, ping_filter, distance_model), trip_id)
+        
+        file = request.files['file']
+        validation = validate_upload(file.stream, file.filename, worksheet_name)
+        if not validation['valid']:
+            return validation_error(validation)
+        
         # Read file based on type
-        if file.filename.endswith('.xlsx'):
-            if worksheet_name:
-                df = pd.read_excel(file, sheet_name=worksheet_name)
+        with STAGE_SECONDS.time(stage='read'):
+            if trip_id != 'single_trip' and use_streaming(file):
+                # Large CSV: keep only the requested trip's rows while reading
+                df = read_csv_trip(file.stream, int(trip_id))
+            elif file.filename.endswith('.xlsx'):
+                # Stream the required columns of the sheet (the first if none is specified)
+                _, df = read_excel_columns(file.stream, worksheet_name)
             else:
-                # Default to first sheet if no worksheet specified
-                df = pd.read_excel(file, sheet_name=0)
-        else:
-            # For CSV files
-            df = pd.read_csv(file)
+                # For CSV files
+                df = pd.read_csv(file)
         
         # Filter by trip_id if specified and column exists
         if trip_id != 'single_trip' and 'trip_id' in df.columns:
@@ -516,18 +2776,9 @@ def generate_report():
             return jsonify({'error': 'Not enough data points for trip analysis'}), 400
         
         # Process data
-        processed_data = process_trip_data(df)
-        
-        # Generate PDF
-        pdf_buffer = generate_pdf_report(processed_data, trip_id)
+        processed_data = process_trip_data(df, ping_filter, distance_model)
         
-        # Return PDF file
-        return send_file(
-            pdf_buffer,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=f'trip_report_{trip_id}.pdf'
-        )
+        return send_trip_report(processed_data, trip_id)
     
     except Exception as e:
         return jsonify({'error': f'Error generating report: {str(e)}'}), 500
@@ -535,6 +2786,27 @@ def generate_report():
 @app.route('/generate-batch-reports', methods=['POST'])
 def generate_batch_reports():
     """Start batch PDF generation for multiple trips"""
+    try:
+        ping_filter = ping_filter_options(request.form)
+        distance_model = distance_model_option(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    upload_id = request.form.get('upload_id')
+    if upload_id:
+        # A stored upload is already processed; the worker reads it directly
+        if upload_store.index(upload_id) is None:
+            return jsonify({'error': 'Upload not found (it may have expired)'}), 404
+        batch_id = str(uuid.uuid4())
+        os.makedirs(batch_folder(batch_id))
+        save_batch_options(batch_id, {'ping_filter': ping_filter, 'distance_model': distance_model})
+        job_store.create_batch(batch_id, upload_store.data_path(upload_id))
+        start_batch_worker()
+        return jsonify({
+            'message': 'Batch PDF generation started',
+            'batch_id': batch_id
+        })
+    
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
     
@@ -545,40 +2817,29 @@ def generate_batch_reports():
     # Get worksheet name for Excel files
     worksheet_name = request.form.get('worksheet_name', None)
     
+    # Checked before the upload is saved, so a bad file is never written out
+    validation = validate_upload(file.stream, file.filename, worksheet_name)
+    if not validation['valid']:
+        return validation_error(validation)
+    
     try:
-        # Read file based on type
-        if file.filename.endswith('.xlsx'):
-            if worksheet_name:
-                df = pd.read_excel(file, sheet_name=worksheet_name)
-            else:
-                # Default to first sheet if no worksheet specified
-                df = pd.read_excel(file, sheet_name=0)
-        else:
-            # For CSV files
-            df = pd.read_csv(file)
-        
-        # Check required columns
-        required_columns = ['latitude', 'longitude', 'device_timestamp']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        
-        if missing_columns:
-            return jsonify({
-                'error': f'Missing required columns: {missing_columns}',
-                'required_columns': required_columns,
-                'found_columns': list(df.columns)
-            }), 400
-        
         # Generate unique batch ID
         batch_id = str(uuid.uuid4())
         
-        # Start background processing
-        thread = threading.Thread(target=generate_batch_pdfs, args=(batch_id, df))
-        thread.daemon = True
-        thread.start()
+        # Save the upload so any worker process can ingest it, even after a restart
+        os.makedirs(batch_folder(batch_id))
+        source_path = os.path.join(batch_folder(batch_id), 'upload.xlsx' if file.filename.endswith('.xlsx') else 'upload.csv')
+        file.save(source_path)
+        
+        # Queue the batch for the background workers
+        save_batch_options(batch_id, {'ping_filter': ping_filter, 'distance_model': distance_model})
+        job_store.create_batch(batch_id, source_path, worksheet_name)
+        start_batch_worker()
         
         return jsonify({
             'message': 'Batch PDF generation started',
-            'batch_id': batch_id
+            'batch_id': batch_id,
+            'validation': validation
         })
         
     except Exception as e:
@@ -586,11 +2847,15 @@ def generate_batch_reports():
 
 @app.route('/batch-status/<batch_id>', methods=['GET'])
 def get_batch_status(batch_id):
-    """Get status of batch PDF generation"""
-    if batch_id not in batch_jobs:
-        return jsonify({'error': 'Batch job not found'}), 404
+    """Get status of batch PDF generation
     
-    job = batch_jobs[batch_id]
+    With ?offset=N only the PDFs completed after the first N are listed, so
+    a poller can pass back next_offset instead of fetching the whole list.
+    """
+    offset = request.args.get('offset', 0, type=int)
+    job = job_store.get_batch(batch_id, offset=max(offset, 0))
+    if job is None:
+        return jsonify({'error': 'Batch job not found'}), 404
     
     # Calculate progress percentage
     progress = 0
@@ -603,16 +2868,163 @@ def get_batch_status(batch_id):
         'total_trips': job['total_trips'],
         'completed_trips': job['completed_trips'],
         'pdfs': job['pdfs'],
-        'error': job['error']
+        'next_offset': max(offset, 0) + len(job['pdfs']),
+        'failed_trips': job['failed_trips'],
+        'error': job['error'],
+        'row_report': load_batch_row_report(batch_id)
+    })
+
+@app.route('/batch-events/<batch_id>', methods=['GET'])
+def batch_events(batch_id):
+    """Stream a batch's progress as Server-Sent Events
+    
+    Each event's id is its position in the batch's event log; a reconnecting
+    EventSource sends the last one back (Last-Event-ID) and the stream
+    resumes after it. The stream ends after the batch_done event.
+    """
+    if job_store.batch_status(batch_id) is None:
+        return jsonify({'error': 'Batch job not found'}), 404
+    
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0
+    try:
+        last_event_id = int(last_event_id)
+    except ValueError:
+        return jsonify({'error': 'Invalid Last-Event-ID'}), 400
+    
+    return Response(
+        stream_batch_events(batch_id, last_event_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/batch-cancel/<batch_id>', methods=['POST'])
+def cancel_batch(batch_id):
+    """Cancel a batch; trips already rendering are allowed to finish"""
+    if not job_store.cancel_batch(batch_id):
+        return jsonify({'error': 'Batch job not found'}), 404
+    
+    return jsonify({
+        'message': 'Batch cancelled',
+        'status': job_store.get_batch(batch_id)['status']
+    })
+
+@app.route('/fleet-analytics', methods=['GET'])
+def fleet_analytics():
+    """Fleet rollups over every recorded upload
+    
+    Query parameters: group_by (comma-separated, from day, week, month,
+    vehicle, route, invoice, trip, upload, created_day and closed_day;
+    default day), from and to (YYYY-MM-DD, inclusive), created_from,
+    created_to, closed_from and closed_to (the same, for the day trips were
+    created or closed), the exact-match filters trip_id, vehicle, route,
+    invoice and upload_id, and percentiles (default 50,90,99).
+    """
+    group_by = [name.strip() for name in request.args.get('group_by', 'day').split(',') if name.strip()]
+    start = request.args.get('from')
+    end = request.args.get('to')
+    ranges = {
+        name: (request.args.get(f"{name}_from"), request.args.get(f"{name}_to"))
+        for name in RANGE_COLUMNS
+        if request.args.get(f"{name}_from") or request.args.get(f"{name}_to")
+    }
+    try:
+        for value in [start, end, *itertools.chain.from_iterable(ranges.values())]:
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+        percentiles = [float(p) for p in request.args.get('percentiles', '50,90,99').split(',') if p.strip()]
+        if any(not 0 <= p <= 100 for p in percentiles):
+            raise ValueError("percentiles must be between 0 and 100")
+        rows = fleet_store.query(group_by, start, end, {name: request.args.get(name) for name in FILTER_COLUMNS},
+                                 percentiles, ranges)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'group_by': group_by,
+        'row_count': len(rows),
+        'rows': rows
     })
 
+@app.route('/export/<upload_id>', methods=['GET'])
+def export_upload(upload_id):
+    """Stream a stored upload's processed pings as CSV, NDJSON or GeoJSON
+    
+    Query parameters: format (csv, the default, ndjson or geojson), trip_id
+    (repeatable; every trip by default) and compress=gzip for a .gz file.
+    Without compress=gzip the response is still gzip-encoded for clients
+    that accept it. Rows are read from the stored Arrow file a chunk of
+    whole trips at a time and formatted with Arrow compute functions, so
+    no PDF or pandas work is involved.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format {export_format!r}, expected one of {list(EXPORT_FORMATS)}"}), 400
+    compress = request.args.get('compress')
+    if compress not in (None, 'gzip'):
+        return jsonify({'error': f"Unknown compression {compress!r}, expected 'gzip'"}), 400
+    
+    index = upload_store.index(upload_id)
+    if index is None:
+        return jsonify({'error': 'Upload not found (it may have expired)'}), 404
+    trip_ids = request.args.getlist('trip_id') or None
+    if trip_ids:
+        missing = [trip_id for trip_id in trip_ids if trip_id not in index['trips']]
+        if missing:
+            return jsonify({'error': f"Trips not found in upload: {missing}"}), 404
+    
+    mimetype, extension = EXPORT_FORMATS[export_format]
+    filename = f"trips_{upload_id}.{extension}"
+    headers = {'Vary': 'Accept-Encoding'}
+    chunks = STAGE_SECONDS.time_iter(
+        iter_export(upload_store.iter_tables(upload_id, EXPORT_CHUNK_ROWS, trip_ids), export_format), stage='export')
+    if compress == 'gzip':
+        mimetype = 'application/gzip'
+        filename += '.gz'
+        chunks = gzip_chunks(chunks, EXPORT_GZIP_LEVEL)
+    elif 'gzip' in request.accept_encodings:
+        headers['Content-Encoding'] = 'gzip'
+        chunks = gzip_chunks(chunks, EXPORT_GZIP_LEVEL)
+    headers['Content-Disposition'] = f'attachment; filename={filename}'
+    
+    return Response(chunks, mimetype=mimetype, headers=headers)
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    """PDF cache hit/miss counters (for this process) and current size"""
+    return jsonify(pdf_cache.stats())
+
+@app.route('/download-batch/<batch_id>', methods=['GET'])
+def download_batch(batch_id):
+    """Download all of a batch's PDFs as one streamed ZIP file
+    
+    With ?format=pdf they are merged into one PDF instead, opened by a
+    summary of the batch's trips and with a bookmark for each trip.
+    """
+    download_format = request.args.get('format', 'zip')
+    if download_format not in ('zip', 'pdf'):
+        return jsonify({'error': f"Unknown format {download_format!r}, expected 'zip' or 'pdf'"}), 400
+    if job_store.batch_status(batch_id) is None:
+        return jsonify({'error': 'Batch job not found'}), 404
+    
+    if download_format == 'pdf':
+        return Response(
+            stream_batch_pdf(batch_id),
+            mimetype='application/pdf',
+            headers={'Content-Disposition': f'attachment; filename=trip_reports_{batch_id}.pdf'}
+        )
+    return Response(
+        stream_batch_zip(batch_id),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=trip_reports_{batch_id}.zip'}
+    )
+
 @app.route('/download-pdf/<filename>', methods=['GET'])
 def download_pdf(filename):
     """Download individual PDF file"""
     try:
-        pdf_path = os.path.join(PDF_FOLDER, filename)
+        pdf_path = pdf_cache.path(filename)
         
-        if not os.path.exists(pdf_path):
+        if not pdf_cache.touch(filename):
             return jsonify({'error': 'PDF file not found'}), 404
         
         return send_file(
@@ -625,6 +3037,92 @@ def download_pdf(filename):
     except Exception as e:
         return jsonify({'error': f'Error downloading PDF: {str(e)}'}), 500
 
+def read_live_pings(trip_id):
+    """New pings for a live trip from the request, as (latitudes, longitudes, timestamps, rejected)
+
+    Pings come from an uploaded CSV/Excel file (rows of other trips are
+    ignored when it has a trip_id column) or a JSON body {"pings": [...]}.
+    Pings without a parseable timestamp or numeric coordinates are left out
+    and counted in rejected.
+    """
+    if 'file' in request.files:
+        file = request.files['file']
+        if file.filename.endswith('.xlsx'):
+            _, df = read_excel_columns(file.stream, request.form.get('worksheet_name'))
+        else:
+            df = pd.read_csv(file)
+        if 'trip_id' in df.columns:
+            df = df[df['trip_id'].astype(str) == str(trip_id)]
+    else:
+        body = request.get_json(silent=True) or {}
+        df = pd.DataFrame(body.get('pings') or [])
+    
+    required_columns = ['latitude', 'longitude', 'device_timestamp']
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    if missing_columns:
+        raise ValueError(f"Missing required columns: {missing_columns}")
+    
+    timestamps, _ = parse_timestamp_column(df['device_timestamp'])
+    latitudes = pd.to_numeric(df['latitude'], errors='coerce')
+    longitudes = pd.to_numeric(df['longitude'], errors='coerce')
+    valid = (timestamps.notna() & latitudes.notna() & longitudes.notna()).to_numpy()
+    return (
+        latitudes.to_numpy(dtype=float)[valid],
+        longitudes.to_numpy(dtype=float)[valid],
+        timestamps.to_numpy(dtype='datetime64[ns]')[valid],
+        int((~valid).sum())
+    )
+
+@app.route('/live-trips/<trip_id>/pings', methods=['POST'])
+def append_live_pings(trip_id):
+    """Add new pings to a live trip and return its updated totals
+    
+    Only the new pings are measured (late pings against their stored
+    neighbours), so the cost doesn't grow with the trip's history.
+    """
+    try:
+        latitudes, longitudes, timestamps, rejected = read_live_pings(trip_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'Error reading pings: {str(e)}'}), 500
+    
+    if len(timestamps) == 0:
+        return jsonify({'error': 'No valid pings provided', 'rejected': rejected}), 400
+    
+    summary = live_trip_store.append(trip_id, latitudes, longitudes, timestamps)
+    return jsonify(dict(summary, appended=int(len(timestamps)), rejected=rejected))
+
+@app.route('/live-trips/<trip_id>', methods=['GET'])
+def get_live_trip(trip_id):
+    """Current totals of a live trip"""
+    summary = live_trip_store.summary(trip_id)
+    if summary is None:
+        return jsonify({'error': 'Live trip not found'}), 404
+    return jsonify(summary)
+
+@app.route('/live-trips/<trip_id>', methods=['DELETE'])
+def delete_live_trip(trip_id):
+    """Forget a live trip (for example once it has closed)"""
+    if not live_trip_store.delete(trip_id):
+        return jsonify({'error': 'Live trip not found'}), 404
+    return jsonify({'message': 'Live trip deleted'})
+
+@app.route('/live-trips/<trip_id>/report', methods=['GET'])
+@admission_controlled
+def live_trip_report(trip_id):
+    """PDF report of a live trip's pings so far"""
+    processed_data = live_trip_store.read(trip_id)
+    if processed_data is None:
+        return jsonify({'error': 'Live trip not found'}), 404
+    if len(processed_data) < 2:
+        return jsonify({'error': 'Not enough data points for trip analysis'}), 400
+    
+    try:
+        return send_trip_report(processed_data, trip_id)
+    except Exception as e:
+        return jsonify({'error': f'Error generating report: {str(e)}'}), 500
+
 @app.route('/list-worksheets', methods=['POST'])
 def list_worksheets():
     """List all worksheets in an Excel file"""
@@ -636,9 +3134,8 @@ def list_worksheets():
         return jsonify({'error': 'Please select a valid Excel (.xlsx) file'}), 400
     
     try:
-        # Get all sheet names
-        excel_file = pd.ExcelFile(file)
-        worksheets = excel_file.sheet_names
+        # Get all sheet names (from the workbook metadata only)
+        worksheets = excel_sheet_names(file.stream)
         
         return jsonify({
             'worksheets': worksheets,
@@ -648,7 +3145,37 @@ def list_worksheets():
     except Exception as e:
         return jsonify({'error': f'Error reading Excel file: {str(e)}'}), 500
 
+@app.route('/validate-upload', methods=['POST'])
+def validate_upload_file():
+    """Check a file's columns and first rows without processing it (see validate_upload)"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = request.files['file']
+    if file.filename == '' or not (file.filename.endswith('.csv') or file.filename.endswith('.xlsx')):
+        return jsonify({'error': 'Please select a valid CSV or Excel (.xlsx) file'}), 400
+    
+    return jsonify(validate_upload(file.stream, file.filename, request.form.get('worksheet_name')))
+
+# Resume queued batches left by a previous run (gunicorn workers start theirs
+# once they are forked, see gunicorn.conf.py). The worker and merge commands
+# below run none: a dedicated worker process is its own batch worker.
+CLI_COMMAND = sys.argv[1] if __name__ == '__main__' and len(sys.argv) > 1 else None
+CLI_USAGE = 'usage: python app.py [worker | merge <batch_id> <output.pdf>]'
+if not SERVER_MANAGED and not RENDER_PROCESS and CLI_COMMAND is None:
+    start_batch_worker()
+
 if __name__ == '__main__':
-    import os
-    port = int(os.environ.get('PORT', 5000))
-    app.run(debug=False, host='0.0.0.0', port=port) 
\ No newline at end of file
+    if CLI_COMMAND == 'worker' and len(sys.argv) == 2:
+        # Dedicated batch worker process
+        run_batch_worker()
+    elif CLI_COMMAND == 'merge' and len(sys.argv) == 4:
+        # Write a batch's merged PDF to disk: python app.py merge <batch_id> <output.pdf>
+        with open(sys.argv[3], 'wb') as output:
+            for chunk in stream_batch_pdf(sys.argv[2]):
+                output.write(chunk)
+    elif CLI_COMMAND is None:
+        port = int(os.environ.get('PORT', 5000))
+        app.run(debug=False, host='0.0.0.0', port=port)
+    else:
+        sys.exit(CLI_USAGE)
@@ -0,0 +1,94 @@
+"""Benchmark batch PDF rendering throughput against the number of pool workers.
+
+Run from the repository root:
+
+    python benchmarks/bench_batch_workers.py
+    python benchmarks/bench_batch_workers.py --trips 2000 --pings 300 --workers 1 2 4 8
+
+Each run queues the same synthetic batch in a throwaway job store, drains it
+with run_batch_worker and reports trips per second and the scaling efficiency relative to one worker.
+Scaling is bounded by the number of CPU cores on the machine.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the benchmark's batches out of the app's job store and drain them here
+STORE_DIR = tempfile.mkdtemp(prefix='bench_batch_')
+os.environ['JOB_STORE_URL'] = 'sqlite:///' + os.path.join(STORE_DIR, 'jobs.db')
+os.environ['BATCH_WORKER_THREAD'] = '0'
+
+import app  # noqa: E402
+from bench_process_trip_data import make_trip  # noqa: E402
+
+
+def make_batch(trip_count, ping_count):
+    """Build a multi-trip upload frame with string timestamps"""
+    trips = []
+    for trip_id in range(trip_count):
+        trip = make_trip(ping_count, seed=trip_id)
+        trips.append(pd.DataFrame({
+            'latitude': trip['latitude'],
+            'longitude': trip['longitude'],
+            'device_timestamp': trip['parsed_timestamp'].dt.strftime('%d/%m/%y %H:%M'),
+            'trip_id': 30000000 + trip_id,
+        }))
+    return pd.concat(trips, ignore_index=True)
+
+
+def run_batch(df, workers):
+    batch_id = str(uuid.uuid4())
+    os.makedirs(app.batch_folder(batch_id))
+    source_path = os.path.join(app.batch_folder(batch_id), 'upload.csv')
+    df.to_csv(source_path, index=False)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.job_store.create_batch(batch_id, source_path)
+        app.run_batch_worker(workers=workers, until_idle=True)
+    elapsed = time.perf_counter() - start
+
+    job = app.job_store.get_batch(batch_id)
+    with contextlib.redirect_stdout(io.StringIO()):
+        app.cleanup_old_files(batch_id)
+    if job['status'] != 'completed' or job['failed_trips']:
+        raise SystemExit(f"Batch failed with {workers} workers: {job['error'] or job['failed_trips']}")
+    return elapsed, job['completed_trips']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--trips', type=int, default=200, help='trips in the batch')
+    parser.add_argument('--pings', type=int, default=200, help='pings per trip')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='worker counts to compare')
+    args = parser.parse_args()
+
+    df = make_batch(args.trips, args.pings)
+    print(f"{args.trips} trips x {args.pings} pings, {os.cpu_count()} CPUs")
+    print(f"{'workers':>8} {'seconds':>10} {'trips/s':>10} {'speedup':>9} {'efficiency':>11}")
+
+    baseline = None
+    try:
+        for workers in args.workers:
+            elapsed, completed = run_batch(df, workers)
+            throughput = completed / elapsed
+            baseline = baseline or throughput
+            speedup = throughput / baseline
+            print(f"{workers:>8} {elapsed:>10.2f} {throughput:>10.1f} {speedup:>8.2f}x {speedup / workers * args.workers[0]:>10.0%}")
+    finally:
+        shutil.rmtree(STORE_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Compare the distance models on speed and on accuracy against Vincenty.
+
+Run from the repository root:
+
+    python benchmarks/bench_distance_models.py
+    python benchmarks/bench_distance_models.py --trips 500 --pings 2000 --repeat 5
+    python benchmarks/bench_distance_models.py --file "Sample Trip Data _ Trip Tracker - Sheet1.csv"
+
+Distances are measured between consecutive pings of each trip, as
+compute_ping_metrics does, on a synthetic fleet (benchmarks/synthetic.py,
+whose generator options are accepted here) and on the sample export or the
+--file given. For every model it prints the time per million gaps and the
+error against the ellipsoidal Vincenty distance: per gap (median, 99th
+percentile and max, in metres) and on trip totals (mean and max, in parts
+per million). The last column is the largest gap difference from haversine,
+which shows what the equirectangular shortcut itself gives up.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('BATCH_WORKER_THREAD', '0')
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app  # noqa: E402
+from synthetic import add_arguments, fleet_from_args  # noqa: E402
+
+SAMPLE_FILE = os.path.join(ROOT, 'Sample Trip Data _ Trip Tracker - Sheet1.csv')
+
+
+def ping_gaps(df):
+    """(start lat, start lon, end lat, end lon, trip of each gap) for consecutive pings"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        processed = app.process_trips(df)
+    latitudes = processed['latitude'].to_numpy(dtype=float)
+    longitudes = processed['longitude'].to_numpy(dtype=float)
+    trip_codes = pd.factorize(processed['trip_id'])[0]
+    same_trip = trip_codes[1:] == trip_codes[:-1]
+    return (latitudes[:-1][same_trip], longitudes[:-1][same_trip],
+            latitudes[1:][same_trip], longitudes[1:][same_trip], trip_codes[1:][same_trip])
+
+
+def time_model(distance, gaps, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        distances = distance(*gaps[:4])
+        timings.append(time.perf_counter() - start)
+    return distances, min(timings)
+
+
+def report(name, gaps, repeat):
+    count = len(gaps[0])
+    reference, _ = time_model(app.vincenty_distance_np, gaps, 1)
+    spherical, _ = time_model(app.haversine_distance_np, gaps, 1)
+    reference_totals = np.bincount(gaps[4], weights=reference)
+    spacing = np.percentile(reference * 1000, [50, 99])
+
+    print(f"\n{name}: {count} gaps between pings, {len(reference_totals)} trips, "
+          f"median gap {spacing[0]:.0f} m, 99th percentile {spacing[1]:.0f} m")
+    print(f"{'model':<16} {'s / 1M gaps':>12} {'median (m)':>11} {'p99 (m)':>9} {'max (m)':>9} "
+          f"{'trip mean (ppm)':>16} {'trip max (ppm)':>15} {'vs haversine (mm)':>18}")
+    for model, distance in app.DISTANCE_MODELS.items():
+        distances, seconds = time_model(distance, gaps, repeat)
+        errors = np.abs(distances - reference) * 1000
+        totals = np.bincount(gaps[4], weights=distances)
+        moved = reference_totals > 0
+        trip_errors = np.abs(totals[moved] - reference_totals[moved]) / reference_totals[moved] * 1e6
+        print(f"{model:<16} {seconds / count * 1e6:>12.4f} {np.median(errors):>11.3f} "
+              f"{np.percentile(errors, 99):>9.3f} {errors.max():>9.3f} "
+              f"{trip_errors.mean() if len(trip_errors) else 0:>16.0f} "
+              f"{trip_errors.max() if len(trip_errors) else 0:>15.0f} "
+              f"{np.abs(distances - spherical).max() * 1e6:>18.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per model (the fastest is reported)')
+    parser.add_argument('--file', default=SAMPLE_FILE, help='CSV export with real ping spacing')
+    args = parser.parse_args()
+
+    report(f"synthetic fleet ({args.trips} trips x {args.pings} pings)", ping_gaps(fleet_from_args(args)),
+           args.repeat)
+    if args.file and os.path.exists(args.file):
+        report(os.path.basename(args.file), ping_gaps(pd.read_csv(args.file)), args.repeat)
+
+
+if __name__ == '__main__':
+    main()
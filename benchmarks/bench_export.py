@@ -0,0 +1,85 @@
+"""Benchmark exporting a stored upload as CSV, NDJSON and GeoJSON.
+
+Run from the repository root:
+
+    python benchmarks/bench_export.py
+    python benchmarks/bench_export.py --trips 10000 --pings 100 --repeat 3
+
+A synthetic fleet (benchmarks/synthetic.py, whose generator options are
+accepted here) is processed and stored as /upload stores it, then exported
+in every format with iter_export, plain and gzipped, as GET /export streams
+it. For each it prints the time, trips and pings per second and the output
+size. For scale, the last line times generate_pdf_report on a sample of the
+trips and extrapolates it to the whole fleet.
+"""
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep the benchmark upload out of the app's own store
+WORK_DIR = tempfile.mkdtemp(prefix='bench_export_')
+os.environ['BATCH_WORKER_THREAD'] = '0'
+os.environ['FLEET_DB'] = os.path.join(WORK_DIR, 'fleet.db')
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app  # noqa: E402
+from synthetic import add_arguments, fleet_from_args  # noqa: E402
+from trip_export import EXPORT_FORMATS, gzip_chunks, iter_export  # noqa: E402
+from upload_store import UploadStore  # noqa: E402
+
+
+def export(upload_id, export_format, compress):
+    chunks = iter_export(app.upload_store.iter_tables(upload_id, app.EXPORT_CHUNK_ROWS), export_format)
+    if compress:
+        chunks = gzip_chunks(chunks, app.EXPORT_GZIP_LEVEL)
+    return sum(len(chunk) for chunk in chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.set_defaults(trips=10000, pings=100)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per format (the fastest is reported)')
+    parser.add_argument('--pdf-sample', type=int, default=20, help='trips rendered to PDF for comparison')
+    args = parser.parse_args()
+
+    app.upload_store = UploadStore(os.path.join(WORK_DIR, 'uploads'))
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            processed = app.process_trips(fleet_from_args(args))
+            upload_id = app.store_upload(processed, 'fleet.csv')
+        trips, pings = processed['trip_id'].nunique(), len(processed)
+        print(f"{trips} trips, {pings} pings")
+
+        print(f"{'format':<14} {'seconds':>8} {'trips/s':>9} {'pings/s':>11} {'MB':>8}")
+        for export_format in EXPORT_FORMATS:
+            for compress in [False, True]:
+                timings = []
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    size = export(upload_id, export_format, compress)
+                    timings.append(time.perf_counter() - start)
+                seconds = min(timings)
+                name = export_format + (' + gzip' if compress else '')
+                print(f"{name:<14} {seconds:>8.2f} {trips / seconds:>9.0f} {pings / seconds:>11.0f} {size / 1e6:>8.1f}")
+
+        sample = list(app.iter_trips(processed.iloc[:args.pdf_sample * args.pings]))
+        start = time.perf_counter()
+        for trip_id, trip_data in sample:
+            app.generate_pdf_report(trip_data, trip_id)
+        per_trip = (time.perf_counter() - start) / len(sample)
+        print(f"{'pdf (est.)':<14} {per_trip * trips:>8.2f} {1 / per_trip:>9.0f} {args.pings / per_trip:>11.0f}")
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
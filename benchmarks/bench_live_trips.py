@@ -0,0 +1,176 @@
+"""Check live trip totals against a full recompute, and time the appends.
+
+Run from the repository root:
+
+    python benchmarks/bench_live_trips.py
+    python benchmarks/bench_live_trips.py --pings 5000 --batch 50 --seeds 20
+
+For every seed it builds a synthetic trip (with repeated timestamps) and
+feeds its pings to a LiveTripStore in several arrival orders:
+
+    in-order     batches in timestamp order, the common case
+    before-first the second half first, then the first half, so late pings
+                 land before the first stored ping
+    one-gap      every tenth ping first, then the rest, so many late pings
+                 land between the same two stored pings
+    equal-last   batches that start at the last stored timestamp, plus a
+                 copy of a stored ping sent again later
+    random       random batches of a shuffled trip
+
+After the last batch, the stored pings and the totals are compared with
+process_trip_data run on every ping in arrival order. A mismatch stops the
+run. The timing columns are the total time of the appends and of calling
+process_trip_data once per batch on the history so far, which is what
+recomputing a live trip on every append would cost.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('BATCH_WORKER_THREAD', '0')
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app  # noqa: E402
+from live_trips import LiveTripStore  # noqa: E402
+
+SCENARIOS = ['in-order', 'before-first', 'one-gap', 'equal-last', 'random']
+
+
+def make_trip(ping_count, rng):
+    """A sorted synthetic trip in which about one ping in five repeats the previous timestamp"""
+    steps = rng.choice([0, 60, 300, 600], size=ping_count, p=[0.2, 0.2, 0.3, 0.3])
+    steps[0] = 0
+    return pd.DataFrame({
+        'latitude': 13.7163 + np.cumsum(rng.normal(0, 0.01, ping_count)),
+        'longitude': 79.64074 + np.cumsum(rng.normal(0, 0.01, ping_count)),
+        'parsed_timestamp': pd.Timestamp('2025-02-04 12:00') + pd.to_timedelta(np.cumsum(steps), unit='s'),
+    })
+
+
+def chunks(positions, size):
+    return [positions[i:i + size] for i in range(0, len(positions), size)]
+
+
+def arrival_batches(scenario, trip, batch, rng):
+    """Row positions of the trip, in the batches they are appended in"""
+    count = len(trip)
+    positions = np.arange(count)
+    if scenario == 'in-order':
+        return chunks(positions, batch)
+    if scenario == 'before-first':
+        half = count // 2
+        return chunks(positions[half:], batch) + chunks(rng.permutation(positions[:half]), batch)
+    if scenario == 'one-gap':
+        first = positions[::10]
+        return [first] + chunks(rng.permutation(np.setdiff1d(positions, first)), batch)
+    if scenario == 'equal-last':
+        # Cut the trip where a timestamp repeats, so each batch after the
+        # first starts at the timestamp the store last saw
+        stamps = trip['parsed_timestamp'].to_numpy()
+        repeats = np.flatnonzero(stamps[1:] == stamps[:-1]) + 1
+        cuts = repeats[::max(1, len(repeats) * batch // count)]
+        batches = [part for part in np.split(positions, cuts) if len(part)]
+        return batches + [positions[count // 3:count // 3 + 1]]
+    return chunks(rng.permutation(positions), batch)
+
+
+def replay(store, trip_id, trip, batches):
+    """Append the batches to the store; returns (seconds, rows in arrival order)"""
+    stamps = trip['parsed_timestamp'].to_numpy(dtype='datetime64[ns]')
+    seconds = 0.0
+    for positions in batches:
+        start = time.perf_counter()
+        store.append(trip_id, trip['latitude'].to_numpy()[positions],
+                     trip['longitude'].to_numpy()[positions], stamps[positions])
+        seconds += time.perf_counter() - start
+    return seconds, np.concatenate(batches)
+
+
+def recompute(trip, arrived):
+    """process_trip_data on the pings in arrival order"""
+    rows = trip.iloc[arrived]
+    df = pd.DataFrame({
+        'latitude': rows['latitude'].to_numpy(),
+        'longitude': rows['longitude'].to_numpy(),
+        'device_timestamp': rows['parsed_timestamp'].dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(),
+    })
+    return app.process_trip_data(df)
+
+
+def recompute_seconds(trip, batches):
+    """Time of recomputing the whole history after every batch"""
+    start = time.perf_counter()
+    for end in range(1, len(batches) + 1):
+        arrived = np.concatenate(batches[:end])
+        if len(arrived) >= 2:
+            recompute(trip, arrived)
+    return time.perf_counter() - start
+
+
+def check(store, trip_id, expected, label):
+    """Compare the stored pings and totals with a processed frame"""
+    stored = store.read(trip_id)
+    if len(stored) != len(expected):
+        raise SystemExit(f"{label}: {len(stored)} pings stored, {len(expected)} expected")
+    if not (stored['parsed_timestamp'].to_numpy() == expected['parsed_timestamp'].to_numpy()).all():
+        raise SystemExit(f"{label}: stored pings are not in timestamp order")
+    for column in ['latitude', 'longitude', 'distance_km', 'duration_hours', 'speed_kmh']:
+        if not np.allclose(stored[column], expected[column], rtol=1e-9, atol=1e-12):
+            raise SystemExit(f"{label}: per-ping {column} differs from process_trip_data")
+
+    summary = store.summary(trip_id)
+    totals = {
+        'ping_count': len(expected),
+        'total_distance': expected['distance_km'].sum(),
+        'total_duration': expected['duration_hours'].sum(),
+        'avg_speed': expected['speed_kmh'].mean(),
+    }
+    for name, value in totals.items():
+        if not np.isclose(summary[name], value, rtol=1e-9, atol=1e-9):
+            raise SystemExit(f"{label}: {name} is {summary[name]}, process_trip_data gives {value}")
+    for name, value in [('first_ping', expected['parsed_timestamp'].iloc[0]),
+                        ('last_ping', expected['parsed_timestamp'].iloc[-1])]:
+        if summary[name] != value.isoformat():
+            raise SystemExit(f"{label}: {name} is {summary[name]}, process_trip_data gives {value.isoformat()}")
+    return abs(summary['total_distance'] - totals['total_distance'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pings', type=int, default=2000, help='pings per trip')
+    parser.add_argument('--batch', type=int, default=25, help='pings per append')
+    parser.add_argument('--seeds', type=int, default=5, help='trips to check for each scenario')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as folder:
+        store = LiveTripStore(os.path.join(folder, 'live_trips.db'), app.compute_ping_metrics)
+        print(f"{'scenario':>12} {'appends':>8} {'max km diff':>12} {'append (s)':>11} {'recompute (s)':>14}")
+        for scenario in SCENARIOS:
+            appends = 0
+            worst = 0.0
+            append_time = 0.0
+            recompute_time = 0.0
+            for seed in range(args.seeds):
+                rng = np.random.default_rng(seed)
+                trip = make_trip(args.pings, rng)
+                batches = arrival_batches(scenario, trip, args.batch, rng)
+                trip_id = f"{scenario}-{seed}"
+                seconds, arrived = replay(store, trip_id, trip, batches)
+                worst = max(worst, check(store, trip_id, recompute(trip, arrived), f"{scenario} seed {seed}"))
+                appends += len(batches)
+                append_time += seconds
+                recompute_time += recompute_seconds(trip, batches)
+            print(f"{scenario:>12} {appends:>8} {worst:>12.2e} {append_time:>11.3f} {recompute_time:>14.3f}")
+
+
+if __name__ == '__main__':
+    main()
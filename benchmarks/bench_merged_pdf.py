@@ -0,0 +1,174 @@
+"""Benchmark merging trip PDFs into one batch PDF, and the memory it takes.
+
+Run from the repository root:
+
+    python benchmarks/bench_merged_pdf.py
+    python benchmarks/bench_merged_pdf.py --trips 2000 --pings 50 --distinct 20
+
+Trip reports are rendered with generate_pdf_report for --distinct trips of a
+synthetic fleet (benchmarks/synthetic.py, whose generator options are
+accepted here) and saved to disk, then --trips of them (reused in turn) are
+merged with PDFMerger into one file, as stream_batch_pdf does. For each
+batch size it prints the merge time, the input and output sizes (the
+output shares the logo and fonts between trips) and the peak memory
+allocated while merging, which stays flat as the batch grows. The last
+column is the peak for building the same PDF by holding every trip's
+bytes in memory first, as concatenating rendered reports would.
+
+Before timing anything it checks a round trip: two rendered reports and a
+ReportLab page whose link URI reads like PDF syntax ("5 0 R", "stream",
+"endobj") are merged, and the result is read back to check its page
+count, every object in its cross-reference table, its outline titles and
+destinations and the URI. A failed check stops the run.
+"""
+import argparse
+import contextlib
+import io
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('BATCH_WORKER_THREAD', '0')
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app  # noqa: E402
+from pdf_merge import PDFMerger, SourcePDF, pdf_string  # noqa: E402
+from reportlab.pdfgen import canvas  # noqa: E402
+from synthetic import add_arguments, fleet_from_args  # noqa: E402
+
+# Strings in a PDF that a merger must copy without renumbering or splitting
+TRICKY_URI = 'https://example.com/track?q=(5 0 R) stream\nendobj'
+
+
+def render_trips(args, folder):
+    """Paths of --distinct rendered trip PDFs"""
+    fleet = fleet_from_args(argparse.Namespace(**{**vars(args), 'trips': args.distinct}))
+    with contextlib.redirect_stdout(io.StringIO()):
+        trips = list(app.iter_trips(app.process_trips(fleet)))
+    paths = []
+    for trip_id, trip_data in trips:
+        path = os.path.join(folder, f"{trip_id}.pdf")
+        with open(path, 'wb') as f:
+            f.write(app.generate_pdf_report(trip_data, trip_id))
+        paths.append(path)
+    return paths
+
+
+def link_page():
+    """A one-page ReportLab PDF with a link to TRICKY_URI"""
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer)
+    pdf.drawString(72, 720, 'Link')
+    pdf.linkURL(TRICKY_URI, (72, 710, 200, 740))
+    pdf.showPage()
+    pdf.save()
+    return buffer.getvalue()
+
+
+def outline(merged):
+    """(title bytes, destination page number) of each outline entry"""
+    catalog, _ = merged.object(merged.root)
+    outlines = re.search(rb'/Outlines\s+(\d+)\s+0\s+R', catalog)
+    if outlines is None:
+        return []
+    entries = []
+    item = re.search(rb'/First\s+(\d+)\s+0\s+R', merged.object(int(outlines.group(1)))[0])
+    while item is not None:
+        body, _ = merged.object(int(item.group(1)))
+        title = re.search(rb'/Title\s+(\(.*?(?<!\\)\)|<[0-9A-F]*>)', body, re.S).group(1)
+        destination = re.search(rb'/Dest\s*\[\s*(\d+)\s+0\s+R', body).group(1)
+        entries.append((title, int(destination)))
+        item = re.search(rb'/Next\s+(\d+)\s+0\s+R', body)
+    return entries
+
+
+def check_round_trip(paths):
+    """Merge two reports and a tricky link page, then read the result back"""
+    documents = []
+    for path in paths[:2]:
+        with open(path, 'rb') as f:
+            documents.append(f.read())
+    documents.append(link_page())
+    titles = [f"Trip {i}" for i in range(len(documents) - 1)] + ['Link (5 0 R)']
+
+    output = io.BytesIO()
+    merger = PDFMerger(output)
+    page_counts = [merger.add(data, title) for data, title in zip(documents, titles)]
+    merger.close()
+    merged = SourcePDF(output.getvalue())
+
+    pages = merged.pages()
+    if len(pages) != sum(page_counts):
+        raise SystemExit(f"Round trip: {len(pages)} pages, expected {sum(page_counts)}")
+    for number in merged.offsets:
+        merged.object(number)
+    firsts = [pages[sum(page_counts[:i])] for i in range(len(page_counts))]
+    if outline(merged) != [(pdf_string(title), first) for title, first in zip(titles, firsts)]:
+        raise SystemExit('Round trip: outline titles or destinations differ from the merged PDFs')
+
+    uri = re.search(rb'/URI\s+(\(.*?(?<!\\)\))', documents[-1], re.S).group(1)
+    annotations = [body for body, _ in map(merged.object, merged.offsets) if b'/URI' in body]
+    if not annotations or any(uri not in body for body in annotations):
+        raise SystemExit('Round trip: the link URI was changed by the merge')
+
+
+def merge(paths, count, output, in_memory=False):
+    """Merge count PDFs (cycling through paths); returns (seconds, peak bytes)"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    with open(output, 'wb') as out:
+        merger = PDFMerger(out)
+        if in_memory:
+            documents = []
+            for i in range(count):
+                with open(paths[i % len(paths)], 'rb') as f:
+                    documents.append(f.read())
+            for i, data in enumerate(documents):
+                merger.add(data, f"Trip {i}")
+        else:
+            for i in range(count):
+                merger.add_file(paths[i % len(paths)], f"Trip {i}")
+        merger.close()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    # --trips takes several batch sizes here, replacing the generator's single one
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0], conflict_handler='resolve')
+    add_arguments(parser)
+    parser.set_defaults(pings=50)
+    parser.add_argument('--trips', type=int, nargs='+', default=[100, 1000],
+                        help='trips per merged PDF, one merge per value')
+    parser.add_argument('--distinct', type=int, default=20, help='distinct trip PDFs rendered and reused')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp(prefix='bench_merge_')
+    try:
+        paths = render_trips(args, folder)
+        check_round_trip(paths)
+        sizes = [os.path.getsize(path) for path in paths]
+        output = os.path.join(folder, 'merged.pdf')
+
+        print(f"{'trips':>6} {'seconds':>8} {'trips/s':>8} {'input MB':>9} {'output MB':>10} "
+              f"{'peak MB':>8} {'in-memory peak MB':>18}")
+        for count in args.trips:
+            seconds, peak = merge(paths, count, output)
+            _, in_memory_peak = merge(paths, count, output, in_memory=True)
+            input_bytes = sum(sizes[i % len(sizes)] for i in range(count))
+            print(f"{count:>6} {seconds:>8.2f} {count / seconds:>8.0f} {input_bytes / 1e6:>9.1f} "
+                  f"{os.path.getsize(output) / 1e6:>10.1f} {peak / 1e6:>8.1f} {in_memory_peak / 1e6:>18.1f}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Benchmark PDF rendering with the platypus Table against the canvas-drawn ping table.
+
+Run from the repository root:
+
+    python benchmarks/bench_pdf_report.py
+    python benchmarks/bench_pdf_report.py --sizes 1000 5000 20000 --table-max 5000
+
+For every size it renders the same synthetic trip both ways and prints the
+page count, timings and per-ping cost. The Table path re-measures the whole
+remaining table on every page break, so its per-ping cost grows with the
+trip; the canvas path stays flat.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BATCH_WORKER_THREAD', '0')
+
+import app  # noqa: E402
+from bench_process_trip_data import make_trip  # noqa: E402
+
+
+def make_processed_trip(ping_count):
+    trip = make_trip(ping_count)
+    trip['device_timestamp'] = trip['parsed_timestamp'].dt.strftime('%d/%m/%y %H:%M')
+    return app.process_trip_data(trip[['latitude', 'longitude', 'device_timestamp']])
+
+
+def render(trip_data, min_pings):
+    app.FAST_TABLE_MIN_PINGS = min_pings
+    start = time.perf_counter()
+    pdf = app.generate_pdf_report(trip_data, 1)
+    return time.perf_counter() - start, pdf.count(b'/Type /Page\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help='ping counts to benchmark')
+    parser.add_argument('--table-max', type=int, default=5000,
+                        help='skip the Table renderer above this many pings')
+    args = parser.parse_args()
+
+    render(make_processed_trip(10), 0)  # Decode the logo once, as a warm process would
+
+    print(f"{'pings':>8} {'pages':>6} {'table (s)':>10} {'canvas (s)':>11} {'canvas us/ping':>15} {'speedup':>8}")
+    for size in args.sizes:
+        trip_data = make_processed_trip(size)
+        fast_time, pages = render(trip_data, 0)
+        if size > args.table_max:
+            print(f"{size:>8} {pages:>6} {'skipped':>10} {fast_time:>11.2f} {fast_time / size * 1e6:>15.1f} {'-':>8}")
+            continue
+        table_time, _ = render(trip_data, size + 1)
+        print(f"{size:>8} {pages:>6} {table_time:>10.2f} {fast_time:>11.2f} {fast_time / size * 1e6:>15.1f} {table_time / fast_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
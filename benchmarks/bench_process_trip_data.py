@@ -0,0 +1,107 @@
+"""Benchmark the vectorized ping metrics against the original per-row loop.
+
+Run from the repository root:
+
+    python benchmarks/bench_process_trip_data.py
+    python benchmarks/bench_process_trip_data.py --sizes 1000 100000 1000000
+
+For every size it builds a synthetic trip (with repeated timestamps so the
+zero-duration path is exercised), checks that both implementations produce the
+same distance/duration/speed columns and prints the timings and speedup.
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import compute_ping_metrics, haversine_distance  # noqa: E402
+
+
+def make_trip(ping_count, seed=0):
+    """Build a sorted synthetic trip with roughly 10 minute ping spacing"""
+    rng = np.random.default_rng(seed)
+    steps = rng.choice([0, 60, 300, 600, 900], size=ping_count, p=[0.05, 0.1, 0.2, 0.5, 0.15])
+    steps[0] = 0
+    timestamps = pd.Timestamp('2025-02-04 12:00') + pd.to_timedelta(np.cumsum(steps), unit='s')
+    return pd.DataFrame({
+        'latitude': 13.7163 + np.cumsum(rng.normal(0, 0.01, ping_count)),
+        'longitude': 79.64074 + np.cumsum(rng.normal(0, 0.01, ping_count)),
+        'parsed_timestamp': timestamps,
+    })
+
+
+def legacy_metrics(df):
+    """The original df.iloc loop from process_trip_data"""
+    distances = []
+    durations = []
+    speeds = []
+
+    for i in range(len(df)):
+        if i == 0:
+            distances.append(0)
+            durations.append(0)
+            speeds.append(0)
+        else:
+            prev_row = df.iloc[i-1]
+            curr_row = df.iloc[i]
+
+            distance = haversine_distance(
+                prev_row['latitude'], prev_row['longitude'],
+                curr_row['latitude'], curr_row['longitude']
+            )
+            distances.append(distance)
+
+            time_diff = (curr_row['parsed_timestamp'] - prev_row['parsed_timestamp']).total_seconds() / 3600
+            durations.append(time_diff)
+
+            speeds.append(distance / time_diff if time_diff > 0 else 0)
+
+    return np.array(distances, dtype=float), np.array(durations, dtype=float), np.array(speeds, dtype=float)
+
+
+def vectorized_metrics(df):
+    return compute_ping_metrics(
+        df['latitude'].to_numpy(),
+        df['longitude'].to_numpy(),
+        df['parsed_timestamp'].to_numpy(dtype='datetime64[ns]')
+    )
+
+
+def timed(func, df):
+    start = time.perf_counter()
+    result = func(df)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000],
+                        help='ping counts to benchmark')
+    parser.add_argument('--legacy-max', type=int, default=None,
+                        help='skip the legacy loop above this many pings (it takes minutes at 1M)')
+    args = parser.parse_args()
+
+    print(f"{'pings':>10} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>10}")
+    for size in args.sizes:
+        df = make_trip(size)
+        fast, fast_time = timed(vectorized_metrics, df)
+
+        if args.legacy_max is not None and size > args.legacy_max:
+            print(f"{size:>10} {'skipped':>12} {fast_time:>15.4f} {'-':>10}")
+            continue
+
+        slow, slow_time = timed(legacy_metrics, df)
+        for name, expected, actual in zip(['distance', 'duration', 'speed'], slow, fast):
+            if not np.allclose(expected, actual, rtol=1e-12, atol=0):
+                raise SystemExit(f"Parity check failed for {name} at {size} pings")
+
+        print(f"{size:>10} {slow_time:>12.4f} {fast_time:>15.4f} {slow_time / fast_time:>9.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Benchmark rendering batches of short trips with and without the report template.
+
+Run from the repository root:
+
+    python benchmarks/bench_report_template.py
+    python benchmarks/bench_report_template.py --trips 1000 --pings 20
+    python benchmarks/bench_report_template.py --trips 200 --pings 5 50 200
+
+Trips come from a synthetic fleet (benchmarks/synthetic.py, whose generator
+options are accepted here), rendered one PDF each with generate_pdf_report.
+The per-report layout it is compared against is the one the template
+replaced: the full-size logo opened and decoded again for every PDF, and the
+header and ping tables laid out as platypus Tables. For every
+trip length it prints the time per PDF, PDFs per second and the speedup,
+which is largest where the fixed per-PDF cost dominates.
+"""
+import argparse
+import contextlib
+import copy
+import io
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('BATCH_WORKER_THREAD', '0')
+
+from reportlab.lib.units import inch  # noqa: E402
+from reportlab.platypus import Image, Table, TableStyle  # noqa: E402
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app  # noqa: E402
+from synthetic import add_arguments, fleet_from_args  # noqa: E402
+
+# The header layout HeaderBlock reproduces
+HEADER_TABLE_STYLE = TableStyle([
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTNAME', (1, 0), (1, -1), 'Helvetica'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+])
+
+
+def table_header(rows):
+    table = Table(rows, colWidths=app.HEADER_TABLE_COL_WIDTHS)
+    table.setStyle(HEADER_TABLE_STYLE)
+    return table
+
+
+@contextlib.contextmanager
+def per_report_layout():
+    """Render as before the template: a decoded logo copied per report, Tables for header and pings"""
+    logo = Image(app.LOGO_PATH, width=2*inch, height=0.8*inch)
+    logo.hAlign = 'LEFT'
+    logo._img.getRGBData()
+    saved = app.report_logo, app.HeaderBlock, app.FAST_TABLE_MIN_PINGS
+    app.report_logo, app.HeaderBlock, app.FAST_TABLE_MIN_PINGS = lambda: copy.copy(logo), table_header, sys.maxsize
+    try:
+        yield
+    finally:
+        app.report_logo, app.HeaderBlock, app.FAST_TABLE_MIN_PINGS = saved
+
+
+def render_all(trips):
+    start = time.perf_counter()
+    for trip_id, trip_data in trips:
+        app.generate_pdf_report(trip_data, trip_id)
+    return time.perf_counter() - start
+
+
+def main():
+    # --pings takes several trip lengths here, replacing the generator's single one
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0], conflict_handler='resolve')
+    add_arguments(parser)
+    parser.set_defaults(trips=200)
+    parser.add_argument('--pings', type=int, nargs='+', default=[5, 20, 100],
+                        help='pings per trip, one batch per value')
+    args = parser.parse_args()
+
+    print(f"{'pings':>6} {'trips':>6} {'per-report ms/pdf':>18} {'template ms/pdf':>16} "
+          f"{'template pdf/s':>15} {'speedup':>8}")
+    for pings in args.pings:
+        fleet = fleet_from_args(argparse.Namespace(**{**vars(args), 'pings': pings}))
+        with contextlib.redirect_stdout(io.StringIO()):
+            trips = list(app.iter_trips(app.process_trips(fleet)))
+
+        # One warm-up report each, so both sides start from a decoded logo and a built template
+        with per_report_layout():
+            render_all(trips[:1])
+            baseline = render_all(trips)
+        render_all(trips[:1])
+        templated = render_all(trips)
+
+        count = len(trips)
+        print(f"{pings:>6} {count:>6} {baseline / count * 1000:>18.2f} {templated / count * 1000:>16.2f} "
+              f"{count / templated:>15.0f} {baseline / templated:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
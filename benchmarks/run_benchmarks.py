@@ -0,0 +1,249 @@
+"""Time each processing stage and the Flask endpoints on a synthetic fleet file.
+
+Run from the repository root:
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --trips 200 --pings 500 --bad-rows 0.01 --repeat 5
+    python benchmarks/run_benchmarks.py --compare benchmarks/results/<older commit>.json
+
+The fleet file is generated with benchmarks/synthetic.py (the generator
+options are accepted here too). Stages:
+
+    read_file              pd.read_csv / pd.read_excel of the whole upload
+    read_excel_columns     the read-only streaming reader (--excel only)
+    parse_timestamp        the per-value parser, over --scalar-rows values
+    parse_timestamp_column the bulk parser, over the whole column
+    process_trip_data      every trip processed on its own
+    process_trips          all trips in one pass
+    generate_pdf_report    --pdf-trips reports rendered from processed data
+    endpoint_upload        POST /upload
+    endpoint_fleet_analytics         GET /fleet-analytics by trip and day, over the uploaded fleet
+    endpoint_generate_report         POST /generate-report for one trip (cold cache)
+    endpoint_generate_report_cached  the same request again (PDF cache hit)
+    endpoint_batch         POST /generate-batch-reports, drained until complete
+
+Each stage runs --repeat times; the minimum and median are reported. Results
+go to a JSON file named after the current commit so runs can be compared.
+
+CSV runs first check that /upload still succeeds when it streams the file
+in small chunks and a later trip has a latitude that isn't a number (the
+reader switches to text coordinates after frames were already stored).
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep benchmark batches and PDFs out of the app's own store and cache
+WORK_DIR = tempfile.mkdtemp(prefix='bench_suite_')
+os.environ['JOB_STORE_URL'] = 'sqlite:///' + os.path.join(WORK_DIR, 'jobs.db')
+os.environ['BATCH_WORKER_THREAD'] = '0'
+os.environ['FLEET_DB'] = os.path.join(WORK_DIR, 'fleet.db')
+
+with contextlib.redirect_stdout(io.StringIO()):
+    import app  # noqa: E402
+from pdf_cache import PDFCache  # noqa: E402
+from synthetic import add_arguments, fleet_from_args, write_fleet  # noqa: E402
+
+
+def fresh_pdf_cache():
+    """Point the app at an empty PDF cache so renders aren't served from disk"""
+    folder = tempfile.mkdtemp(prefix='pdfs_', dir=WORK_DIR)
+    app.pdf_cache = PDFCache(folder, app.PDF_CACHE_MAX_BYTES, app.PDF_CACHE_MAX_AGE_SECONDS)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def measure(name, func, repeat, rows, setup=None):
+    """Run func repeat times (after setup, untimed) and summarize the timings"""
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    result = {
+        'stage': name,
+        'runs': repeat,
+        'min_seconds': round(best, 6),
+        'median_seconds': round(statistics.median(timings), 6),
+        'rows': rows,
+        'rows_per_second': round(rows / best, 1) if best > 0 else None,
+    }
+    print(f"{name:<34} {result['min_seconds']:>10.4f} {result['median_seconds']:>10.4f} {rows:>10} "
+          f"{result['rows_per_second'] or 0:>14.0f}")
+    return result
+
+
+def post_file(client, url, path, **form):
+    with open(path, 'rb') as f:
+        response = client.post(url, data={'file': (f, os.path.basename(path)), **form})
+    if response.status_code != 200:
+        raise SystemExit(f"{url} returned {response.status_code}: {response.get_data(as_text=True)[:300]}")
+    data = response.get_data()
+    response.close()
+    return data
+
+
+def run_batch(client, path):
+    batch_id = json.loads(post_file(client, '/generate-batch-reports', path))['batch_id']
+    app.run_batch_worker(until_idle=True)
+    status = client.get(f'/batch-status/{batch_id}').get_json()
+    app.cleanup_old_files(batch_id)
+    if status['status'] != 'completed':
+        raise SystemExit(f"Batch ended {status['status']}: {status['error']}")
+
+
+def check_streamed_upload(client, df):
+    """POST /upload streamed in quarter-trip chunks, with a non-numeric latitude in the last trip"""
+    if df['trip_id'].nunique() < 2:
+        return
+    df = df.astype({'latitude': object})
+    df.loc[df.index[-1], 'latitude'] = 'not a number'
+    path = write_fleet(os.path.join(WORK_DIR, 'fleet_text_coordinates.csv'), df)
+    chunk_rows = max(1, len(df) // (4 * df['trip_id'].nunique()))
+    saved = app.STREAMING_MIN_BYTES, app.CSV_CHUNK_ROWS
+    app.STREAMING_MIN_BYTES, app.CSV_CHUNK_ROWS = 0, chunk_rows
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            post_file(client, '/upload', path)
+    finally:
+        app.STREAMING_MIN_BYTES, app.CSV_CHUNK_ROWS = saved
+    print(f"Streamed upload with a non-numeric latitude ({chunk_rows}-row chunks): ok\n")
+
+
+def run_stages(path, args):
+    read = (lambda: pd.read_excel(path)) if path.endswith('.xlsx') else (lambda: pd.read_csv(path))
+    uploaded = read()
+    rows = len(uploaded)
+    trip_ids = uploaded['trip_id'].dropna().unique()
+    trips = [group for _, group in uploaded.groupby('trip_id', sort=False)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        processed = dict(app.iter_trips(app.process_trips(uploaded)))
+    pdf_trips = [processed[trip_id] for trip_id in list(processed)[:args.pdf_trips]]
+    pdf_rows = sum(len(trip) for trip in pdf_trips)
+    scalar_values = uploaded['device_timestamp'].head(args.scalar_rows).tolist()
+    report_trip = str(int(trip_ids[0]))
+    report_rows = int((uploaded['trip_id'] == trip_ids[0]).sum())
+    client = app.app.test_client()
+
+    print(f"{'stage':<34} {'min (s)':>10} {'median (s)':>10} {'rows':>10} {'rows/s':>14}")
+    results = [measure('read_file', read, args.repeat, rows)]
+    if path.endswith('.xlsx'):
+        results.append(measure('read_excel_columns', lambda: app.read_excel_columns(path), args.repeat, rows))
+    results += [
+        measure('parse_timestamp', lambda: [app.parse_timestamp(value) for value in scalar_values],
+                args.repeat, len(scalar_values)),
+        measure('parse_timestamp_column', lambda: app.parse_timestamp_column(uploaded['device_timestamp']),
+                args.repeat, rows),
+        measure('process_trip_data', lambda: [app.process_trip_data(trip) for trip in trips if len(trip) >= 2],
+                args.repeat, rows),
+        measure('process_trips', lambda: app.process_trips(uploaded), args.repeat, rows),
+        measure('generate_pdf_report', lambda: [app.generate_pdf_report(trip, 1) for trip in pdf_trips],
+                args.repeat, pdf_rows),
+        measure('endpoint_upload', lambda: post_file(client, '/upload', path), args.repeat, rows),
+        measure('endpoint_fleet_analytics', lambda: client.get('/fleet-analytics?group_by=trip,day').get_data(),
+                args.repeat, rows),
+        measure('endpoint_generate_report', lambda: post_file(client, '/generate-report', path, trip_id=report_trip),
+                args.repeat, report_rows, setup=fresh_pdf_cache),
+        measure('endpoint_generate_report_cached',
+                lambda: post_file(client, '/generate-report', path, trip_id=report_trip),
+                args.repeat, report_rows),
+    ]
+    if not args.skip_batch:
+        results.append(measure('endpoint_batch', lambda: run_batch(client, path), args.repeat, rows,
+                               setup=fresh_pdf_cache))
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {result['stage']: result for result in json.load(f)['results']}
+
+    print(f"\nCompared with {baseline_path} (ratio > 1 is slower)")
+    print(f"{'stage':<34} {'before (s)':>10} {'after (s)':>10} {'ratio':>8}")
+    for result in results:
+        before = baseline.get(result['stage'])
+        if before is None:
+            continue
+        ratio = result['min_seconds'] / before['min_seconds'] if before['min_seconds'] else float('nan')
+        print(f"{result['stage']:<34} {before['min_seconds']:>10.4f} {result['min_seconds']:>10.4f} {ratio:>7.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--excel', action='store_true', help='benchmark an .xlsx upload instead of CSV')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage')
+    parser.add_argument('--scalar-rows', type=int, default=20000,
+                        help='values timed through the per-value parse_timestamp')
+    parser.add_argument('--pdf-trips', type=int, default=3, help='trips rendered in generate_pdf_report')
+    parser.add_argument('--skip-batch', action='store_true', help='skip the batch endpoint')
+    parser.add_argument('--output', help='results file (default benchmarks/results/<commit>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    args = parser.parse_args()
+
+    commit = git_commit()
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f'{commit}.json')
+
+    try:
+        df = fleet_from_args(args)
+        path = write_fleet(os.path.join(WORK_DIR, 'fleet.xlsx' if args.excel else 'fleet.csv'), df)
+        print(f"{args.trips} trips x {args.pings} pings ({len(df)} rows), commit {commit}, {os.cpu_count()} CPUs\n")
+
+        fresh_pdf_cache()
+        if not args.excel:
+            check_streamed_upload(app.app.test_client(), df)
+        results = run_stages(path, args)
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    report = {
+        'commit': commit,
+        'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+        },
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'results': results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
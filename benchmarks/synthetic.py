@@ -0,0 +1,145 @@
+"""Generate synthetic fleet trip files shaped like the Trip Tracker export.
+
+Run from the repository root:
+
+    python benchmarks/synthetic.py fleet.csv
+    python benchmarks/synthetic.py fleet.xlsx --trips 50 --pings 400 --formats dmy iso --bad-rows 0.01
+
+Every trip is a truck moving along a random heading at highway speeds with
+stops along the way, pinging about every ten minutes. Each trip uses one of
+the requested timestamp formats (in turn), rows carry the same trip
+metadata columns as the sample export, and a fraction of rows can be
+corrupted to exercise the rejection paths.
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Timestamp layouts seen in exports, by short name
+TIMESTAMP_LAYOUTS = {
+    'dmy': '%d/%m/%y %H:%M',
+    'mdy': '%m/%d/%y %H:%M',
+    'dmY': '%d/%m/%Y %H:%M',
+    'iso': '%Y-%m-%d %H:%M:%S',
+    'dmy-seconds': '%d/%m/%y %H:%M:%S',
+}
+
+# Rough bounding box of southern India, where the sample trips run
+LATITUDE_RANGE = (8.5, 20.0)
+LONGITUDE_RANGE = (74.0, 84.0)
+
+KM_PER_DEGREE = 111.32
+
+
+def corrupt_rows(df, fraction, rng):
+    """Break a fraction of rows in the ways real exports do"""
+    bad = np.flatnonzero(rng.random(len(df)) < fraction)
+    if not len(bad):
+        return df
+
+    kinds = rng.integers(0, 4, size=len(bad))
+    df.loc[df.index[bad[kinds == 0]], 'device_timestamp'] = ''
+    df.loc[df.index[bad[kinds == 1]], 'device_timestamp'] = 'not a time'
+    df.loc[df.index[bad[kinds == 2]], 'latitude'] = np.nan
+    df.loc[df.index[bad[kinds == 3]], 'device_timestamp'] = '31/31/31 31:31'
+    return df
+
+
+def generate_fleet(trips=20, pings=300, formats=('dmy',), interval_seconds=600, jitter_seconds=120,
+                   bad_rows=0.0, shuffle=False, seed=0, first_trip_id=34000000):
+    """Build a multi-trip upload frame
+
+    jitter_seconds spreads each ping interval uniformly by up to that many
+    seconds either way (never below one second). bad_rows is the fraction
+    of rows to corrupt. With shuffle the rows of all trips are interleaved,
+    as in exports sorted by time rather than by trip.
+    """
+    rng = np.random.default_rng(seed)
+    frames = []
+    start = pd.Timestamp('2025-02-01 06:00')
+
+    for number in range(trips):
+        trip_id = first_trip_id + number
+        layout = TIMESTAMP_LAYOUTS[formats[number % len(formats)]]
+
+        # Ping spacing with jitter, and stops where the truck doesn't move
+        gaps = interval_seconds + rng.uniform(-jitter_seconds, jitter_seconds, pings)
+        gaps = np.maximum(gaps, 1)
+        gaps[0] = 0
+        offsets = np.cumsum(gaps)
+        moving = rng.random(pings) > 0.2
+        speeds_kmh = np.where(moving, rng.normal(45, 15, pings).clip(5, 90), 0)
+
+        heading = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.15, pings))
+        step_km = speeds_kmh * gaps / 3600
+        latitude0 = rng.uniform(*LATITUDE_RANGE)
+        longitude0 = rng.uniform(*LONGITUDE_RANGE)
+        latitudes = latitude0 + np.cumsum(step_km * np.cos(heading)) / KM_PER_DEGREE
+        longitudes = longitude0 + np.cumsum(step_km * np.sin(heading)) / (KM_PER_DEGREE * np.cos(np.radians(latitude0)))
+
+        trip_start = start + pd.Timedelta(hours=int(rng.integers(0, 24 * 14)))
+        timestamps = trip_start + pd.to_timedelta(offsets, unit='s')
+        trip_end = timestamps[-1] + pd.Timedelta(hours=int(rng.integers(1, 48)))
+
+        frames.append(pd.DataFrame({
+            'latitude': latitudes.round(5),
+            'longitude': longitudes.round(5),
+            'device_timestamp': timestamps.strftime(layout),
+            'trip_id': trip_id,
+            'trip_created_at': (trip_start - pd.Timedelta(minutes=int(rng.integers(5, 240)))).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'trip_closed_at': trip_end.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'Invoice Number': f"TN/24-25/{number + 1:07d}",
+        }))
+
+    df = pd.concat(frames, ignore_index=True)
+    if shuffle:
+        df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+    if bad_rows:
+        df = corrupt_rows(df, bad_rows, rng)
+    return df
+
+
+def write_fleet(path, df):
+    """Write a fleet frame as CSV or Excel, by file extension"""
+    if path.endswith('.xlsx'):
+        df.to_excel(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def add_arguments(parser):
+    """Generator options shared with the benchmark runner"""
+    parser.add_argument('--trips', type=int, default=20, help='number of trips')
+    parser.add_argument('--pings', type=int, default=300, help='pings per trip')
+    parser.add_argument('--formats', nargs='+', default=['dmy'], choices=sorted(TIMESTAMP_LAYOUTS),
+                        help='timestamp layouts, assigned to trips in turn')
+    parser.add_argument('--interval', type=int, default=600, help='seconds between pings')
+    parser.add_argument('--jitter', type=int, default=120, help='max seconds each interval varies by')
+    parser.add_argument('--bad-rows', type=float, default=0.0, help='fraction of rows to corrupt')
+    parser.add_argument('--shuffle', action='store_true', help='interleave the rows of all trips')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+
+
+def fleet_from_args(args):
+    return generate_fleet(
+        trips=args.trips, pings=args.pings, formats=args.formats,
+        interval_seconds=args.interval, jitter_seconds=args.jitter,
+        bad_rows=args.bad_rows, shuffle=args.shuffle, seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('output', help='file to write (.csv or .xlsx)')
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    df = fleet_from_args(args)
+    write_fleet(args.output, df)
+    print(f"Wrote {len(df)} rows ({args.trips} trips) to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+import math
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+import numpy as np
+import pandas as pd
+
+# Speed histograms of moving intervals: SPEED_BIN_KMH wide bins, the last one open-ended
+SPEED_BIN_KMH = 2
+SPEED_BINS = 80
+
+# Query dimensions and the trip_days column (or day bucket) each one groups by
+GROUP_COLUMNS = {
+    'day': 'day',
+    'week': 'week',
+    'month': 'month',
+    'vehicle': 'vehicle',
+    'route': 'route',
+    'invoice': 'invoice_number',
+    'trip': 'trip_id',
+    'upload': 'upload_id',
+    'created_day': 'created_day',
+    'closed_day': 'closed_day'
+}
+
+# Exact-match filters and the column each one applies to
+FILTER_COLUMNS = {
+    'trip_id': 'trip_id',
+    'vehicle': 'vehicle',
+    'route': 'route',
+    'invoice': 'invoice_number',
+    'upload_id': 'upload_id'
+}
+
+# Date ranges (YYYY-MM-DD, inclusive) and the trip time column each one bounds
+RANGE_COLUMNS = {
+    'created': 'trip_created_at',
+    'closed': 'trip_closed_at'
+}
+
+# Trip-level fields added to every group when grouping by trip
+TRIP_FIELDS = ['trip_created_at', 'trip_closed_at']
+
+TRIP_DAY_COLUMNS = ['trip_id', 'day', 'vehicle', 'invoice_number', 'route', 'trip_created_at', 'trip_closed_at',
+                    'upload_id', 'ping_count', 'distance_km', 'moving_distance_km', 'moving_hours', 'idle_hours',
+                    'max_speed_kmh', 'speed_histogram']
+
+
+def speed_histograms(groups, speeds, group_count):
+    """Per-group counts of speeds in SPEED_BINS bins, as a (group_count, SPEED_BINS) array"""
+    bins = np.minimum((np.asarray(speeds) // SPEED_BIN_KMH).astype(np.int64), SPEED_BINS - 1)
+    counts = np.bincount(np.asarray(groups) * SPEED_BINS + bins, minlength=group_count * SPEED_BINS)
+    return counts.reshape(group_count, SPEED_BINS)
+
+
+def histogram_percentiles(counts, percentiles):
+    """Percentiles of binned speed distributions (one per row of counts), interpolated within the bin
+
+    Returns a (rows, len(percentiles)) array, NaN for rows without speeds.
+    """
+    counts = np.asarray(counts, dtype=float)
+    cumulative = np.cumsum(counts, axis=1)
+    totals = cumulative[:, -1]
+    rows = np.arange(len(counts))
+    result = np.full((len(counts), len(percentiles)), np.nan)
+    for column, p in enumerate(percentiles):
+        rank = totals * p / 100
+        index = np.minimum((cumulative < rank[:, None]).sum(axis=1), SPEED_BINS - 1)
+        below = np.where(index > 0, cumulative[rows, index - 1], 0)
+        in_bin = counts[rows, index]
+        fraction = np.divide(rank - below, in_bin, out=np.zeros(len(counts)), where=in_bin > 0)
+        result[:, column] = np.where(totals > 0, (index + fraction) * SPEED_BIN_KMH, np.nan)
+    return result
+
+
+class FleetStore:
+    """Per-trip, per-day aggregates of processed uploads, in SQLite
+
+    Every processed trip is reduced to one row per day it has pings on:
+    distance, moving and idle hours, top speed and a histogram of moving
+    speeds, along with the trip's vehicle, invoice, route and creation and
+    closing times (ISO 8601 text, when the upload has them). Fleet queries
+    then group and sum these rows instead of reading pings again, and
+    histograms from many rows add up to exact binned speed percentiles.
+    A trip recorded again (re-uploaded) replaces its earlier rows.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS trip_days (
+            trip_id TEXT NOT NULL,
+            day TEXT NOT NULL,
+            vehicle TEXT,
+            invoice_number TEXT,
+            route TEXT,
+            trip_created_at TEXT,
+            trip_closed_at TEXT,
+            upload_id TEXT,
+            ping_count INTEGER NOT NULL,
+            distance_km REAL NOT NULL,
+            moving_distance_km REAL NOT NULL,
+            moving_hours REAL NOT NULL,
+            idle_hours REAL NOT NULL,
+            max_speed_kmh REAL NOT NULL,
+            speed_histogram BLOB NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (trip_id, day)
+        );
+        CREATE INDEX IF NOT EXISTS trip_days_by_day ON trip_days (day);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def record(self, trip_days):
+        """Store a frame of TRIP_DAY_COLUMNS rows, replacing the earlier rows of its trips
+
+        speed_histogram holds each row's SPEED_BINS counts as an array.
+        """
+        if len(trip_days) == 0:
+            return 0
+        trip_days = trip_days.astype({'trip_id': str})
+        now = time.time()
+        rows = [
+            tuple(None if pd.isna(value) else value.item() if isinstance(value, np.generic) else value
+                  for value in row[:-1]) +
+            (np.asarray(row[-1], dtype=np.int32).tobytes(), now)
+            for row in trip_days[TRIP_DAY_COLUMNS].itertuples(index=False, name=None)
+        ]
+        with self._transaction() as conn:
+            conn.executemany('DELETE FROM trip_days WHERE trip_id = ?',
+                             [(trip_id,) for trip_id in trip_days['trip_id'].unique()])
+            conn.executemany(
+                f"""INSERT INTO trip_days ({', '.join(TRIP_DAY_COLUMNS)}, updated_at)
+                    VALUES ({', '.join('?' * (len(TRIP_DAY_COLUMNS) + 1))})""",
+                rows
+            )
+        return len(rows)
+
+    def query(self, group_by=('day',), start=None, end=None, filters=None, percentiles=(50, 90, 99), ranges=None):
+        """Fleet rollups grouped by GROUP_COLUMNS dimensions, as a list of dicts
+
+        start and end (YYYY-MM-DD, inclusive) bound the days included, and
+        filters maps FILTER_COLUMNS names to the value rows must have.
+        ranges maps RANGE_COLUMNS names to (from, to) pairs of dates (either
+        may be None) bounding the day a trip was created or closed; trips
+        without that time are left out. Each group reports its trip count,
+        pings, distance, moving and idle hours, moving average speed, top
+        speed and moving speed percentiles, plus the TRIP_FIELDS when grouped
+        by trip. Groups are sorted by their keys.
+        """
+        unknown = [name for name in group_by if name not in GROUP_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown group_by {unknown}, expected some of {list(GROUP_COLUMNS)}")
+        filters = {name: value for name, value in (filters or {}).items() if value is not None}
+        unknown = [name for name in filters if name not in FILTER_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown filters {unknown}, expected some of {list(FILTER_COLUMNS)}")
+        ranges = ranges or {}
+        unknown = [name for name in ranges if name not in RANGE_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unknown ranges {unknown}, expected some of {list(RANGE_COLUMNS)}")
+
+        conditions, params = [], []
+        if start:
+            conditions.append('day >= ?')
+            params.append(start)
+        if end:
+            conditions.append('day <= ?')
+            params.append(end)
+        for name, value in filters.items():
+            conditions.append(f"{FILTER_COLUMNS[name]} = ?")
+            params.append(str(value))
+        for name, (range_start, range_end) in ranges.items():
+            if range_start:
+                conditions.append(f"substr({RANGE_COLUMNS[name]}, 1, 10) >= ?")
+                params.append(range_start)
+            if range_end:
+                conditions.append(f"substr({RANGE_COLUMNS[name]}, 1, 10) <= ?")
+                params.append(range_end)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+        with closing(self._connect()) as conn:
+            rows = pd.read_sql_query(
+                f"""SELECT trip_id, day, vehicle, invoice_number, route, trip_created_at, trip_closed_at, upload_id,
+                           ping_count, distance_km, moving_distance_km, moving_hours, idle_hours, max_speed_kmh,
+                           speed_histogram
+                    FROM trip_days {where}""",
+                conn, params=params
+            )
+        if len(rows) == 0:
+            return []
+
+        days = pd.to_datetime(rows['day'])
+        rows['week'] = (days - pd.to_timedelta(days.dt.weekday, unit='D')).dt.strftime('%Y-%m-%d')
+        rows['month'] = rows['day'].str[:7]
+        rows['created_day'] = rows['trip_created_at'].str[:10]
+        rows['closed_day'] = rows['trip_closed_at'].str[:10]
+        # Trips without a vehicle column count as their own vehicle
+        rows['vehicle'] = rows['vehicle'].fillna('trip:' + rows['trip_id'])
+        rows['all'] = 0
+
+        keys = [GROUP_COLUMNS[name] for name in group_by] or ['all']
+        trip_fields = TRIP_FIELDS if 'trip' in group_by else []
+        grouped = rows.groupby(keys, sort=True, dropna=False)
+        totals = grouped.agg(
+            trips=('trip_id', 'nunique'),
+            ping_count=('ping_count', 'sum'),
+            distance_km=('distance_km', 'sum'),
+            moving_distance_km=('moving_distance_km', 'sum'),
+            moving_hours=('moving_hours', 'sum'),
+            idle_hours=('idle_hours', 'sum'),
+            max_speed_kmh=('max_speed_kmh', 'max'),
+            **{name: (name, 'first') for name in trip_fields}
+        )
+        histograms = np.frombuffer(b''.join(rows['speed_histogram']), dtype=np.int32).reshape(len(rows), SPEED_BINS)
+        codes = grouped.ngroup().to_numpy()
+        order = np.argsort(codes, kind='stable')
+        group_starts = np.searchsorted(codes[order], np.arange(len(totals)))
+        group_histograms = np.add.reduceat(histograms[order].astype(np.int64), group_starts)
+
+        speed_percentiles = histogram_percentiles(group_histograms, percentiles).tolist()
+        results = []
+        for code, (key, total) in enumerate(zip(totals.index, totals.itertuples(index=False))):
+            key = key if isinstance(key, tuple) else (key,)
+            results.append({
+                **{name: (None if pd.isna(value) else value) for name, value in zip(group_by, key)},
+                'trips': int(total.trips),
+                'ping_count': int(total.ping_count),
+                'distance_km': float(total.distance_km),
+                'moving_hours': float(total.moving_hours),
+                'idle_hours': float(total.idle_hours),
+                'moving_avg_speed': float(total.moving_distance_km / total.moving_hours)
+                if total.moving_hours > 0 else 0.0,
+                'max_speed_kmh': float(total.max_speed_kmh),
+                'speed_percentiles_kmh': {
+                    f"p{p:g}": (None if math.isnan(value) else value)
+                    for p, value in zip(percentiles, speed_percentiles[code])
+                },
+                **{name: (None if pd.isna(getattr(total, name)) else getattr(total, name)) for name in trip_fields}
+            })
+        return results
@@ -113,39 +113,100 @@ function App() {
     }
   };
 
-  // Poll batch status when batch processing starts
+  // Follow batch progress once processing starts: Server-Sent Events where
+  // the browser supports them, otherwise polling for new PDFs by offset
   useEffect(() => {
+    if (!batchId) return undefined;
+
+    let totalTrips = 0;
+    let completedTrips = 0;
+    let finished = false;
+    let source;
     let interval;
-    
-    if (batchId && batchStatus !== 'completed' && batchStatus !== 'error') {
+
+    setBatchStatus('processing');
+
+    const updateProgress = () => {
+      setProgress(totalTrips > 0 ? (completedTrips / totalTrips) * 100 : 0);
+    };
+
+    const finish = (status, message) => {
+      finished = true;
+      setBatchStatus(status);
+      setLoading(false);
+      if (status === 'completed') {
+        setUploadStatus('All PDF reports generated successfully!');
+      } else if (status === 'error') {
+        setError(message || 'Error generating reports');
+      } else if (status === 'cancelled') {
+        setUploadStatus('Batch cancelled');
+      }
+    };
+
+    if (window.EventSource) {
+      source = new EventSource(`/batch-events/${batchId}`);
+
+      source.addEventListener('batch_started', (event) => {
+        totalTrips = JSON.parse(event.data).total_trips;
+        updateProgress();
+      });
+
+      source.addEventListener('trip_completed', (event) => {
+        const pdf = JSON.parse(event.data);
+        completedTrips += 1;
+        setCompletedPdfs((pdfs) => [...pdfs, pdf]);
+        updateProgress();
+      });
+
+      source.addEventListener('batch_done', (event) => {
+        const data = JSON.parse(event.data);
+        source.close();
+        totalTrips = data.total_trips;
+        completedTrips = data.completed_trips;
+        updateProgress();
+        finish(data.status, data.error);
+      });
+
+      // The browser reconnects on its own (resuming from the last event ID)
+      // unless the stream was closed for good
+      source.onerror = () => {
+        if (!finished && source.readyState === EventSource.CLOSED) {
+          setError('Error checking batch status');
+          setLoading(false);
+        }
+      };
+    } else {
+      let offset = 0;
       interval = setInterval(async () => {
         try {
-          const response = await axios.get(`/batch-status/${batchId}`);
+          const response = await axios.get(`/batch-status/${batchId}`, { params: { offset } });
           const data = response.data;
-          
-          setBatchStatus(data.status);
-          setProgress(data.progress);
-          setCompletedPdfs(data.pdfs);
-          
-          if (data.status === 'completed') {
-            setLoading(false);
-            setUploadStatus('All PDF reports generated successfully!');
-          } else if (data.status === 'error') {
-            setLoading(false);
-            setError(data.error || 'Error generating reports');
+
+          offset = data.next_offset;
+          totalTrips = data.total_trips;
+          completedTrips = data.completed_trips;
+          if (data.pdfs.length > 0) {
+            setCompletedPdfs((pdfs) => [...pdfs, ...data.pdfs]);
+          }
+          updateProgress();
+
+          if (data.status !== 'processing') {
+            clearInterval(interval);
+            finish(data.status, data.error);
           }
-          
         } catch (err) {
+          clearInterval(interval);
           setError('Error checking batch status');
           setLoading(false);
         }
       }, 1000); // Poll every second
     }
-    
+
     return () => {
+      if (source) source.close();
       if (interval) clearInterval(interval);
     };
-  }, [batchId, batchStatus]);
+  }, [batchId]);
 
   return (
     <div className="App">
@@ -232,6 +293,13 @@ function App() {
             {completedPdfs.length > 0 && (
               <div className="completed-reports">
                 <h3>Generated Reports ({completedPdfs.length})</h3>
+                {/* A plain link lets the browser stream the ZIP to disk */}
+                <a
+                  href={`/download-batch/${batchId}`}
+                  className="download-button download-all-button"
+                >
+                  Download All Reports (ZIP)
+                </a>
                 <div className="reports-grid">
                   {completedPdfs.map((report, index) => (
                     <div key={index} className="report-card">
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import math
+
+import numpy as np
+import pandas as pd
+
+# Metres per degree of latitude
+METRES_PER_DEGREE = 111320.0
+
+
+def read_sites(path, default_radius_m):
+    """Sites from a CSV or GeoJSON file, as a frame of site_id, name, type, latitude, longitude, radius_m
+
+    CSV files need latitude and longitude columns; site_id, name, type and
+    radius_m are optional. GeoJSON Point features take the same fields from
+    their properties. Polygon features are matched as a circle around the
+    mean of their outer ring's vertices that reaches the farthest vertex.
+    """
+    if path.lower().endswith(('.geojson', '.json')):
+        with open(path) as f:
+            features = json.load(f).get('features', [])
+        records = []
+        for feature in features:
+            geometry = feature.get('geometry') or {}
+            properties = feature.get('properties') or {}
+            if geometry.get('type') == 'Point':
+                longitude, latitude = geometry['coordinates'][:2]
+                radius_m = properties.get('radius_m')
+            elif geometry.get('type') == 'Polygon':
+                ring = np.asarray(geometry['coordinates'][0], dtype=float)
+                longitude, latitude = ring[:, 0].mean(), ring[:, 1].mean()
+                scale = math.cos(math.radians(latitude))
+                offsets = np.hypot((ring[:, 0] - longitude) * scale, ring[:, 1] - latitude)
+                radius_m = float(offsets.max() * METRES_PER_DEGREE)
+            else:
+                continue
+            records.append({
+                'site_id': properties.get('site_id', feature.get('id')),
+                'name': properties.get('name'),
+                'type': properties.get('type'),
+                'latitude': latitude,
+                'longitude': longitude,
+                'radius_m': radius_m
+            })
+        sites = pd.DataFrame(records, columns=['site_id', 'name', 'type', 'latitude', 'longitude', 'radius_m'])
+    else:
+        sites = pd.read_csv(path)
+        missing_columns = [col for col in ['latitude', 'longitude'] if col not in sites.columns]
+        if missing_columns:
+            raise ValueError(f"Missing required columns in {path}: {missing_columns}")
+        for column in ['site_id', 'name', 'type', 'radius_m']:
+            if column not in sites.columns:
+                sites[column] = None
+
+    sites['latitude'] = pd.to_numeric(sites['latitude'], errors='coerce')
+    sites['longitude'] = pd.to_numeric(sites['longitude'], errors='coerce')
+    sites['radius_m'] = pd.to_numeric(sites['radius_m'], errors='coerce').fillna(default_radius_m)
+    sites = sites.dropna(subset=['latitude', 'longitude']).reset_index(drop=True)
+    sites['site_id'] = sites['site_id'].where(sites['site_id'].notna(), pd.Series(sites.index, dtype=object))
+    sites['name'] = sites['name'].where(sites['name'].notna(), sites['site_id'].astype(str))
+    return sites
+
+
+class GeofenceIndex:
+    """Circular geofences in a grid index, queried with whole arrays of points
+
+    Sites are bucketed into a latitude/longitude grid whose cells are at
+    least as large as the largest geofence, so every site that can contain a
+    point lies in the point's cell or one of its 8 neighbours. Each site is
+    also listed under those 8 neighbouring cells, so the sites that may
+    contain a point are found with one lookup of the point's own cell.
+    Candidate pairs are gathered for all points at once with binary searches
+    over the sorted cell keys, and only those pairs are measured.
+
+    distance is the vectorized function measuring KM between arrays of
+    points (see haversine_distance_np in app.py).
+    """
+
+    def __init__(self, sites, distance, digest=''):
+        self.sites = sites.reset_index(drop=True)
+        self.distance = distance
+        self.digest = digest
+        latitudes = self.sites['latitude'].to_numpy(dtype=float)
+        longitudes = self.sites['longitude'].to_numpy(dtype=float)
+        self.radius_m = self.sites['radius_m'].to_numpy(dtype=float)
+
+        # Longitude cells are widened for the highest latitude so they still cover a radius there
+        self.cell_lat = max(float(self.radius_m.max(initial=0)), 1.0) / METRES_PER_DEGREE
+        max_lat = min(float(np.abs(latitudes).max(initial=0)) + self.cell_lat, 89.0)
+        self.cell_lon = self.cell_lat / math.cos(math.radians(max_lat))
+        self.columns = int(math.ceil(360 / self.cell_lon))
+
+        rows, cols = self._cells(latitudes, longitudes)
+        self.keys, self.order = self._sorted_cells(rows, cols, np.arange(len(self.sites)))
+
+        # Every site under its own cell and the 8 around it
+        offsets = [(row, col) for row in (-1, 0, 1) for col in (-1, 0, 1)]
+        self.cover_keys, self.cover_sites = self._sorted_cells(
+            np.concatenate([rows + row for row, _ in offsets]),
+            np.concatenate([(cols + col) % self.columns for _, col in offsets]),
+            np.tile(np.arange(len(self.sites)), len(offsets))
+        )
+
+    @classmethod
+    def load(cls, path, distance, default_radius_m):
+        """Index the sites in a CSV or GeoJSON file (see read_sites)"""
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        return cls(read_sites(path, default_radius_m), distance, f"{digest}:{default_radius_m}")
+
+    def __len__(self):
+        return len(self.sites)
+
+    def _cells(self, latitudes, longitudes):
+        # Both shifted coordinates are non-negative, so truncating floors them
+        rows = ((latitudes + 90) / self.cell_lat).astype(np.int64)
+        cols = ((longitudes + 180) / self.cell_lon).astype(np.int64) % self.columns
+        return rows, cols
+
+    def _sorted_cells(self, rows, cols, sites):
+        keys = rows * self.columns + cols
+        order = np.argsort(keys, kind='stable')
+        return keys[order], sites[order]
+
+    def _candidates(self, latitudes, longitudes, rings):
+        """(point, site) index pairs of the sites in the cells around each point
+
+        rings is how many cells around the point's own are searched; None
+        looks up just the point's cell in the neighbour-covering index.
+        """
+        points = np.flatnonzero(~(np.isnan(latitudes) | np.isnan(longitudes)))
+        rows, cols = self._cells(latitudes[points], longitudes[points])
+        if rings is None:
+            sorted_keys, sorted_sites, offsets = self.cover_keys, self.cover_sites, [(0, 0)]
+        else:
+            sorted_keys, sorted_sites = self.keys, self.order
+            offsets = [(row, col) for row in range(-rings, rings + 1) for col in range(-rings, rings + 1)]
+
+        point_parts, start_parts, count_parts = [], [], []
+        for row_offset, col_offset in offsets:
+            keys = (rows + row_offset) * self.columns + (cols + col_offset) % self.columns
+            starts = np.searchsorted(sorted_keys, keys, 'left')
+            counts = np.searchsorted(sorted_keys, keys, 'right') - starts
+            hits = counts > 0
+            point_parts.append(points[hits])
+            start_parts.append(starts[hits])
+            count_parts.append(counts[hits])
+
+        counts = np.concatenate(count_parts)
+        if counts.sum() == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        # Expand each (point, cell) hit into one pair per site in the cell
+        pair_points = np.repeat(np.concatenate(point_parts), counts)
+        firsts = np.repeat(np.concatenate(start_parts), counts)
+        within_cell = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return pair_points, sorted_sites[firsts + within_cell]
+
+    def within(self, latitudes, longitudes, radius_m=None):
+        """Every (point, site) pair with the point inside the site
+
+        A point is inside a site within the site's own radius, or within
+        radius_m when given. Returns point indices, site indices and distances
+        in metres.
+        """
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        if len(self.sites) == 0 or len(latitudes) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([])
+
+        rings = None if radius_m is None else max(1, int(math.ceil(radius_m / (self.cell_lat * METRES_PER_DEGREE))))
+        points, sites = self._candidates(latitudes, longitudes, rings)
+        distances = self.distance(latitudes[points], longitudes[points],
+                                  self.sites['latitude'].to_numpy(dtype=float)[sites],
+                                  self.sites['longitude'].to_numpy(dtype=float)[sites]) * 1000
+        limit = self.radius_m[sites] if radius_m is None else radius_m
+        inside = distances <= limit
+        return points[inside], sites[inside], distances[inside]
+
+    def nearest(self, latitudes, longitudes):
+        """For each point, the nearest site that contains it
+
+        Returns site indices (-1 where no site contains the point) and
+        distances in metres (NaN where there is no match).
+        """
+        count = len(latitudes)
+        site_index = np.full(count, -1, dtype=np.int64)
+        site_distance = np.full(count, np.nan)
+        points, sites, distances = self.within(latitudes, longitudes)
+        if len(points):
+            order = np.lexsort((distances, points))
+            first = order[np.r_[True, points[order][1:] != points[order][:-1]]]
+            site_index[points[first]] = sites[first]
+            site_distance[points[first]] = distances[first]
+        return site_index, site_distance
+
+    def site(self, index):
+        """A matched site as a JSON-ready dict, or None for -1"""
+        if index < 0:
+            return None
+        site = self.sites.iloc[int(index)]
+        return {
+            'site_id': site['site_id'] if isinstance(site['site_id'], str) else int(site['site_id']),
+            'name': str(site['name']),
+            'type': None if pd.isna(site['type']) else str(site['type'])
+        }
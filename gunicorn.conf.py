@@ -0,0 +1,45 @@
+"""Production server settings: gunicorn -c gunicorn.conf.py app:app
+
+Every setting can be overridden from the environment. The app is loaded once
+in the master process (preload_app), which runs its startup tasks a single
+time and shares the loaded modules with the forked workers; each worker then
+starts its own batch worker thread.
+"""
+import os
+
+# Tells app.py to leave the startup tasks and batch thread to the hooks below
+os.environ['TRIP_ANALYTICS_SERVER'] = 'gunicorn'
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Worker processes. They share the job store, PDF cache and metrics store, so
+# any of them can answer any request (see DEPLOYMENT.md for sizing)
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+
+# Threads per worker. Each open /batch-events stream or ZIP download holds a
+# thread, while CPU-heavy requests are limited to HEAVY_REQUEST_SLOTS of them.
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+# Seconds a worker may go silent before it is restarted, and the grace period
+# for in-flight requests on restart or deploy
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 60))
+keepalive = int(os.environ.get('WEB_KEEPALIVE', 5))
+
+# Recycle workers now and then to return memory held by large uploads
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+preload_app = True
+accesslog = '-'
+
+
+def on_starting(server):
+    import app
+    app.run_startup_tasks()
+
+
+def post_worker_init(worker):
+    import app
+    app.start_batch_worker()
@@ -0,0 +1,502 @@
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+
+
+class JobStore(ABC):
+    """Interface for batch job backends
+
+    A batch starts out waiting for ingestion: a worker claims it, splits the
+    upload into per-trip tasks with add_trips and calls finish_ingestion. Trip
+    tasks are then claimed, rendered and settled with complete_trip or
+    fail_trip. Claims carry a lease so that work held by a crashed process is
+    picked up again once the lease expires.
+
+    Progress is also recorded as an append-only list of events per batch
+    (batch_started, trip_started, trip_completed, trip_failed and batch_done)
+    with increasing IDs, so clients can follow a batch incrementally.
+    """
+
+    @abstractmethod
+    def create_batch(self, batch_id, source_path, worksheet_name=None):
+        """Record a new batch whose upload is waiting to be ingested"""
+
+    @abstractmethod
+    def claim_ingestion(self, worker_id, lease_seconds, max_attempts):
+        """Claim the oldest batch waiting to be ingested, or return None"""
+
+    @abstractmethod
+    def add_trips(self, batch_id, trips, lease_seconds):
+        """Queue trip tasks (dicts with trip_id, filename, payload_path and summary)"""
+
+    @abstractmethod
+    def set_total_trips(self, batch_id, total_trips):
+        """Record how many trips a batch has once the upload has been scanned"""
+
+    @abstractmethod
+    def finish_ingestion(self, batch_id, total_trips):
+        """Mark a batch's trips as fully queued"""
+
+    @abstractmethod
+    def fail_batch(self, batch_id, error):
+        """Mark a batch as failed"""
+
+    @abstractmethod
+    def claim_trip(self, worker_id, lease_seconds, max_attempts):
+        """Claim the next queued trip task, or return None"""
+
+    @abstractmethod
+    def renew_leases(self, task_ids, lease_seconds):
+        """Extend the leases of trip tasks that are still being rendered"""
+
+    @abstractmethod
+    def complete_trip(self, task_id):
+        """Mark a trip task as rendered"""
+
+    @abstractmethod
+    def fail_trip(self, task_id, error, max_attempts):
+        """Requeue a failed trip task, or fail it for good; returns its new status"""
+
+    @abstractmethod
+    def cancel_batch(self, batch_id):
+        """Cancel a batch and its queued trips; returns False if the batch is unknown"""
+
+    @abstractmethod
+    def batch_status(self, batch_id):
+        """Current status string of a batch, or None if it is unknown"""
+
+    @abstractmethod
+    def get_batch(self, batch_id, offset=0):
+        """Status dict for a batch (as served by /batch-status), or None
+
+        pdfs lists completed trips in completion order, starting at offset.
+        """
+
+    @abstractmethod
+    def batch_events(self, batch_id, after_id=0, limit=500):
+        """Events of a batch with IDs above after_id, oldest first"""
+
+    @abstractmethod
+    def batch_ids(self):
+        """IDs of every stored batch"""
+
+    @abstractmethod
+    def batch_pdfs(self):
+        """PDF filenames of the trips in every stored batch"""
+
+    @abstractmethod
+    def queue_stats(self):
+        """Counts of queued and running trip tasks and of batches still processing"""
+
+    @abstractmethod
+    def expired_batches(self, finished_before):
+        """IDs of batches that finished before the given time"""
+
+    @abstractmethod
+    def delete_batch(self, batch_id):
+        """Remove a batch and return the PDF filenames and payload paths it owned"""
+
+
+class SQLiteJobStore(JobStore):
+    """Job store in a SQLite database, safe to share between processes
+
+    Every call opens its own connection, so the store can be used from any
+    thread, and writes run in IMMEDIATE transactions so that two workers
+    never claim the same task.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS batches (
+            batch_id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            source_path TEXT,
+            worksheet_name TEXT,
+            ingest_state TEXT NOT NULL DEFAULT 'queued',
+            ingest_attempts INTEGER NOT NULL DEFAULT 0,
+            total_trips INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            lease_owner TEXT,
+            lease_expires REAL,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS trips (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL,
+            trip_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            payload_path TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            lease_owner TEXT,
+            lease_expires REAL,
+            finished_at REAL,
+            UNIQUE (batch_id, trip_id)
+        );
+        CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            batch_id TEXT NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS trips_by_status ON trips (status, id);
+        CREATE INDEX IF NOT EXISTS trips_by_batch ON trips (batch_id, status);
+        CREATE INDEX IF NOT EXISTS events_by_batch ON events (batch_id, id);
+        CREATE INDEX IF NOT EXISTS events_by_type ON events (batch_id, type, id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _finish_if_done(self, conn, batch_id):
+        """Complete a batch once it is ingested and none of its trips are pending"""
+        cursor = conn.execute(
+            """UPDATE batches SET status = 'completed', finished_at = ?
+               WHERE batch_id = ? AND status = 'processing' AND ingest_state = 'done'
+               AND NOT EXISTS (SELECT 1 FROM trips WHERE batch_id = ? AND status IN ('queued', 'running'))""",
+            (time.time(), batch_id, batch_id)
+        )
+        if cursor.rowcount:
+            self._add_batch_done(conn, batch_id)
+
+    def _add_event(self, conn, batch_id, event_type, data):
+        conn.execute(
+            'INSERT INTO events (batch_id, type, data, created_at) VALUES (?, ?, ?, ?)',
+            (batch_id, event_type, json.dumps(data), time.time())
+        )
+
+    def _add_batch_done(self, conn, batch_id):
+        """Record the final status of a batch that just stopped processing"""
+        batch = conn.execute(
+            'SELECT status, error, total_trips FROM batches WHERE batch_id = ?', (batch_id,)
+        ).fetchone()
+        counts = dict(conn.execute(
+            "SELECT status, COUNT(*) FROM trips WHERE batch_id = ? AND status IN ('completed', 'failed') GROUP BY status",
+            (batch_id,)
+        ).fetchall())
+        self._add_event(conn, batch_id, 'batch_done', {
+            'status': batch['status'],
+            'error': batch['error'],
+            'total_trips': batch['total_trips'],
+            'completed_trips': counts.get('completed', 0),
+            'failed_trips': counts.get('failed', 0)
+        })
+
+    @staticmethod
+    def _pdf_entry(filename, summary):
+        """A completed trip as listed under pdfs in the batch status"""
+        return {
+            'filename': filename,
+            'trip_id': summary['trip_id'],
+            'ping_count': summary['ping_count'],
+            'total_distance': summary['total_distance'],
+            'avg_speed': summary['avg_speed'],
+            'running_time': summary.get('running_time'),
+            'moving_avg_speed': summary.get('moving_avg_speed')
+        }
+
+    def create_batch(self, batch_id, source_path, worksheet_name=None):
+        with self._transaction() as conn:
+            conn.execute(
+                """INSERT INTO batches (batch_id, status, source_path, worksheet_name, created_at)
+                   VALUES (?, 'processing', ?, ?, ?)""",
+                (batch_id, source_path, worksheet_name, time.time())
+            )
+
+    def claim_ingestion(self, worker_id, lease_seconds, max_attempts):
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    """SELECT * FROM batches WHERE status = 'processing'
+                       AND (ingest_state = 'queued' OR (ingest_state = 'ingesting' AND lease_expires < ?))
+                       ORDER BY created_at LIMIT 1""",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    return None
+
+                # An upload that keeps taking its worker down is not retried forever
+                if row['ingest_attempts'] >= max_attempts:
+                    conn.execute(
+                        "UPDATE batches SET status = 'error', error = ?, finished_at = ? WHERE batch_id = ?",
+                        ('Batch ingestion was interrupted too many times', now, row['batch_id'])
+                    )
+                    self._add_batch_done(conn, row['batch_id'])
+                    continue
+
+                conn.execute(
+                    """UPDATE batches SET ingest_state = 'ingesting', ingest_attempts = ingest_attempts + 1,
+                       lease_owner = ?, lease_expires = ? WHERE batch_id = ?""",
+                    (worker_id, now + lease_seconds, row['batch_id'])
+                )
+                return dict(row)
+
+    def add_trips(self, batch_id, trips, lease_seconds):
+        with self._transaction() as conn:
+            # Trips queued by an earlier, interrupted ingestion are kept as they are
+            conn.executemany(
+                """INSERT OR IGNORE INTO trips (batch_id, trip_id, status, filename, payload_path, summary)
+                   VALUES (?, ?, 'queued', ?, ?, ?)""",
+                [(batch_id, trip['trip_id'], trip['filename'], trip['payload_path'], json.dumps(trip['summary']))
+                 for trip in trips]
+            )
+            conn.execute(
+                'UPDATE batches SET lease_expires = ? WHERE batch_id = ?',
+                (time.time() + lease_seconds, batch_id)
+            )
+
+    def set_total_trips(self, batch_id, total_trips):
+        with self._transaction() as conn:
+            conn.execute('UPDATE batches SET total_trips = ? WHERE batch_id = ?', (total_trips, batch_id))
+            self._add_event(conn, batch_id, 'batch_started', {'total_trips': total_trips})
+
+    def finish_ingestion(self, batch_id, total_trips):
+        with self._transaction() as conn:
+            conn.execute(
+                """UPDATE batches SET ingest_state = 'done', total_trips = ?, lease_owner = NULL,
+                   lease_expires = NULL WHERE batch_id = ?""",
+                (total_trips, batch_id)
+            )
+            self._finish_if_done(conn, batch_id)
+
+    def fail_batch(self, batch_id, error):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                """UPDATE batches SET status = 'error', error = ?, finished_at = ?
+                   WHERE batch_id = ? AND status = 'processing'""",
+                (error, time.time(), batch_id)
+            )
+            conn.execute(
+                "UPDATE trips SET status = 'cancelled' WHERE batch_id = ? AND status = 'queued'",
+                (batch_id,)
+            )
+            if cursor.rowcount:
+                self._add_batch_done(conn, batch_id)
+
+    def claim_trip(self, worker_id, lease_seconds, max_attempts):
+        now = time.time()
+        with self._transaction() as conn:
+            while True:
+                row = conn.execute(
+                    """SELECT trips.* FROM trips JOIN batches USING (batch_id)
+                       WHERE batches.status = 'processing'
+                       AND (trips.status = 'queued' OR (trips.status = 'running' AND trips.lease_expires < ?))
+                       ORDER BY trips.id LIMIT 1""",
+                    (now,)
+                ).fetchone()
+                if row is None:
+                    return None
+
+                # A trip whose lease keeps expiring is taking its worker down with it
+                if row['attempts'] >= max_attempts:
+                    error = 'Worker stopped while rendering this trip'
+                    conn.execute(
+                        "UPDATE trips SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                        (error, now, row['id'])
+                    )
+                    self._add_event(conn, row['batch_id'], 'trip_failed', {'trip_id': row['trip_id'], 'error': error})
+                    self._finish_if_done(conn, row['batch_id'])
+                    continue
+
+                conn.execute(
+                    """UPDATE trips SET status = 'running', attempts = attempts + 1,
+                       lease_owner = ?, lease_expires = ? WHERE id = ?""",
+                    (worker_id, now + lease_seconds, row['id'])
+                )
+                task = dict(row)
+                task['attempts'] += 1
+                task['summary'] = json.loads(task['summary'])
+                self._add_event(conn, task['batch_id'], 'trip_started', {
+                    'trip_id': task['trip_id'],
+                    'attempt': task['attempts']
+                })
+                return task
+
+    def renew_leases(self, task_ids, lease_seconds):
+        if not task_ids:
+            return
+        with self._transaction() as conn:
+            conn.executemany(
+                "UPDATE trips SET lease_expires = ? WHERE id = ? AND status = 'running'",
+                [(time.time() + lease_seconds, task_id) for task_id in task_ids]
+            )
+
+    def complete_trip(self, task_id):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT batch_id, filename, summary FROM trips WHERE id = ?', (task_id,)).fetchone()
+            if row is None:
+                return
+            # A trip finished by two workers (after a lease expired) is only reported once
+            cursor = conn.execute(
+                """UPDATE trips SET status = 'completed', error = NULL, lease_owner = NULL,
+                   lease_expires = NULL, finished_at = ? WHERE id = ? AND status != 'completed'""",
+                (time.time(), task_id)
+            )
+            if cursor.rowcount:
+                self._add_event(conn, row['batch_id'], 'trip_completed',
+                                self._pdf_entry(row['filename'], json.loads(row['summary'])))
+            self._finish_if_done(conn, row['batch_id'])
+
+    def fail_trip(self, task_id, error, max_attempts):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT batch_id, trip_id, attempts FROM trips WHERE id = ?', (task_id,)).fetchone()
+            if row is None:
+                return None
+
+            status = 'failed' if row['attempts'] >= max_attempts else 'queued'
+            cursor = conn.execute(
+                """UPDATE trips SET status = ?, error = ?, lease_owner = NULL, lease_expires = NULL,
+                   finished_at = ? WHERE id = ? AND status = 'running'""",
+                (status, error, time.time() if status == 'failed' else None, task_id)
+            )
+            if cursor.rowcount and status == 'failed':
+                self._add_event(conn, row['batch_id'], 'trip_failed', {'trip_id': row['trip_id'], 'error': error})
+            self._finish_if_done(conn, row['batch_id'])
+            return status
+
+    def cancel_batch(self, batch_id):
+        with self._transaction() as conn:
+            row = conn.execute('SELECT status FROM batches WHERE batch_id = ?', (batch_id,)).fetchone()
+            if row is None:
+                return False
+            if row['status'] == 'processing':
+                conn.execute(
+                    "UPDATE batches SET status = 'cancelled', finished_at = ? WHERE batch_id = ?",
+                    (time.time(), batch_id)
+                )
+                conn.execute(
+                    "UPDATE trips SET status = 'cancelled' WHERE batch_id = ? AND status = 'queued'",
+                    (batch_id,)
+                )
+                self._add_batch_done(conn, batch_id)
+            return True
+
+    def batch_status(self, batch_id):
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT status FROM batches WHERE batch_id = ?', (batch_id,)).fetchone()
+        return row['status'] if row else None
+
+    def get_batch(self, batch_id, offset=0):
+        with closing(self._connect()) as conn:
+            batch = conn.execute('SELECT * FROM batches WHERE batch_id = ?', (batch_id,)).fetchone()
+            if batch is None:
+                return None
+
+            # Completion events give a stable order to page through with offset
+            completed_trips = conn.execute(
+                "SELECT COUNT(*) FROM events WHERE batch_id = ? AND type = 'trip_completed'", (batch_id,)
+            ).fetchone()[0]
+            completed = conn.execute(
+                """SELECT data FROM events WHERE batch_id = ? AND type = 'trip_completed'
+                   ORDER BY id LIMIT -1 OFFSET ?""",
+                (batch_id, offset)
+            ).fetchall()
+            failed = conn.execute(
+                "SELECT trip_id, error FROM trips WHERE batch_id = ? AND status = 'failed' ORDER BY finished_at, id",
+                (batch_id,)
+            ).fetchall()
+
+        return {
+            'status': batch['status'],
+            'total_trips': batch['total_trips'],
+            'completed_trips': completed_trips,
+            'pdfs': [json.loads(row['data']) for row in completed],
+            'failed_trips': [{'trip_id': row['trip_id'], 'error': row['error']} for row in failed],
+            'error': batch['error']
+        }
+
+    def batch_events(self, batch_id, after_id=0, limit=500):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT id, type, data FROM events WHERE batch_id = ? AND id > ? ORDER BY id LIMIT ?',
+                (batch_id, after_id, limit)
+            ).fetchall()
+        return [{'id': row['id'], 'type': row['type'], 'data': json.loads(row['data'])} for row in rows]
+
+    def batch_ids(self):
+        with closing(self._connect()) as conn:
+            return {row['batch_id'] for row in conn.execute('SELECT batch_id FROM batches')}
+
+    def batch_pdfs(self):
+        with closing(self._connect()) as conn:
+            return {row['filename'] for row in conn.execute('SELECT DISTINCT filename FROM trips')}
+
+    def queue_stats(self):
+        with closing(self._connect()) as conn:
+            trips = dict(conn.execute(
+                "SELECT status, COUNT(*) FROM trips WHERE status IN ('queued', 'running') GROUP BY status"
+            ).fetchall())
+            active_batches = conn.execute(
+                "SELECT COUNT(*) FROM batches WHERE status = 'processing'"
+            ).fetchone()[0]
+        return {
+            'queued_trips': trips.get('queued', 0),
+            'running_trips': trips.get('running', 0),
+            'active_batches': active_batches
+        }
+
+    def expired_batches(self, finished_before):
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                'SELECT batch_id FROM batches WHERE finished_at IS NOT NULL AND finished_at < ?',
+                (finished_before,)
+            ).fetchall()
+        return [row['batch_id'] for row in rows]
+
+    def delete_batch(self, batch_id):
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT filename, payload_path FROM trips WHERE batch_id = ?', (batch_id,)
+            ).fetchall()
+            conn.execute('DELETE FROM trips WHERE batch_id = ?', (batch_id,))
+            conn.execute('DELETE FROM events WHERE batch_id = ?', (batch_id,))
+            conn.execute('DELETE FROM batches WHERE batch_id = ?', (batch_id,))
+        return [row['filename'] for row in rows], [row['payload_path'] for row in rows]
+
+
+# Backends by URL scheme; other stores can be registered here
+JOB_STORE_BACKENDS = {
+    'sqlite': SQLiteJobStore,
+}
+
+
+def create_job_store(url):
+    """Create a job store from a URL such as sqlite:///uploads/batch_jobs.db"""
+    scheme, separator, location = url.partition('://')
+    if not separator or scheme not in JOB_STORE_BACKENDS:
+        raise ValueError(f"Unsupported job store URL: {url}")
+
+    # sqlite:///relative/path and sqlite:////absolute/path
+    return JOB_STORE_BACKENDS[scheme](location[1:] if location.startswith('/') else location)
@@ -0,0 +1,239 @@
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+import numpy as np
+import pandas as pd
+
+
+class LiveTripStore:
+    """Running totals of trips that are still receiving pings, in SQLite
+
+    Each trip keeps its pings (ordered by timestamp, then arrival) with the
+    distance, duration and speed of every ping measured from the one before
+    it, plus running totals. Appending pings that come after the last one
+    only measures them against it. A ping that arrives late is measured
+    against its stored neighbours, and only the ping after it is measured
+    again, so an append costs O(new pings) however long the trip is.
+
+    metrics is the function that measures a run of pings, called as
+    metrics(latitudes, longitudes, timestamps) and returning per-ping
+    distance, duration and speed arrays (see compute_ping_metrics in app.py).
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS live_trips (
+            trip_id TEXT PRIMARY KEY,
+            ping_count INTEGER NOT NULL,
+            total_distance REAL NOT NULL,
+            total_duration REAL NOT NULL,
+            speed_sum REAL NOT NULL,
+            first_ts INTEGER NOT NULL,
+            last_ts INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS live_pings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            distance_km REAL NOT NULL,
+            duration_hours REAL NOT NULL,
+            speed_kmh REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS live_pings_by_time ON live_pings (trip_id, ts, id);
+    """
+
+    def __init__(self, path, metrics):
+        self.path = path
+        self.metrics = metrics
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _summary(row):
+        """A trip's totals, in the shape of an /upload report entry"""
+        return {
+            'trip_id': row['trip_id'],
+            'ping_count': row['ping_count'],
+            'total_distance': row['total_distance'],
+            'total_duration': row['total_duration'],
+            'avg_speed': row['speed_sum'] / row['ping_count'] if row['ping_count'] else 0.0,
+            'first_ping': pd.Timestamp(row['first_ts']).isoformat(),
+            'last_ping': pd.Timestamp(row['last_ts']).isoformat()
+        }
+
+    def _neighbours(self, conn, trip_id, ts):
+        """The stored pings just before (or at) and just after a timestamp"""
+        before = conn.execute(
+            """SELECT * FROM live_pings WHERE trip_id = ? AND ts <= ?
+               ORDER BY ts DESC, id DESC LIMIT 1""",
+            (trip_id, ts)
+        ).fetchone()
+        after = conn.execute(
+            'SELECT * FROM live_pings WHERE trip_id = ? AND ts > ? ORDER BY ts, id LIMIT 1',
+            (trip_id, ts)
+        ).fetchone()
+        return before, after
+
+    def append(self, trip_id, latitudes, longitudes, timestamps):
+        """Add pings to a trip (creating it on first use) and return its new totals
+
+        Pings may arrive in any order; pings with equal timestamps keep their
+        arrival order, as a stable sort of the whole history would.
+        """
+        trip_id = str(trip_id)
+        timestamps = np.asarray(timestamps, dtype='datetime64[ns]').view('int64')
+        order = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[order]
+        latitudes = np.asarray(latitudes, dtype=float)[order]
+        longitudes = np.asarray(longitudes, dtype=float)[order]
+
+        with self._transaction() as conn:
+            trip = conn.execute('SELECT * FROM live_trips WHERE trip_id = ?', (trip_id,)).fetchone()
+            totals = dict(trip) if trip else {
+                'trip_id': trip_id, 'ping_count': 0, 'total_distance': 0.0, 'total_duration': 0.0,
+                'speed_sum': 0.0, 'first_ts': int(timestamps[0]), 'last_ts': int(timestamps[0]),
+                'created_at': time.time()
+            }
+            inserts = []
+            updates = []
+
+            def measure_window(head, positions, tail):
+                """Measure new pings (and the stored ping after them) from the stored ping before them"""
+                lats = latitudes[positions]
+                lons = longitudes[positions]
+                stamps = timestamps[positions]
+                if head is not None:
+                    lats = np.r_[head['latitude'], lats]
+                    lons = np.r_[head['longitude'], lons]
+                    stamps = np.r_[head['ts'], stamps]
+                if tail is not None:
+                    lats = np.r_[lats, tail['latitude']]
+                    lons = np.r_[lons, tail['longitude']]
+                    stamps = np.r_[stamps, tail['ts']]
+                distances, durations, speeds = self.metrics(lats, lons, stamps.astype('datetime64[ns]'))
+                offset = 0 if head is None else 1
+
+                for i, position in enumerate(positions, start=offset):
+                    inserts.append((trip_id, int(timestamps[position]), float(latitudes[position]),
+                                    float(longitudes[position]), float(distances[i]), float(durations[i]),
+                                    float(speeds[i])))
+                totals['ping_count'] += len(positions)
+                totals['total_distance'] += float(distances[offset:].sum())
+                totals['total_duration'] += float(durations[offset:].sum())
+                totals['speed_sum'] += float(speeds[offset:].sum())
+
+                # The stored ping after the window is now measured from the last new ping
+                if tail is not None:
+                    totals['total_distance'] -= tail['distance_km']
+                    totals['total_duration'] -= tail['duration_hours']
+                    totals['speed_sum'] -= tail['speed_kmh']
+                    updates.append((float(distances[-1]), float(durations[-1]), float(speeds[-1]), tail['id']))
+
+            if trip is None:
+                measure_window(None, np.arange(len(timestamps)), None)
+            else:
+                # Late pings, grouped by the stored ping each one lands before
+                late = np.flatnonzero(timestamps < trip['last_ts'])
+                groups = {}
+                for position in late.tolist():
+                    before, after = self._neighbours(conn, trip_id, int(timestamps[position]))
+                    groups.setdefault(after['id'], (before, after, []))[2].append(position)
+                for before, after, positions in groups.values():
+                    measure_window(before, np.array(positions), after)
+
+                # Pings after the last stored one
+                newer = np.flatnonzero(timestamps >= trip['last_ts'])
+                if len(newer):
+                    last = conn.execute(
+                        'SELECT * FROM live_pings WHERE trip_id = ? ORDER BY ts DESC, id DESC LIMIT 1',
+                        (trip_id,)
+                    ).fetchone()
+                    measure_window(last, newer, None)
+
+            conn.executemany(
+                """INSERT INTO live_pings (trip_id, ts, latitude, longitude, distance_km, duration_hours, speed_kmh)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                inserts
+            )
+            conn.executemany(
+                'UPDATE live_pings SET distance_km = ?, duration_hours = ?, speed_kmh = ? WHERE id = ?',
+                updates
+            )
+            totals['first_ts'] = min(totals['first_ts'], int(timestamps[0]))
+            totals['last_ts'] = max(totals['last_ts'], int(timestamps[-1]))
+            totals['updated_at'] = time.time()
+            conn.execute(
+                """INSERT OR REPLACE INTO live_trips (trip_id, ping_count, total_distance, total_duration,
+                   speed_sum, first_ts, last_ts, created_at, updated_at)
+                   VALUES (:trip_id, :ping_count, :total_distance, :total_duration, :speed_sum,
+                   :first_ts, :last_ts, :created_at, :updated_at)""",
+                totals
+            )
+        return self._summary(totals)
+
+    def summary(self, trip_id):
+        """Current totals of a live trip, or None if it is unknown"""
+        with closing(self._connect()) as conn:
+            row = conn.execute('SELECT * FROM live_trips WHERE trip_id = ?', (str(trip_id),)).fetchone()
+        return self._summary(row) if row else None
+
+    def read(self, trip_id):
+        """A live trip's pings as a processed frame (as process_trip_data returns), or None"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                """SELECT ts, latitude, longitude, distance_km, duration_hours, speed_kmh
+                   FROM live_pings WHERE trip_id = ? ORDER BY ts, id""",
+                (str(trip_id),)
+            ).fetchall()
+        if not rows:
+            return None
+        frame = pd.DataFrame([tuple(row) for row in rows], columns=rows[0].keys())
+        frame.insert(0, 'parsed_timestamp', pd.to_datetime(frame.pop('ts'), unit='ns'))
+        return frame
+
+    def delete(self, trip_id):
+        """Forget a live trip; returns False if it is unknown"""
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM live_pings WHERE trip_id = ?', (str(trip_id),))
+            cursor = conn.execute('DELETE FROM live_trips WHERE trip_id = ?', (str(trip_id),))
+        return cursor.rowcount > 0
+
+    def purge(self, max_age_seconds):
+        """Delete trips that received no pings for max_age_seconds"""
+        cutoff = time.time() - max_age_seconds
+        with self._transaction() as conn:
+            trip_ids = [row['trip_id'] for row in conn.execute(
+                'SELECT trip_id FROM live_trips WHERE updated_at < ?', (cutoff,)
+            ).fetchall()]
+            for trip_id in trip_ids:
+                conn.execute('DELETE FROM live_pings WHERE trip_id = ?', (trip_id,))
+                conn.execute('DELETE FROM live_trips WHERE trip_id = ?', (trip_id,))
+        return len(trip_ids)
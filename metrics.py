@@ -0,0 +1,369 @@
+import atexit
+import bisect
+import functools
+import json
+import multiprocessing.util
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+
+# Default histogram buckets in seconds, from a fast parse to a long render
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    text = ','.join(f'{name}="{escape(value)}"' for name, value in pairs)
+    return '{' + text + '}'
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(ABC):
+    """A named metric with a fixed set of label names
+
+    Metrics that are shared between processes (counters and histograms) also
+    give their values as series(): a dict of (label values, position) to
+    numbers that can be summed with other processes' series, and that
+    samples() accepts in place of the local values.
+    """
+
+    TYPE = None
+    SHARED = True
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.registry = None
+
+    def _key(self, labels):
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} takes labels {list(self.label_names)}, got {sorted(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _changed(self):
+        if self.registry is not None:
+            self.registry.changed()
+
+    def series(self):
+        """This process's values, in the form they are shared in"""
+        return {}
+
+    @abstractmethod
+    def samples(self, series=None):
+        """(name suffix, label values, extra labels, value) for every series
+
+        series, when given, replaces this process's values (see series()).
+        """
+
+    def render(self, series=None):
+        lines = [f"# HELP {self.name} {escape(self.documentation)}", f"# TYPE {self.name} {self.TYPE}"]
+        for suffix, values, extra, value in self.samples(series):
+            lines.append(f"{self.name}{suffix}{format_labels(self.label_names, values, extra)} {format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A count that only goes up
+
+    Its name must end in _total: the text format gives counter samples that
+    name, and the HELP and TYPE lines must use the same one.
+    """
+
+    TYPE = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        if not name.endswith('_total'):
+            raise ValueError(f"Counter names end in _total, got {name}")
+        Metric.__init__(self, name, documentation, labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+        self._changed()
+
+    def series(self):
+        with self.lock:
+            return {(key, 0): value for key, value in self.values.items()}
+
+    def samples(self, series=None):
+        if series is None:
+            with self.lock:
+                values = dict(self.values)
+        else:
+            values = {key: value for (key, _), value in series.items()}
+        return [('', key, (), value) for key, value in sorted(values.items())]
+
+
+class Gauge(Metric):
+    """A gauge set directly, or read from a callback at every scrape
+
+    The callback returns a dict of label-value tuples to values. Gauges are
+    not shared between processes: each reports what the rendering process
+    sees, so callbacks should read state that all processes share.
+    """
+
+    TYPE = 'gauge'
+    SHARED = False
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        Metric.__init__(self, name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self, series=None):
+        if self.callback is not None:
+            values = self.callback()
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [('', key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    """Observations counted into buckets, with their sum
+
+    Shared as one series per bucket (positions 0 to len(buckets), the last
+    for +Inf) plus the sum at the next position.
+    """
+
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+        self._changed()
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of a with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """Decorator observing the wall time of every call"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def time_iter(self, iterable, **labels):
+        """Yield from iterable, observing the time spent producing each item"""
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.observe(time.perf_counter() - start, **labels)
+            yield item
+
+    def series(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        series = {}
+        for key, (counts, total) in values.items():
+            series.update(((key, position), count) for position, count in enumerate(counts))
+            series[(key, len(counts))] = total
+        return series
+
+    def samples(self, series=None):
+        if series is None:
+            with self.lock:
+                values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        else:
+            values = {}
+            for (key, position), value in series.items():
+                counts, total = values.setdefault(key, ([0] * (len(self.buckets) + 1), 0.0))
+                if position < len(counts):
+                    counts[position] = value
+                else:
+                    values[key] = (counts, value)
+        samples = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+class SQLiteMetricStore:
+    """Totals of counters and histograms summed over processes, in SQLite
+
+    Processes add what their series grew by since they last flushed, so the
+    stored value of a series is the sum over every process that has
+    recorded it, including processes that have since exited.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS metric_series (
+            metric TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            value NUMERIC NOT NULL,
+            PRIMARY KEY (metric, labels, position)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        with closing(self._connect()) as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def add(self, deltas):
+        """Add {(metric name, label values, position): amount} to the stored totals"""
+        with closing(self._connect()) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.executemany(
+                    """INSERT INTO metric_series (metric, labels, position, value) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (metric, labels, position) DO UPDATE SET value = value + excluded.value""",
+                    [(name, json.dumps(key), position, amount) for (name, key, position), amount in deltas.items()]
+                )
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def read(self):
+        """Stored totals as {metric name: {(label values, position): value}}"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute('SELECT metric, labels, position, value FROM metric_series').fetchall()
+        totals = {}
+        for name, labels, position, value in rows:
+            totals.setdefault(name, {})[(tuple(json.loads(labels)), position)] = value
+        return totals
+
+
+class Registry:
+    """Metrics rendered in the Prometheus text format
+
+    Without a store, the metrics are those of this process. With one (see
+    SQLiteMetricStore), each process adds what its counters and histograms
+    grew by to the store from a background thread, at most flush_interval
+    seconds after they change and when the process exits, and render()
+    reports the totals over all processes.
+    """
+
+    def __init__(self, store=None, flush_interval=1.0):
+        self.metrics = []
+        self.store = store
+        self.flush_interval = flush_interval
+        self.flush_lock = threading.Lock()
+        self.flushed = {}
+        self.flusher_pid = None
+        if store is not None:
+            atexit.register(self.flush)
+            # A forked child starts from what its parent had; only its own
+            # changes are its to flush
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def register(self, metric):
+        metric.registry = self
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        return self.register(Gauge(name, documentation, labels, callback))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def _snapshot(self):
+        return {(metric.name, key, position): value
+                for metric in self.metrics if metric.SHARED
+                for (key, position), value in metric.series().items()}
+
+    def _after_fork(self):
+        self.flush_lock = threading.Lock()
+        self.flushed = self._snapshot()
+        self.flusher_pid = None
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing metrics: {str(e)}")
+
+    def changed(self):
+        """Start this process's flush thread, once, when a metric first changes"""
+        if self.store is None or self.flusher_pid == os.getpid():
+            return
+        with self.flush_lock:
+            if self.flusher_pid != os.getpid():
+                self.flusher_pid = os.getpid()
+                threading.Thread(target=self._flush_loop, daemon=True).start()
+                # Processes started by multiprocessing skip atexit handlers
+                # but run the finalizers registered since they started
+                multiprocessing.util.Finalize(self, self.flush, exitpriority=0)
+
+    def flush(self):
+        """Add what this process's metrics grew by since the last flush to the store"""
+        if self.store is None:
+            return
+        with self.flush_lock:
+            current = self._snapshot()
+            deltas = {name: value - self.flushed.get(name, 0) for name, value in current.items()
+                      if value != self.flushed.get(name, 0)}
+            if deltas:
+                self.store.add(deltas)
+            self.flushed = current
+
+    def render(self):
+        if self.store is None:
+            return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+        self.flush()
+        totals = self.store.read()
+        return '\n'.join(metric.render(totals.get(metric.name, {}) if metric.SHARED else None)
+                         for metric in self.metrics) + '\n'
@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+
+
+class PDFCache:
+    """Directory of rendered PDFs named by a hash of the data they were built from
+
+    A file's modification time doubles as its last access time: lookups touch
+    it, and evict() removes files that have not been used for max_age_seconds
+    and then the least recently used ones until the directory fits in
+    max_bytes. Files named by pinned(), a callable returning a set of
+    filenames, are never evicted: the app pins the PDFs of batches still in
+    the job store, so a batch can be downloaded until it expires.
+    Hit/miss/eviction counters are kept per process.
+    """
+
+    SUFFIX = '.pdf'
+
+    def __init__(self, folder, max_bytes, max_age_seconds, evict_interval=60, pinned=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.evict_interval = evict_interval
+        self.pinned = pinned
+        self.last_evict = 0
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'evicted_bytes': 0}
+        self.lock = threading.Lock()
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def path(self, filename):
+        return os.path.join(self.folder, filename)
+
+    def touch(self, filename):
+        """Mark a cached file as used; False if it isn't cached"""
+        try:
+            os.utime(self.path(filename))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get(self, filename):
+        """Path of a cached PDF, or None on a miss"""
+        if self.touch(filename):
+            self._count('hits')
+            return self.path(filename)
+        self._count('misses')
+        return None
+
+    def put(self, filename, content):
+        """Store a rendered PDF and return its path
+
+        The file is written under a temporary name and renamed into place so
+        that readers never see a partial PDF.
+        """
+        path = self.path(filename)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+        os.replace(temp_path, path)
+        self._count('stores')
+        return path
+
+    def _entries(self):
+        """(last used, size, path) of every file in the cache folder"""
+        entries = []
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                except FileNotFoundError:
+                    pass
+        return entries
+
+    def evict(self):
+        """Remove expired files, then the least recently used until under max_bytes
+
+        Pinned files still count towards max_bytes but are skipped.
+        """
+        self.last_evict = time.time()
+        pinned = self.pinned() if self.pinned else set()
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.max_age_seconds
+        removed = 0
+
+        for last_used, size, path in entries:
+            # Leftover temporary files from interrupted writes age out too
+            if last_used >= cutoff and total <= self.max_bytes:
+                break
+            if os.path.basename(path) in pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+            self._count('evictions')
+            self._count('evicted_bytes', size)
+        return removed
+
+    def maybe_evict(self):
+        """Run evict() at most once per evict_interval seconds"""
+        if time.time() - self.last_evict >= self.evict_interval:
+            self.evict()
+
+    def stats(self):
+        """Counters plus the current size of the cache"""
+        entries = [entry for entry in self._entries() if entry[2].endswith(self.SUFFIX)]
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'hit_ratio': round(stats['hits'] / lookups, 4) if lookups else 0.0,
+            'files': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_bytes': self.max_bytes,
+            'max_age_seconds': self.max_age_seconds,
+        })
+        return stats
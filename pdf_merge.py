@@ -0,0 +1,339 @@
+import hashlib
+import os
+import re
+
+# An indirect reference, with the dictionary key in front of it when there is one
+REFERENCE = re.compile(rb'(/[A-Za-z]+\s+)?(\d+)\s+0\s+R(?![A-Za-z])')
+OBJECT_HEADER = re.compile(rb'\s*(\d+)\s+0\s+obj\s*')
+# The end of an object's body: the start of its stream data, or endobj
+BODY_END = re.compile(rb'(stream\r?\n)|endobj')
+# A literal or hex string starts here (<< opens a dictionary instead)
+STRING_START = re.compile(rb'<<|[(<]')
+LENGTH = re.compile(rb'/Length\s+(\d+)(\s+0\s+R)?')
+PAGES = re.compile(rb'/Pages\s+\d+\s+0\s+R')
+KIDS = re.compile(rb'/Kids\s*\[([^\]]*)\]')
+
+
+def pdf_string(text):
+    """A PDF text string: literal when ASCII, UTF-16 hex otherwise"""
+    try:
+        data = text.encode('ascii')
+    except UnicodeEncodeError:
+        return b'<FEFF' + text.encode('utf-16-be').hex().upper().encode() + b'>'
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+
+def string_end(data, start):
+    """Offset just past the literal or hex string that starts at data[start]"""
+    if data[start:start + 1] == b'<':
+        end = data.find(b'>', start)
+        if end < 0:
+            raise ValueError('Unterminated hex string')
+        return end + 1
+    depth = 0
+    position = start
+    while position < len(data):
+        char = data[position:position + 1]
+        if char == b'\\':
+            position += 1
+        elif char == b'(':
+            depth += 1
+        elif char == b')':
+            depth -= 1
+            if depth == 0:
+                return position + 1
+        position += 1
+    raise ValueError('Unterminated literal string')
+
+
+def search_outside_strings(pattern, data, start=0, end=None):
+    """First match of pattern in data[start:end] that isn't inside a string"""
+    end = len(data) if end is None else end
+    position = start
+    while True:
+        match = pattern.search(data, position, end)
+        if match is None:
+            return None
+        string = STRING_START.search(data, position, match.start())
+        while string is not None and string.group() == b'<<':
+            string = STRING_START.search(data, string.end(), match.start())
+        if string is None:
+            return match
+        position = string_end(data, string.start())
+
+
+def replace_references(replace, body):
+    """REFERENCE.sub(replace, body), leaving the contents of strings alone
+
+    Strings are copied as they are, so a title or URI that happens to read
+    like "12 0 R" is not renumbered.
+    """
+    parts = []
+    position = 0
+    while True:
+        string = STRING_START.search(body, position)
+        while string is not None and string.group() == b'<<':
+            string = STRING_START.search(body, string.end())
+        if string is None:
+            parts.append(REFERENCE.sub(replace, body[position:]))
+            return b''.join(parts)
+        end = string_end(body, string.start())
+        parts.append(REFERENCE.sub(replace, body[position:string.start()]))
+        parts.append(body[string.start():end])
+        position = end
+
+
+def reference_number(value):
+    match = REFERENCE.search(value)
+    if match is None:
+        raise ValueError(f"Expected an indirect reference, found {value[:40]!r}")
+    return int(match.group(2))
+
+
+class SourcePDF:
+    """Objects of a PDF with a classic cross-reference table, as ReportLab writes them
+
+    Only what merging needs is parsed: the xref table, the page tree and
+    each object's dictionary and (undecoded) stream data. Stream data is
+    sliced by its /Length and never searched, and the contents of literal
+    and hex strings are skipped when looking for keys or references.
+    Cross-reference streams, object streams and incremental updates are not
+    supported.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        start = data.rfind(b'startxref')
+        trailer = data.rfind(b'trailer', 0, start)
+        if start < 0 or trailer < 0:
+            raise ValueError('No cross-reference table found')
+        xref = int(data[start + len(b'startxref'):].split()[0])
+
+        tokens = data[xref:trailer].split()
+        if not tokens or tokens[0] != b'xref':
+            raise ValueError('Unsupported cross-reference section')
+        self.offsets = {}
+        position = 1
+        while position < len(tokens):
+            first, count = int(tokens[position]), int(tokens[position + 1])
+            position += 2
+            for number in range(first, first + count):
+                offset, _, kind = tokens[position:position + 3]
+                if kind == b'n':
+                    self.offsets[number] = int(offset)
+                position += 3
+
+        root = re.search(rb'/Root\s+(\d+)\s+0\s+R', data[trailer:start])
+        if root is None:
+            raise ValueError('Trailer has no /Root')
+        self.root = int(root.group(1))
+
+    def object(self, number):
+        """(dictionary or other body bytes, stream bytes or None) of an object"""
+        offset = self.offsets[number]
+        header = OBJECT_HEADER.match(self.data, offset)
+        if header is None or int(header.group(1)) != number:
+            raise ValueError(f"Object {number} not found at offset {offset}")
+        start = header.end()
+        end = search_outside_strings(BODY_END, self.data, start)
+        if end is None:
+            raise ValueError(f"Object {number} has no endobj")
+        body = self.data[start:end.start()].rstrip()
+        if end.group(1) is None:
+            return body, None
+
+        length = search_outside_strings(LENGTH, body)
+        if length is None:
+            raise ValueError(f"Stream object {number} has no /Length")
+        if length.group(2):
+            length = int(self.object(int(length.group(1)))[0])
+        else:
+            length = int(length.group(1))
+        return body, self.data[end.end():end.end() + length]
+
+    def pages(self):
+        """Object numbers of the pages, in order"""
+        catalog, _ = self.object(self.root)
+        pages = search_outside_strings(PAGES, catalog)
+        if pages is None:
+            raise ValueError('Catalog has no /Pages')
+        result = []
+        stack = [reference_number(pages.group(0))]
+        while stack:
+            number = stack.pop()
+            node, _ = self.object(number)
+            kids = search_outside_strings(KIDS, node)
+            if kids is None:
+                result.append(number)
+            else:
+                stack.extend(reversed([int(match.group(2)) for match in REFERENCE.finditer(kids.group(1))]))
+        return result
+
+
+class PDFMerger:
+    """Writes whole PDFs one after another into a single PDF, with an outline
+
+    Every PDF added is parsed, its pages and the objects they use renumbered
+    and written straight to the output file object, so only the PDF being
+    added is held in memory; what is kept across PDFs is an offset per
+    object written and a number per page. Resource objects (fonts, images
+    and their dictionaries) that are byte-for-byte the same as one already
+    written are shared instead of written again, so a logo drawn on every
+    report is stored once. Page content streams are always copied.
+
+    Each PDF can start an outline (bookmark) entry, and PDFs added with
+    front=True are placed before all the others in page order, wherever
+    they were written, so a summary built last can open the document. The
+    page tree, outline and cross-reference table are written by close().
+    Pages must carry their own MediaBox and Resources (attributes inherited
+    from a source's page tree are not copied), as ReportLab's pages do.
+    """
+
+    HEADER = b'%PDF-1.4\n%\x93\x8c\x8b\x9e\n'
+
+    def __init__(self, out, title=None):
+        self.out = out
+        self.title = title
+        self.position = 0
+        # Offset of each object by number; object 0 is the head of the free list
+        self.offsets = [None]
+        self.shared = {}
+        self.pages = {False: [], True: []}
+        self.sections = {False: [], True: []}
+        self.pages_number = self._reserve()
+        self._write(self.HEADER)
+
+    @property
+    def page_count(self):
+        return len(self.pages[False]) + len(self.pages[True])
+
+    def _write(self, data):
+        self.out.write(data)
+        self.position += len(data)
+
+    def _reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+
+    def _write_object(self, number, body, stream=None):
+        self.offsets[number] = self.position
+        if stream is None:
+            self._write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+        else:
+            self._write(b'%d 0 obj\n%s\nstream\n%s\nendstream\nendobj\n' % (number, body, stream))
+
+    def _copy(self, source, number, numbers, share=True):
+        """Write a source object and everything it references; returns its new number
+
+        numbers maps the source's object numbers to new ones for the PDF
+        being added (None while an object's references are being copied).
+        """
+        if number in numbers:
+            if numbers[number] is None:
+                # A reference cycle: give the object its number now, unshared
+                numbers[number] = self._reserve()
+            return numbers[number]
+        numbers[number] = None
+
+        body, stream = source.object(number)
+        body = replace_references(
+            lambda match: b'%s%d 0 R' % (match.group(1) or b'',
+                                         self._copy(source, int(match.group(2)), numbers)),
+            body
+        )
+
+        if numbers[number] is not None:
+            new_number = numbers[number]
+        elif share:
+            digest = hashlib.sha256(body + b'\0' + (stream if stream is not None else b'')).digest()
+            new_number = self.shared.get(digest)
+            if new_number is not None:
+                numbers[number] = new_number
+                return new_number
+            new_number = self.shared[digest] = self._reserve()
+        else:
+            new_number = self._reserve()
+        numbers[number] = new_number
+        self._write_object(new_number, body, stream)
+        return new_number
+
+    def _copy_page(self, source, number, numbers):
+        body, _ = source.object(number)
+
+        def replace(match):
+            key = (match.group(1) or b'').strip()
+            if key == b'/Parent':
+                return b'/Parent %d 0 R' % self.pages_number
+            # Content streams belong to their page; anything else may be shared
+            new_number = self._copy(source, int(match.group(2)), numbers, share=key != b'/Contents')
+            return b'%s%d 0 R' % (match.group(1) or b'', new_number)
+
+        body = replace_references(replace, body)
+        new_number = self._reserve()
+        self._write_object(new_number, body)
+        return new_number
+
+    def add(self, data, title=None, front=False):
+        """Append the pages of a PDF (bytes) and return how many there were
+
+        title starts an outline entry pointing at its first page.
+        """
+        source = SourcePDF(data)
+        numbers = {}
+        pages = [self._copy_page(source, number, numbers) for number in source.pages()]
+        if title is not None and pages:
+            self.sections[front].append((title, pages[0]))
+        self.pages[front].extend(pages)
+        return len(pages)
+
+    def add_file(self, path, title=None, front=False):
+        with open(path, 'rb') as f:
+            return self.add(f.read(), title, front)
+
+    def _write_outline(self):
+        sections = self.sections[True] + self.sections[False]
+        if not sections:
+            return None
+        outline_number = self._reserve()
+        item_numbers = [self._reserve() for _ in sections]
+        for i, (title, page) in enumerate(sections):
+            links = b''
+            if i > 0:
+                links += b' /Prev %d 0 R' % item_numbers[i - 1]
+            if i < len(sections) - 1:
+                links += b' /Next %d 0 R' % item_numbers[i + 1]
+            self._write_object(item_numbers[i], b'<< /Title %s /Parent %d 0 R%s /Dest [ %d 0 R /Fit ] >>'
+                               % (pdf_string(title), outline_number, links, page))
+        self._write_object(outline_number, b'<< /Type /Outlines /First %d 0 R /Last %d 0 R /Count %d >>'
+                           % (item_numbers[0], item_numbers[-1], len(sections)))
+        return outline_number
+
+    def close(self):
+        """Write the page tree, outline, catalog and cross-reference table"""
+        kids = self.pages[True] + self.pages[False]
+        self._write_object(self.pages_number, b'<< /Type /Pages /Count %d /Kids [ %s ] >>'
+                           % (len(kids), b' '.join(b'%d 0 R' % number for number in kids)))
+
+        outline_number = self._write_outline()
+        catalog = b'<< /Type /Catalog /Pages %d 0 R' % self.pages_number
+        if outline_number is not None:
+            catalog += b' /Outlines %d 0 R /PageMode /UseOutlines' % outline_number
+        catalog_number = self._reserve()
+        self._write_object(catalog_number, catalog + b' >>')
+
+        info_number = None
+        if self.title is not None:
+            info_number = self._reserve()
+            self._write_object(info_number, b'<< /Title %s /Producer (trip-analytics) >>' % pdf_string(self.title))
+
+        xref = self.position
+        entries = [b'0000000000 65535 f \n']
+        entries.extend(b'%010d 00000 n \n' % offset for offset in self.offsets[1:])
+        self._write(b'xref\n0 %d\n' % len(self.offsets) + b''.join(entries))
+
+        document_id = os.urandom(16).hex().encode()
+        trailer = b'<< /Size %d /Root %d 0 R /ID [ <%s> <%s> ]' % (len(self.offsets), catalog_number,
+                                                                    document_id, document_id)
+        if info_number is not None:
+            trailer += b' /Info %d 0 R' % info_number
+        self._write(b'trailer\n%s >>\nstartxref\n%d\n%%%%EOF\n' % (trailer, xref))
@@ -0,0 +1,67 @@
+from PIL import Image
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import Flowable
+
+
+class StaticImage(Flowable):
+    """An image decoded once per process and drawn into every document
+
+    drawImage compresses an image's pixels into a new XObject for every
+    document it draws into, so the cost of each report grows with the
+    image's pixel count. Here the file is decoded once, scaled down to the
+    size it is drawn at (dpi pixels per inch), and the resulting
+    ImageReader is handed to drawImage for every document. Images already
+    at or below that resolution are kept as they are.
+    """
+
+    def __init__(self, path, width, height, dpi=300):
+        Flowable.__init__(self)
+        with Image.open(path) as image:
+            image.load()
+            size = (round(width / 72 * dpi), round(height / 72 * dpi))
+            if image.width > size[0] and image.height > size[1]:
+                image = image.resize(size, Image.LANCZOS)
+            self.reader = ImageReader(image)
+        # Decode now so that every document reuses the reader's pixel data
+        self.reader.getRGBData()
+        self.width = width
+        self.height = height
+        self.hAlign = 'LEFT'
+
+    def wrap(self, availWidth, availHeight):
+        return self.width, self.height
+
+    def draw(self):
+        self.canv.drawImage(self.reader, 0, 0, self.width, self.height, mask='auto')
+
+
+def column_layout(widths):
+    """Left edges (plus the right edge of the last column) and centres of columns of the given widths"""
+    edges = [0]
+    for width in widths:
+        edges.append(edges[-1] + width)
+    return edges, [(left + right) / 2 for left, right in zip(edges, edges[1:])]
+
+
+class ReportTemplate:
+    """The static layers of the trip report, built once per process
+
+    Holds what every report draws the same way whatever the trip: the logo
+    as a StaticImage (None when the file is missing or unreadable) and the
+    column edges of the header, ping and batch summary tables. Reports only
+    stamp their own header values and table rows onto these.
+    """
+
+    def __init__(self, logo_path, logo_width, logo_height, header_col_widths, ping_col_widths,
+                 summary_col_widths):
+        try:
+            self.logo = StaticImage(logo_path, logo_width, logo_height)
+        except (OSError, ValueError):
+            self.logo = None
+
+        self.header_col_positions, _ = column_layout(header_col_widths)
+        self.header_table_width = self.header_col_positions[-1]
+        self.ping_col_positions, self.ping_col_centers = column_layout(ping_col_widths)
+        self.ping_table_width = self.ping_col_positions[-1]
+        self.summary_col_positions, self.summary_col_centers = column_layout(summary_col_widths)
+        self.summary_table_width = self.summary_col_positions[-1]
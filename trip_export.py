@@ -0,0 +1,194 @@
+import io
+import json
+import zlib
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+# Export formats by name: MIME type and file extension
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'geojson': ('application/geo+json', 'geojson')
+}
+
+# Per-ping numbers exported, and the decimals each is rounded to
+# (6 decimals of a degree is about 0.1 m)
+EXPORT_DECIMALS = {
+    'latitude': 6,
+    'longitude': 6,
+    'distance_km': 6,
+    'duration_hours': 6,
+    'speed_kmh': 3
+}
+
+
+def numeric_column(column):
+    """A column as rounding-ready float64, with text that isn't a number as null"""
+    if pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+        # Coordinates stored as text (uploads with some non-numeric values)
+        return pa.array(pd.to_numeric(column.to_pandas(), errors='coerce'), type=pa.float64(), from_pandas=True)
+    return pc.cast(column, pa.float64())
+
+
+def export_table(table):
+    """The exported columns of a slice of processed pings, as an Arrow table
+
+    trip_id (when the upload has one), an ISO 8601 timestamp and the
+    EXPORT_DECIMALS numbers, rounded. Missing, non-numeric and non-finite
+    numbers are null.
+    """
+    columns = {}
+    if 'trip_id' in table.column_names:
+        columns['trip_id'] = table['trip_id']
+    timestamps = pc.cast(pc.cast(table['parsed_timestamp'], pa.timestamp('s'), safe=False), pa.string())
+    columns['timestamp'] = pc.replace_substring(timestamps, ' ', 'T', max_replacements=1)
+    for name, decimals in EXPORT_DECIMALS.items():
+        values = pc.round(numeric_column(table[name]), decimals)
+        columns[name] = pc.if_else(pc.is_finite(values), values, pa.scalar(None, pa.float64()))
+    return pa.table(columns)
+
+
+def json_text(column):
+    """JSON text of each value of a numeric column (null for nulls)"""
+    return pc.fill_null(pc.cast(column, pa.string()), 'null')
+
+
+def joined(column):
+    """(bytes, offsets) of a string column's values laid end to end
+
+    Value i is data[offsets[i]:offsets[i + 1]], so a run of values is one
+    slice, without building a Python string per value.
+    """
+    array = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    array = array.cast(pa.large_string())
+    _, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[array.offset:array.offset + len(array) + 1]
+    return data.to_pybytes() if data is not None else b'', offsets
+
+
+def trip_bounds(table):
+    """Start and end row of each trip in a slice of whole trips"""
+    if 'trip_id' not in table.column_names or len(table) == 0:
+        return np.array([0]), np.array([len(table)])
+    trip_ids = table['trip_id'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, trip_ids[1:] != trip_ids[:-1]])
+    return starts, np.r_[starts[1:], len(trip_ids)]
+
+
+def csv_chunk(table, header):
+    buffer = io.BytesIO()
+    pa_csv.write_csv(table, buffer, pa_csv.WriteOptions(include_header=header))
+    return buffer.getvalue()
+
+
+def ndjson_chunk(table):
+    parts = []
+    for name in table.column_names:
+        if name == 'timestamp':
+            parts += [f',"{name}":"', table[name], '"']
+        else:
+            parts += [f',"{name}":', json_text(table[name])]
+    parts[0] = parts[0].replace(',', '{', 1)
+    lines = pc.binary_join_element_wise(*parts, '}\n', '')
+    data, offsets = joined(lines)
+    return data[offsets[0]:offsets[-1]]
+
+
+def geojson_chunk(table):
+    """GeoJSON Features of the trips in a slice, one LineString each, comma-separated
+
+    Pings without both coordinates are left out of the line and of its
+    per-ping property arrays; a trip left with fewer than two positions has
+    a null geometry. Totals count every ping.
+    """
+    starts, ends = trip_bounds(table)
+    located = pc.and_(pc.is_valid(table['latitude']), pc.is_valid(table['longitude'])).to_numpy(zero_copy_only=False)
+    trip_ids = table['trip_id'].to_numpy() if 'trip_id' in table.column_names else None
+
+    distances = np.nan_to_num(table['distance_km'].to_numpy(zero_copy_only=False))
+    durations = np.nan_to_num(table['duration_hours'].to_numpy(zero_copy_only=False))
+    timestamps = table['timestamp'].to_numpy(zero_copy_only=False)
+    total_distances = np.add.reduceat(distances, starts) if len(table) else np.zeros(1)
+    total_durations = np.add.reduceat(durations, starts) if len(table) else np.zeros(1)
+
+    # Per-ping values of the located pings, each followed by a comma unless it ends its trip
+    positions = np.flatnonzero(located)
+    kept = table.take(pa.array(positions))
+    trip_of = np.searchsorted(starts, positions, side='right') - 1
+    last = np.r_[trip_of[1:] != trip_of[:-1], True] if len(positions) else np.array([], dtype=bool)
+    separators = pa.array(np.where(last, '', ','))
+    kept_starts = np.searchsorted(trip_of, np.arange(len(starts)))
+    kept_ends = np.searchsorted(trip_of, np.arange(len(starts)), side='right')
+
+    arrays = {
+        'coordinates': joined(pc.binary_join_element_wise(
+            '[', json_text(kept['longitude']), ',', json_text(kept['latitude']), ']', separators, '')),
+        'timestamps': joined(pc.binary_join_element_wise('"', kept['timestamp'], '"', separators, '')),
+    }
+    for name in ['distance_km', 'duration_hours', 'speed_kmh']:
+        arrays[name] = joined(pc.binary_join_element_wise(json_text(kept[name]), separators, ''))
+
+    def run(name, trip):
+        data, offsets = arrays[name]
+        return data[offsets[kept_starts[trip]]:offsets[kept_ends[trip]]]
+
+    features = []
+    for trip, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+        properties = json.dumps({
+            'trip_id': trip_ids[start].item() if trip_ids is not None else 'single_trip',
+            'ping_count': end - start,
+            'start_time': timestamps[start] if end > start else None,
+            'end_time': timestamps[end - 1] if end > start else None,
+            'total_distance': float(total_distances[trip]),
+            'total_duration': float(total_durations[trip])
+        }, separators=(',', ':')).encode()
+        if kept_ends[trip] - kept_starts[trip] >= 2:
+            geometry = b'{"type":"LineString","coordinates":[' + run('coordinates', trip) + b']}'
+        else:
+            geometry = b'null'
+        features.append(
+            b'{"type":"Feature","geometry":' + geometry + b',"properties":' + properties[:-1] +
+            b''.join(b',"%s":[%s]' % (name.encode(), run(name, trip))
+                     for name in ['timestamps', 'distance_km', 'duration_hours', 'speed_kmh']) + b'}}'
+        )
+    return b','.join(features)
+
+
+def iter_export(tables, export_format):
+    """Yield an export of processed pings, one chunk per table of whole trips
+
+    tables are Arrow tables of processed rows (see UploadStore.iter_tables).
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format {export_format!r}, expected one of {list(EXPORT_FORMATS)}")
+
+    if export_format == 'geojson':
+        yield b'{"type":"FeatureCollection","features":['
+    first = True
+    for table in tables:
+        if len(table) == 0:
+            continue
+        table = export_table(table)
+        if export_format == 'csv':
+            yield csv_chunk(table, header=first)
+        elif export_format == 'ndjson':
+            yield ndjson_chunk(table)
+        else:
+            yield (b'' if first else b',') + geojson_chunk(table)
+        first = False
+    if export_format == 'geojson':
+        yield b']}\n'
+
+
+def gzip_chunks(chunks, level):
+    """Compress a stream of byte chunks into one gzip stream"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
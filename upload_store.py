@@ -0,0 +1,199 @@
+import json
+import os
+import shutil
+import time
+import uuid
+
+import numpy as np
+import pyarrow as pa
+
+
+class UploadWriter:
+    """Appends processed frames to a new upload; see UploadStore.create"""
+
+    def __init__(self, store, metadata):
+        self.store = store
+        self.upload_id = str(uuid.uuid4())
+        self.metadata = dict(metadata)
+        self.temp_dir = os.path.join(store.folder, f".{self.upload_id}.tmp")
+        self.writer = None
+        self.schema = None
+        self.rows = 0
+        self.trips = {}
+        os.makedirs(self.temp_dir)
+
+    def write(self, frame):
+        """Append processed rows; each trip's rows must arrive together"""
+        if not len(frame):
+            return
+        frame = frame.reset_index(drop=True)
+        for column in frame.columns:
+            # Mixed-type text columns (common in Excel exports) are stored as strings
+            if frame[column].dtype == object:
+                frame[column] = frame[column].astype('string')
+
+        table = pa.Table.from_pandas(frame, schema=self.schema, preserve_index=False)
+        if self.writer is None:
+            self.schema = table.schema
+            self.writer = pa.ipc.new_file(os.path.join(self.temp_dir, UploadStore.DATA_FILE), self.schema)
+        self.writer.write_table(table)
+
+        if 'trip_id' in frame.columns:
+            trip_ids = frame['trip_id'].to_numpy()
+            starts = np.flatnonzero(np.r_[True, trip_ids[1:] != trip_ids[:-1]])
+            stops = np.r_[starts[1:], len(trip_ids)]
+            for trip_id, start, stop in zip(trip_ids[starts].tolist(), starts.tolist(), stops.tolist()):
+                self.trips[str(trip_id)] = [self.rows + start, self.rows + stop]
+        self.rows += len(frame)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.writer is not None:
+            self.writer.close()
+        if exc_type is not None or self.writer is None:
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+            if exc_type is None:
+                raise ValueError('No rows to store')
+            return False
+
+        index = dict(self.metadata, upload_id=self.upload_id, rows=self.rows, trips=self.trips,
+                     created_at=time.time())
+        with open(os.path.join(self.temp_dir, UploadStore.INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+        os.replace(self.temp_dir, os.path.join(self.store.folder, self.upload_id))
+        return False
+
+
+class UploadStore:
+    """Processed uploads saved as Arrow IPC files and read back through memory maps
+
+    An upload is written once, after its timestamps have been parsed and its
+    rows sorted by trip and time, next to a JSON index of the row range of
+    every trip. Later requests map the file and convert only the rows they
+    need, without reading or parsing the original CSV/Excel file again.
+    """
+
+    DATA_FILE = 'trips.arrow'
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, folder):
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def create(self, metadata=None):
+        """Writer for a new upload, used as a context manager
+
+        The upload only becomes visible (under writer.upload_id) once the
+        block exits without an error.
+        """
+        return UploadWriter(self, metadata or {})
+
+    def upload_dir(self, upload_id):
+        """Directory of an upload, or None if the ID is not a valid upload ID"""
+        try:
+            upload_id = str(uuid.UUID(upload_id))
+        except (TypeError, ValueError):
+            return None
+        return os.path.join(self.folder, upload_id)
+
+    def data_path(self, upload_id):
+        upload_dir = self.upload_dir(upload_id)
+        return os.path.join(upload_dir, self.DATA_FILE) if upload_dir else None
+
+    def index(self, upload_id):
+        """The JSON index of an upload, or None if it doesn't exist"""
+        upload_dir = self.upload_dir(upload_id)
+        if upload_dir is None:
+            return None
+        try:
+            with open(os.path.join(upload_dir, self.INDEX_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _table(self, upload_id):
+        # Zero-copy: the table's buffers point into the mapped file
+        return pa.ipc.open_file(pa.memory_map(self.data_path(upload_id))).read_all()
+
+    def _frame(self, table, index):
+        frame = table.to_pandas()
+        frame.attrs['timestamp_parsing'] = index.get('timestamp_parsing')
+        frame.attrs['distance_model'] = index.get('distance_model')
+        return frame
+
+    def read(self, upload_id, trip_id=None):
+        """Processed rows of an upload, or of one of its trips
+
+        Returns None if the upload doesn't exist, and raises KeyError if it
+        has no such trip.
+        """
+        index = self.index(upload_id)
+        if index is None:
+            return None
+        table = self._table(upload_id)
+        if trip_id is not None:
+            start, stop = index['trips'][str(trip_id)]
+            table = table.slice(start, stop - start)
+        return self._frame(table, index)
+
+    def iter_tables(self, upload_id, max_rows, trip_ids=None):
+        """Yield an upload's rows as Arrow tables of whole trips, about max_rows each
+
+        The tables are slices of the mapped file, for callers that work on
+        Arrow data without converting it to pandas. With trip_ids only those
+        trips are yielded, one table each (KeyError for a trip the upload
+        doesn't have). An upload without trip IDs is yielded whole.
+        """
+        index = self.index(upload_id)
+        if index is None:
+            raise FileNotFoundError(f"Upload {upload_id} not found")
+        table = self._table(upload_id)
+
+        if trip_ids is not None:
+            ranges = [index['trips'][str(trip_id)] for trip_id in trip_ids]
+            for start, stop in ranges:
+                yield table.slice(start, stop - start)
+            return
+        if not index['trips']:
+            yield table
+            return
+
+        ranges = sorted(index['trips'].values())
+        first = 0
+        for i, (start, stop) in enumerate(ranges):
+            if stop - ranges[first][0] >= max_rows or i == len(ranges) - 1:
+                chunk_start = ranges[first][0]
+                yield table.slice(chunk_start, stop - chunk_start)
+                first = i + 1
+
+    def iter_frames(self, upload_id, max_rows):
+        """Yield an upload's rows as frames of whole trips, about max_rows each"""
+        index = self.index(upload_id)
+        if index is None:
+            raise FileNotFoundError(f"Upload {upload_id} not found")
+        if not index['trips']:
+            return
+        for table in self.iter_tables(upload_id, max_rows):
+            yield self._frame(table, index)
+
+    def delete(self, upload_id):
+        upload_dir = self.upload_dir(upload_id)
+        if upload_dir:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+    def purge(self, max_age_seconds):
+        """Delete uploads (and abandoned partial writes) older than max_age_seconds"""
+        cutoff = time.time() - max_age_seconds
+        removed = 0
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed